@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Query plan check for the hot history queries.
+
+Runs EXPLAIN on the queries behind the history, breakdown and quota routes
+and reports any that scan a whole table instead of using an index. Uses the
+same database as the application (DATABASE_URL, or the local SQLite file).
+Exits with status 1 if any query does a full table scan.
+
+On PostgreSQL sequential scans are disabled for the check, because the
+planner prefers them on small tables even when a usable index exists.
+"""
+
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+# Add the project root to the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import func, select, text
+
+from src.main import app
+from src.models.models import db, BalanceHistory, CashFlow, Job, NavHistory, NetworthRollup, ProtocolBalance, QuotaHistory, TokenBalance
+from src.models.manual_balance import ManualBalance
+from src.routes.wallets import protocol_history_query
+
+CHECKED_TABLES = {
+    'balance_history', 'manual_balances', 'cash_flows', 'quota_history',
+    'nav_history', 'protocol_balances', 'token_balances', 'networth_rollups'
+}
+
+SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?!.*USING)')
+POSTGRES_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+def hot_queries(wallet_id, cutoff_date):
+    """(name, statement) pairs for the queries the history routes run"""
+    return [
+        ('balance history window', select(BalanceHistory.id, BalanceHistory.timestamp, BalanceHistory.networth)
+            .where(BalanceHistory.wallet_id == wallet_id, BalanceHistory.timestamp >= cutoff_date)
+            .order_by(BalanceHistory.timestamp)),
+        ('latest automatic balance', select(BalanceHistory.id)
+            .where(BalanceHistory.wallet_id == wallet_id)
+            .order_by(BalanceHistory.timestamp.desc()).limit(1)),
+        ('protocol history', protocol_history_query(wallet_id, cutoff_date, 100)),
+        ('protocol history (top N)', protocol_history_query(wallet_id, cutoff_date, 100, top=5)),
+        ('token breakdown', select(TokenBalance.token_symbol, TokenBalance.value)
+            .where(TokenBalance.balance_history_id.in_([1, 2, 3]))),
+        ('protocol breakdown', select(ProtocolBalance.protocol_key, ProtocolBalance.value)
+            .where(ProtocolBalance.balance_history_id == 1)),
+        ('delta keyframe count', select(func.count(BalanceHistory.id))
+            .where(BalanceHistory.token_keyframe_id == 1)),
+        ('manual balance window', select(ManualBalance.timestamp, ManualBalance.networth)
+            .where(ManualBalance.wallet_id == wallet_id, ManualBalance.timestamp >= cutoff_date)
+            .order_by(ManualBalance.timestamp)),
+        ('cash flows', select(CashFlow.id)
+            .where(CashFlow.wallet_id == wallet_id)
+            .order_by(CashFlow.timestamp.desc())),
+        ('cash flow replay', select(CashFlow.id)
+            .where(CashFlow.wallet_id == wallet_id, CashFlow.timestamp >= cutoff_date)
+            .order_by(CashFlow.timestamp, CashFlow.id)),
+        ('quota history by timestamp', select(QuotaHistory.id)
+            .where(QuotaHistory.wallet_id == wallet_id, QuotaHistory.timestamp == cutoff_date)),
+        ('nav window', select(NavHistory.timestamp, NavHistory.quota_value)
+            .where(NavHistory.wallet_id == wallet_id, NavHistory.timestamp >= cutoff_date)
+            .order_by(NavHistory.timestamp.desc()).limit(100)),
+        ('differential backup history', select(BalanceHistory.id)
+            .where(BalanceHistory.created_at > cutoff_date).order_by(BalanceHistory.created_at, BalanceHistory.id)),
+        ('differential backup manual balances', select(ManualBalance.id)
+            .where(ManualBalance.updated_at > cutoff_date)),
+        ('portfolio rollups', select(NetworthRollup.wallet_id, NetworthRollup.bucket_start)
+            .where(NetworthRollup.wallet_id.in_([wallet_id, wallet_id + 1]), NetworthRollup.granularity == 'day',
+                   NetworthRollup.bucket_start >= cutoff_date)),
+        ('job queue claim', select(Job.id).where(Job.status == 'queued').order_by(Job.id).limit(1)),
+    ]
+
+
+def explain(conn, statement):
+    """Return the query plan of a statement as a list of text lines"""
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+
+    if conn.dialect.name == 'sqlite':
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).all()
+        return [row[-1] for row in rows]
+    rows = conn.exec_driver_sql(f'EXPLAIN {compiled}', params).all()
+    return [row[0] for row in rows]
+
+
+def full_scans(dialect_name, plan):
+    """Names of checked tables that the plan reads with a full scan"""
+    pattern = SQLITE_SCAN if dialect_name == 'sqlite' else POSTGRES_SCAN
+    scans = set()
+    for line in plan:
+        match = pattern.search(line.strip())
+        if match and match.group(1) in CHECKED_TABLES:
+            scans.add(match.group(1))
+    return scans
+
+
+def check_query_plans():
+    """Explain every hot query and report full table scans"""
+    failures = 0
+    cutoff_date = datetime.utcnow() - timedelta(days=30)
+
+    with app.app_context():
+        with db.engine.begin() as conn:
+            dialect_name = conn.dialect.name
+            print(f"Checking query plans on {dialect_name}...")
+            if dialect_name == 'postgresql':
+                conn.execute(text('SET LOCAL enable_seqscan = off'))
+
+            for name, statement in hot_queries(1, cutoff_date):
+                plan = explain(conn, statement)
+                scans = full_scans(dialect_name, plan)
+                if scans:
+                    failures += 1
+                    print(f"✗ {name}: full scan of {', '.join(sorted(scans))}")
+                    for line in plan:
+                        print(f"    {line}")
+                else:
+                    print(f"✓ {name}")
+
+    if failures:
+        print(f"\n❌ {failures} queries do full table scans")
+        sys.exit(1)
+    print("\n✅ All hot queries use indexes")
+
+
+if __name__ == '__main__':
+    check_query_plans()
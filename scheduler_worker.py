@@ -28,7 +28,15 @@ def create_app():
     if database_url and database_url.startswith('postgres://'):
         database_url = database_url.replace('postgres://', 'postgresql://', 1)
     
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///src/database/app.db'
+    if not database_url:
+        # Same SQLite file as the web app (src/main.py), which background jobs share
+        data_dir = os.getenv('DATA_DIR', '/data')
+        if not os.path.exists(data_dir):
+            data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+        os.makedirs(data_dir, exist_ok=True)
+        database_url = f"sqlite:///{os.path.join(data_dir, 'app.db')}"
+    
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'asdf#FGSgvasgf$5$WGT')
     
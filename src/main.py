@@ -11,11 +11,13 @@ from werkzeug.security import generate_password_hash
 from dotenv import load_dotenv
 
 from src.models.models import db, User
+from src.migrations import run_migrations
 from src.routes.auth import auth_bp
 from src.routes.wallets import wallets_bp
 from src.routes.admin import admin_bp
 from src.routes.settings import settings_bp
 from src.routes.backup import backup_bp
+from src.routes.jobs import jobs_bp
 from src.routes.portfolio import portfolio_bp
 from src.routes.quota import quota_bp
 from src.routes.manual_balance import manual_balance_bp
@@ -101,6 +103,7 @@ app.register_blueprint(wallets_bp, url_prefix='/api/wallets')
 app.register_blueprint(admin_bp, url_prefix='/api/admin')
 app.register_blueprint(settings_bp, url_prefix='/api/settings')
 app.register_blueprint(backup_bp, url_prefix='/api/backup')
+app.register_blueprint(jobs_bp, url_prefix='/api/jobs')
 app.register_blueprint(portfolio_bp)
 app.register_blueprint(quota_bp)
 app.register_blueprint(manual_balance_bp)
@@ -110,6 +113,7 @@ app.register_blueprint(manual_balance_bp)
 # Create database tables and initialize scheduler
 with app.app_context():
     db.create_all()
+    run_migrations(db.engine)
     
     # Create default admin user if not exists
     admin = User.query.filter_by(username='admin').first()
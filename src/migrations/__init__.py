@@ -0,0 +1,92 @@
+"""
+Versioned schema migrations.
+
+db.create_all() creates missing tables but never changes existing ones.
+Changes to existing tables are migrations: modules in this package with a
+VERSION, a DESCRIPTION and an upgrade(conn) function, listed in MIGRATIONS.
+run_migrations() applies the pending ones in list order, each in its own
+transaction, and records them in the schema_migrations table. Works on
+SQLite and PostgreSQL.
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, select, text
+
+from src.migrations import (
+    m0001_composite_indexes, m0002_networth_rollups, m0003_change_tracking, m0004_quota_history_cash_flow,
+    m0005_snapshot_storage_columns, m0006_ledger_change_tracking, m0007_job_files_on_disk, m0008_nav_backfill
+)
+
+# Applied in list order. Versions identify migrations and never change;
+# migration 5 replaced a standalone script and must precede migration 1.
+MIGRATIONS = [
+    m0005_snapshot_storage_columns,
+    m0001_composite_indexes,
+    m0002_networth_rollups,
+    m0003_change_tracking,
+    m0004_quota_history_cash_flow,
+    m0006_ledger_change_tracking,
+    m0007_job_files_on_disk,
+    m0008_nav_backfill,
+]
+
+# Arbitrary key for the PostgreSQL advisory lock that serializes migrations
+ADVISORY_LOCK_KEY = 7410025
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+
+def applied_versions(engine):
+    """Set of migration versions already recorded in the database"""
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def run_migrations(engine):
+    """
+    Apply pending migrations in MIGRATIONS order
+
+    On PostgreSQL each migration runs under a transaction-level advisory
+    lock and the version is re-checked inside it, so concurrent starts
+    cannot apply the same migration twice.
+
+    Args:
+        engine: SQLAlchemy engine for the application database
+
+    Returns:
+        list: Versions applied by this call
+    """
+    applied = applied_versions(engine)
+    newly_applied = []
+
+    for migration in MIGRATIONS:
+        if migration.VERSION in applied:
+            continue
+
+        with engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': ADVISORY_LOCK_KEY})
+                already_applied = conn.execute(
+                    select(schema_migrations.c.version).where(schema_migrations.c.version == migration.VERSION)
+                ).first()
+                if already_applied:
+                    continue
+
+            print(f"Applying migration {migration.VERSION}: {migration.DESCRIPTION}")
+            migration.upgrade(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=migration.VERSION,
+                description=migration.DESCRIPTION,
+                applied_at=datetime.utcnow()
+            ))
+        newly_applied.append(migration.VERSION)
+
+    return newly_applied
@@ -0,0 +1,34 @@
+"""
+Indexes for the per-wallet history lookups and snapshot child rows.
+
+Databases created before these indexes were declared on the models only
+have primary keys, so every history query scans the whole table. New
+databases already get them from db.create_all(); IF NOT EXISTS makes this a
+no-op there. The snapshot storage columns some of them cover are added by
+migration 5, which runs first.
+"""
+from sqlalchemy import inspect, text
+
+VERSION = 1
+DESCRIPTION = 'Composite indexes for history lookups'
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_balance_history_wallet_timestamp', 'balance_history', ('wallet_id', 'timestamp')),
+    ('ix_balance_history_heartbeat_of_id', 'balance_history', ('heartbeat_of_id',)),
+    ('ix_balance_history_token_keyframe_id', 'balance_history', ('token_keyframe_id',)),
+    ('ix_manual_balances_wallet_timestamp', 'manual_balances', ('wallet_id', 'timestamp')),
+    ('ix_cash_flows_wallet_timestamp', 'cash_flows', ('wallet_id', 'timestamp')),
+    ('ix_quota_history_wallet_timestamp', 'quota_history', ('wallet_id', 'timestamp')),
+    ('ix_protocol_balances_balance_history_id', 'protocol_balances', ('balance_history_id',)),
+    ('ix_token_balances_balance_history_id', 'token_balances', ('balance_history_id',)),
+]
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    for name, table, columns in INDEXES:
+        if not inspector.has_table(table):
+            continue
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+        print(f"  ✓ {name}")
@@ -0,0 +1,25 @@
+"""
+Backfill the hour/day/week networth rollups for existing wallets.
+
+New balance points keep the rollups current from here on. Aggregating the
+history recorded before the networth_rollups table existed reads every
+balance point, so it runs as a background job (rollup_backfill) in the
+scheduler worker instead of during web startup; long-range charts fill in
+once it has run.
+"""
+from sqlalchemy import select
+
+from src.models.models import BalanceHistory, NetworthRollup
+from src.services.jobs import enqueue_job
+
+VERSION = 2
+DESCRIPTION = 'Backfill networth rollups'
+
+
+def upgrade(conn):
+    NetworthRollup.__table__.create(conn, checkfirst=True)
+
+    history = BalanceHistory.__table__
+    if conn.execute(select(history.c.id).limit(1)).first():
+        enqueue_job(conn, 'rollup_backfill')
+        print("  ✓ queued rollup_backfill job")
@@ -0,0 +1,27 @@
+"""
+Change tracking for differential backups.
+
+Differential exports select balance history created after a watermark and
+manual balances updated after it. Balance history had no creation time, so
+existing rows get their snapshot timestamp; both lookups get an index.
+"""
+from sqlalchemy import inspect, text
+
+VERSION = 3
+DESCRIPTION = 'Change tracking columns for differential backups'
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+
+    if inspector.has_table('balance_history'):
+        columns = {column['name'] for column in inspector.get_columns('balance_history')}
+        if 'created_at' not in columns:
+            conn.execute(text('ALTER TABLE balance_history ADD COLUMN created_at TIMESTAMP'))
+        conn.execute(text('UPDATE balance_history SET created_at = timestamp WHERE created_at IS NULL'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_balance_history_created_at ON balance_history (created_at)'))
+        print("  ✓ balance_history.created_at")
+
+    if inspector.has_table('manual_balances'):
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_manual_balances_updated_at ON manual_balances (updated_at)'))
+        print("  ✓ ix_manual_balances_updated_at")
@@ -0,0 +1,26 @@
+"""
+Link quota history rows to their cash flows.
+
+Editing or deleting a cash flow found its QuotaHistory row by timestamp,
+which is ambiguous when several flows share one. Rows now carry the ID of
+the flow that created them; existing rows are paired with flows of the same
+wallet and timestamp in ID order.
+"""
+from sqlalchemy import inspect, text
+
+from src.services.quota_engine import link_quota_history
+
+VERSION = 4
+DESCRIPTION = 'Link quota history to cash flows'
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    if not inspector.has_table('quota_history'):
+        return
+
+    columns = {column['name'] for column in inspector.get_columns('quota_history')}
+    if 'cash_flow_id' not in columns:
+        conn.execute(text('ALTER TABLE quota_history ADD COLUMN cash_flow_id INTEGER REFERENCES cash_flows (id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_quota_history_cash_flow_id ON quota_history (cash_flow_id)'))
+    print(f"  ✓ quota_history.cash_flow_id ({link_quota_history(conn)} rows linked)")
@@ -0,0 +1,95 @@
+"""
+Snapshot storage columns.
+
+Adds the columns introduced by out-of-row payloads, heartbeat rows, token
+delta encoding and the denormalized latest balance to databases created
+before them, creates balance_payloads and fills wallets.latest_* (one
+lookup per wallet). Runs before migration 1, whose indexes cover some of
+these columns.
+
+Moving existing inline payloads into balance_payloads rewrites every
+history row, so it is queued as a background job (payload_migration)
+instead of running during startup; reads fall back to the inline payload
+until then.
+"""
+from sqlalchemy import inspect, select, text, update
+
+from src.models.models import BalanceHistory, BalancePayload, Wallet
+from src.models.manual_balance import ManualBalance
+from src.services.jobs import enqueue_job
+
+VERSION = 5
+DESCRIPTION = 'Snapshot storage columns and latest balance backfill'
+
+# (table, column, column DDL) added to existing databases
+NEW_COLUMNS = [
+    ('balance_history', 'content_hash', 'VARCHAR(64)'),
+    ('balance_history', 'heartbeat_of_id', 'INTEGER REFERENCES balance_history (id)'),
+    ('balance_history', 'token_keyframe_id', 'INTEGER REFERENCES balance_history (id)'),
+    ('token_balances', 'delta_op', 'VARCHAR(1)'),
+    ('wallets', 'latest_balance_id', 'INTEGER'),
+    ('wallets', 'latest_networth', 'FLOAT'),
+    ('wallets', 'latest_timestamp', 'TIMESTAMP'),
+]
+
+
+def backfill_latest_balances(conn, has_manual_balances):
+    """Fill wallets.latest_* for wallets that have never been updated"""
+    wallets = Wallet.__table__
+    history = BalanceHistory.__table__
+    manual = ManualBalance.__table__
+    updated = 0
+
+    wallet_ids = conn.execute(select(wallets.c.id).where(wallets.c.latest_timestamp.is_(None))).scalars().all()
+    for wallet_id in wallet_ids:
+        latest = conn.execute(
+            select(history.c.id, history.c.timestamp, history.c.networth)
+            .where(history.c.wallet_id == wallet_id)
+            .order_by(history.c.timestamp.desc())
+            .limit(1)
+        ).first()
+        values = {
+            'latest_balance_id': latest.id if latest else None,
+            'latest_networth': latest.networth if latest else None,
+            'latest_timestamp': latest.timestamp if latest else None
+        }
+
+        if has_manual_balances:
+            latest_manual = conn.execute(
+                select(manual.c.timestamp, manual.c.networth)
+                .where(manual.c.wallet_id == wallet_id)
+                .order_by(manual.c.timestamp.desc())
+                .limit(1)
+            ).first()
+            if latest_manual and (latest is None or latest_manual.timestamp > latest.timestamp):
+                values['latest_networth'] = latest_manual.networth
+                values['latest_timestamp'] = latest_manual.timestamp
+
+        if values['latest_timestamp'] is not None:
+            conn.execute(update(wallets).where(wallets.c.id == wallet_id).values(**values))
+            updated += 1
+    return updated
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    if not inspector.has_table('balance_history'):
+        return
+
+    for table, column, ddl in NEW_COLUMNS:
+        if not inspector.has_table(table):
+            continue
+        if column not in {existing['name'] for existing in inspector.get_columns(table)}:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+            print(f"  ✓ {table}.{column}")
+
+    BalancePayload.__table__.create(conn, checkfirst=True)
+
+    if inspector.has_table('wallets'):
+        updated = backfill_latest_balances(conn, inspector.has_table('manual_balances'))
+        print(f"  ✓ latest balance on {updated} wallets")
+
+    history = BalanceHistory.__table__
+    if conn.execute(select(history.c.id).where(history.c.data_json != '').limit(1)).first():
+        enqueue_job(conn, 'payload_migration')
+        print("  ✓ queued payload_migration job")
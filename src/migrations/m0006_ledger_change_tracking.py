@@ -0,0 +1,32 @@
+"""
+Track cash flow ledger changes for differential backups.
+
+Differential exports used to pick ledgers by the wallet's data version,
+which every sync moves, so each export repeated every synced wallet's
+ledger. Wallets now record when their ledger last changed. Wallets that
+already have cash flows are marked as changed now, so the next differential
+export carries their ledgers once.
+"""
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+VERSION = 6
+DESCRIPTION = 'Ledger change tracking for differential backups'
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    if not inspector.has_table('wallets'):
+        return
+
+    columns = {column['name'] for column in inspector.get_columns('wallets')}
+    if 'ledger_updated_at' not in columns:
+        conn.execute(text('ALTER TABLE wallets ADD COLUMN ledger_updated_at TIMESTAMP'))
+    if inspector.has_table('cash_flows'):
+        conn.execute(
+            text('UPDATE wallets SET ledger_updated_at = :now WHERE ledger_updated_at IS NULL '
+                 'AND id IN (SELECT wallet_id FROM cash_flows)'),
+            {'now': datetime.utcnow()}
+        )
+    print("  ✓ wallets.ledger_updated_at")
@@ -0,0 +1,26 @@
+"""
+Stage job files on disk.
+
+job_files kept uploads and results as binary columns, which loads whole
+backups into memory and caps them at the database's value size. Rows now
+point at files under the job files directory. The old rows only held
+transient job inputs and results, so the table is recreated.
+"""
+from sqlalchemy import inspect
+
+from src.models.models import JobFile
+
+VERSION = 7
+DESCRIPTION = 'Job files on disk'
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    if not inspector.has_table('job_files'):
+        return
+
+    columns = {column['name'] for column in inspector.get_columns('job_files')}
+    if 'path' not in columns:
+        JobFile.__table__.drop(conn)
+        JobFile.__table__.create(conn)
+        print("  ✓ job_files recreated")
@@ -0,0 +1,28 @@
+"""
+Backfill the materialized NAV series for existing wallets.
+
+Balance writes keep NavHistory current for a wallet once it has NAV points.
+Valuing the history recorded before the nav_history table existed reads
+every balance point and cash flow, so it runs as a background job
+(nav_backfill) in the scheduler worker instead of during web startup or in
+a GET request; until then quota history and analytics value those wallets
+on the fly.
+"""
+from sqlalchemy import select
+
+from src.models.models import BalanceHistory, NavHistory
+from src.models.manual_balance import ManualBalance
+from src.services.jobs import enqueue_job
+
+VERSION = 8
+DESCRIPTION = 'Backfill materialized NAV series'
+
+
+def upgrade(conn):
+    NavHistory.__table__.create(conn, checkfirst=True)
+
+    for table in (BalanceHistory.__table__, ManualBalance.__table__):
+        if conn.execute(select(table.c.id).limit(1)).first():
+            enqueue_job(conn, 'nav_backfill')
+            print("  ✓ queued nav_backfill job")
+            break
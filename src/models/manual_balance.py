@@ -17,6 +17,11 @@ class ManualBalance(db.Model):
     # Relationships
     wallet = db.relationship('Wallet', backref='manual_balances')
     
+    __table_args__ = (
+        db.Index('ix_manual_balances_wallet_timestamp', 'wallet_id', 'timestamp'),
+        db.Index('ix_manual_balances_updated_at', 'updated_at'),
+    )
+    
     def __repr__(self):
         return f'<ManualBalance wallet_id={self.wallet_id} networth={self.networth} timestamp={self.timestamp}>'
     
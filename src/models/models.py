@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+import zlib
 
 db = SQLAlchemy()
 
@@ -32,12 +33,20 @@ class Wallet(db.Model):
     # Quota system fields
     initial_quota_value = db.Column(db.Float, default=1.0, nullable=False)  # Initial quota value (default $1.00)
     current_quota_quantity = db.Column(db.Float, default=0.0, nullable=False)  # Current number of quotas
+    ledger_updated_at = db.Column(db.DateTime, nullable=True)  # Last change to cash flows / quota history
+    
+    # Denormalized latest balance, maintained by src/services/wallet_state.py
+    latest_balance_id = db.Column(db.Integer, nullable=True)  # Newest automatic BalanceHistory
+    latest_networth = db.Column(db.Float, nullable=True)  # Newest automatic or manual networth
+    latest_timestamp = db.Column(db.DateTime, nullable=True)
     
     # Relationships
     balance_history = db.relationship('BalanceHistory', back_populates='wallet', cascade='all, delete-orphan')
     permissions = db.relationship('WalletPermission', back_populates='wallet', cascade='all, delete-orphan')
     cash_flows = db.relationship('CashFlow', back_populates='wallet', cascade='all, delete-orphan')
     quota_history = db.relationship('QuotaHistory', back_populates='wallet', cascade='all, delete-orphan')
+    nav_history = db.relationship('NavHistory', back_populates='wallet', cascade='all, delete-orphan')
+    networth_rollups = db.relationship('NetworthRollup', back_populates='wallet', cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Wallet {self.address}>'
@@ -69,17 +78,103 @@ class BalanceHistory(db.Model):
     wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     networth = db.Column(db.Float, nullable=False)
-    data_json = db.Column(db.Text, nullable=False)  # Store full API response as JSON
+    # Legacy inline copy of the API response; new snapshots keep it empty and
+    # store the payload in BalancePayload. Deferred so queries never load it.
+    data_json = db.deferred(db.Column(db.Text, nullable=False, default=''))
+    # Hash of the normalized payload, used to detect unchanged snapshots
+    content_hash = db.Column(db.String(64), nullable=True)
+    # Set on heartbeat rows: the full snapshot whose payload and children this row reuses
+    heartbeat_of_id = db.Column(db.Integer, db.ForeignKey('balance_history.id'), nullable=True)
+    # Set on delta-encoded snapshots: the full keyframe their token rows are relative to
+    token_keyframe_id = db.Column(db.Integer, db.ForeignKey('balance_history.id'), nullable=True)
+    # When the row was written (differs from timestamp for imported history)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=True)
     
     # Relationships
     wallet = db.relationship('Wallet', back_populates='balance_history')
     protocol_balances = db.relationship('ProtocolBalance', back_populates='balance_history', cascade='all, delete-orphan')
     token_balances = db.relationship('TokenBalance', back_populates='balance_history', cascade='all, delete-orphan')
+    payload = db.relationship('BalancePayload', uselist=False, cascade='all, delete-orphan')
+    heartbeat_of = db.relationship('BalanceHistory', remote_side=[id], foreign_keys=[heartbeat_of_id])
+    
+    __table_args__ = (
+        db.Index('ix_balance_history_wallet_timestamp', 'wallet_id', 'timestamp'),
+        db.Index('ix_balance_history_heartbeat_of_id', 'heartbeat_of_id'),
+        db.Index('ix_balance_history_token_keyframe_id', 'token_keyframe_id'),
+        db.Index('ix_balance_history_created_at', 'created_at'),
+    )
+    
+    @property
+    def is_heartbeat(self):
+        return self.heartbeat_of_id is not None
+    
+    @property
+    def snapshot_id(self):
+        """ID of the row holding this snapshot's payload, protocol and token rows"""
+        return self.heartbeat_of_id or self.id
+    
+    @property
+    def raw_json(self):
+        """Full API response as a JSON string (loads the payload on access)"""
+        if self.is_heartbeat:
+            return self.heartbeat_of.raw_json
+        if self.payload is not None:
+            return self.payload.decode()
+        return self.data_json or None
+    
+    @raw_json.setter
+    def raw_json(self, value):
+        self.data_json = ''
+        if value is None:
+            self.payload = None
+        elif self.payload is not None:
+            self.payload.encode(value)
+        else:
+            self.payload = BalancePayload().encode(value)
     
     def __repr__(self):
         return f'<BalanceHistory wallet_id={self.wallet_id} networth={self.networth}>'
 
 
+class BalancePayload(db.Model):
+    """Compressed raw API response for a balance snapshot, stored out of row"""
+    __tablename__ = 'balance_payloads'
+    
+    CODEC_ZLIB = 'zlib'
+    CODEC_NONE = 'none'
+    
+    balance_history_id = db.Column(db.Integer, db.ForeignKey('balance_history.id'), primary_key=True)
+    # Header: codec used for `payload` and the uncompressed size in bytes
+    codec = db.Column(db.String(10), nullable=False, default=CODEC_ZLIB)
+    raw_size = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    
+    @staticmethod
+    def compress(text):
+        """Compress a JSON string, returning (codec, raw_size, blob)"""
+        raw = text.encode('utf-8')
+        return BalancePayload.CODEC_ZLIB, len(raw), zlib.compress(raw, 6)
+    
+    @staticmethod
+    def decompress(codec, blob):
+        """Decompress a stored payload back into a JSON string"""
+        if codec == BalancePayload.CODEC_ZLIB:
+            blob = zlib.decompress(blob)
+        elif codec != BalancePayload.CODEC_NONE:
+            raise ValueError(f"Unknown payload codec: {codec}")
+        return blob.decode('utf-8')
+    
+    def encode(self, text):
+        self.codec, self.raw_size, self.payload = BalancePayload.compress(text)
+        return self
+    
+    def decode(self):
+        return BalancePayload.decompress(self.codec, self.payload)
+    
+    def __repr__(self):
+        return f'<BalancePayload balance_history_id={self.balance_history_id} codec={self.codec} raw_size={self.raw_size}>'
+
+
 class ProtocolBalance(db.Model):
     __tablename__ = 'protocol_balances'
     
@@ -93,6 +188,8 @@ class ProtocolBalance(db.Model):
     # Relationships
     balance_history = db.relationship('BalanceHistory', back_populates='protocol_balances')
     
+    __table_args__ = (db.Index('ix_protocol_balances_balance_history_id', 'balance_history_id'),)
+    
     def __repr__(self):
         return f'<ProtocolBalance {self.protocol_name} value={self.value}>'
 
@@ -100,6 +197,10 @@ class ProtocolBalance(db.Model):
 class TokenBalance(db.Model):
     __tablename__ = 'token_balances'
     
+    # delta_op values for rows of delta-encoded snapshots
+    DELTA_UPSERT = 'u'
+    DELTA_REMOVE = 'd'
+    
     id = db.Column(db.Integer, primary_key=True)
     balance_history_id = db.Column(db.Integer, db.ForeignKey('balance_history.id'), nullable=False)
     token_symbol = db.Column(db.String(50), nullable=False)
@@ -109,10 +210,13 @@ class TokenBalance(db.Model):
     price = db.Column(db.Float, nullable=False)
     chain = db.Column(db.String(50), nullable=True)
     protocol = db.Column(db.String(100), nullable=True)
+    delta_op = db.Column(db.String(1), nullable=True)  # None for full rows, 'u'/'d' for delta rows
     
     # Relationships
     balance_history = db.relationship('BalanceHistory', back_populates='token_balances')
     
+    __table_args__ = (db.Index('ix_token_balances_balance_history_id', 'balance_history_id'),)
+    
     def __repr__(self):
         return f'<TokenBalance {self.token_symbol} balance={self.balance}>'
 
@@ -134,6 +238,8 @@ class CashFlow(db.Model):
     # Relationships
     wallet = db.relationship('Wallet', back_populates='cash_flows')
     
+    __table_args__ = (db.Index('ix_cash_flows_wallet_timestamp', 'wallet_id', 'timestamp'),)
+    
     def __repr__(self):
         return f'<CashFlow wallet_id={self.wallet_id} type={self.type} amount={self.amount}>'
 
@@ -148,14 +254,162 @@ class QuotaHistory(db.Model):
     quota_value = db.Column(db.Float, nullable=False)  # Value of one quota at this time
     quota_quantity = db.Column(db.Float, nullable=False)  # Total number of quotas
     networth = db.Column(db.Float, nullable=False)  # Net worth at this time
+    cash_flow_id = db.Column(db.Integer, db.ForeignKey('cash_flows.id'), nullable=True, index=True)  # Flow this row records
     
     # Relationships
     wallet = db.relationship('Wallet', back_populates='quota_history')
     
+    __table_args__ = (db.Index('ix_quota_history_wallet_timestamp', 'wallet_id', 'timestamp'),)
+    
     def __repr__(self):
         return f'<QuotaHistory wallet_id={self.wallet_id} quota_value={self.quota_value}>'
 
 
+class NavHistory(db.Model):
+    """Materialized quota valuation of every balance point, maintained by src/services/quota_engine.py"""
+    __tablename__ = 'nav_history'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    networth = db.Column(db.Float, nullable=False)
+    quota_quantity = db.Column(db.Float, nullable=False)  # Quotas outstanding at this time
+    quota_value = db.Column(db.Float, nullable=False)  # Value of one quota at this time
+    source = db.Column(db.String(10), nullable=False)  # 'automatic' or 'manual'
+    
+    # Relationships
+    wallet = db.relationship('Wallet', back_populates='nav_history')
+    
+    __table_args__ = (db.Index('ix_nav_history_wallet_timestamp', 'wallet_id', 'timestamp'),)
+    
+    def __repr__(self):
+        return f'<NavHistory wallet_id={self.wallet_id} quota_value={self.quota_value}>'
+
+
+class NetworthRollup(db.Model):
+    """Per-wallet networth aggregated into hour/day/week buckets, maintained by src/services/rollups.py"""
+    __tablename__ = 'networth_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallets.id'), nullable=False)
+    granularity = db.Column(db.String(10), nullable=False)  # 'hour', 'day' or 'week'
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    min_networth = db.Column(db.Float, nullable=False)
+    max_networth = db.Column(db.Float, nullable=False)
+    sum_networth = db.Column(db.Float, nullable=False)
+    auto_count = db.Column(db.Integer, nullable=False, default=0)
+    manual_count = db.Column(db.Integer, nullable=False, default=0)
+    # Last point of each source in the bucket; automatic data takes precedence
+    last_auto_networth = db.Column(db.Float, nullable=True)
+    last_auto_timestamp = db.Column(db.DateTime, nullable=True)
+    last_manual_networth = db.Column(db.Float, nullable=True)
+    last_manual_timestamp = db.Column(db.DateTime, nullable=True)
+    
+    # Relationships
+    wallet = db.relationship('Wallet', back_populates='networth_rollups')
+    
+    __table_args__ = (
+        db.Index('ix_networth_rollups_wallet_bucket', 'wallet_id', 'granularity', 'bucket_start', unique=True),
+    )
+    
+    @property
+    def point_count(self):
+        return self.auto_count + self.manual_count
+    
+    @property
+    def networth(self):
+        """Closing networth of the bucket (last automatic point, else last manual point)"""
+        return self.last_auto_networth if self.auto_count else self.last_manual_networth
+    
+    @property
+    def source(self):
+        return 'automatic' if self.auto_count else 'manual'
+    
+    def __repr__(self):
+        return f'<NetworthRollup wallet_id={self.wallet_id} {self.granularity} {self.bucket_start}>'
+
+
+class DataVersion(db.Model):
+    """Per-wallet counter bumped by every write to the wallet's data, used by src/services/response_cache.py"""
+    __tablename__ = 'data_versions'
+    
+    # No foreign key: the version must outlive a deleted wallet so a reused ID
+    # cannot match entries cached for the old wallet
+    wallet_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DataVersion wallet_id={self.wallet_id} version={self.version}>'
+
+
+class Job(db.Model):
+    """Long-running admin operation executed by the job runner in src/services/jobs.py"""
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed, cancelled
+    params_json = db.Column(db.Text, nullable=True)
+    progress = db.Column(db.Float, nullable=False, default=0.0)  # Percent complete
+    message = db.Column(db.String(255), nullable=True)
+    result_json = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    # Handler-defined resume point saved with progress updates (JSON)
+    checkpoint_json = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+
+    # Relationships
+    files = db.relationship('JobFile', backref='job', lazy=True, cascade='all, delete-orphan',
+                            order_by='JobFile.position')
+
+    __table_args__ = (db.Index('ix_jobs_status_id', 'status', 'id'),)
+
+    def to_dict(self):
+        result_file = next((f for f in self.files if f.role == 'result'), None)
+        return {
+            'id': self.id,
+            'type': self.type,
+            'status': self.status,
+            'progress': round(self.progress or 0.0, 1),
+            'message': self.message,
+            'error': self.error,
+            'attempts': self.attempts,
+            'cancel_requested': self.cancel_requested,
+            'result_file': result_file.filename if result_file else None,
+            'created_by': self.created_by,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.type} {self.status}>'
+
+
+class JobFile(db.Model):
+    """Uploaded input or produced result of a job, staged as a file under the job files directory"""
+    __tablename__ = 'job_files'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id', ondelete='CASCADE'), nullable=False, index=True)
+    role = db.Column(db.String(10), nullable=False)  # 'input' or 'result'
+    position = db.Column(db.Integer, nullable=False, default=0)
+    filename = db.Column(db.String(255), nullable=False)
+    mimetype = db.Column(db.String(100), nullable=True)
+    path = db.Column(db.String(255), nullable=False)  # Relative to the job files directory
+    size = db.Column(db.BigInteger, nullable=False, default=0)  # Bytes
+
+    def __repr__(self):
+        return f'<JobFile job_id={self.job_id} {self.role} {self.filename}>'
+
+
 class AppSettings(db.Model):
     __tablename__ = 'app_settings'
     
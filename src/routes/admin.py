@@ -1,7 +1,10 @@
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, current_user
 from functools import wraps
-from src.models.models import db, User, Wallet, WalletPermission, AppSettings
+from src.models.models import db, User, Wallet, WalletPermission, AppSettings, Job
+from src.services.jobs import JOB_QUEUED, JOB_RUNNING, enqueue_job
+from src.services.octav_service import OctavService
+from src.services.response_cache import bump_data_version
 from werkzeug.security import generate_password_hash
 
 admin_bp = Blueprint('admin', __name__)
@@ -175,6 +178,7 @@ def update_wallet(wallet_id):
     if 'name' in data:
         wallet.name = data['name']
     
+    bump_data_version(wallet.id)
     db.session.commit()
     
     return jsonify({
@@ -196,11 +200,36 @@ def delete_wallet(wallet_id):
         return jsonify({'error': 'Wallet not found'}), 404
     
     db.session.delete(wallet)
+    bump_data_version(wallet_id)
     db.session.commit()
     
     return jsonify({'message': 'Wallet deleted successfully'}), 200
 
 
+@admin_bp.route('/sync', methods=['POST'])
+@admin_required
+def sync_all():
+    """
+    Queue a sync of all wallets
+
+    Returns 202 with the sync job (the one already queued or running, if
+    any); ?wait=1 syncs in the request instead.
+    """
+    # Imported here: the jobs blueprint imports admin_required from this module
+    from src.routes.jobs import job_accepted, wants_background
+    
+    if not wants_background():
+        results = OctavService.sync_all_wallets()
+        return jsonify({key: value for key, value in results.items() if key != 'latency'}), 200
+    
+    enqueue_job(db.session.connection(), 'sync_all')
+    db.session.commit()
+    job = Job.query.filter(
+        Job.type == 'sync_all', Job.status.in_((JOB_QUEUED, JOB_RUNNING))
+    ).order_by(Job.id.desc()).first()
+    return job_accepted(job)
+
+
 # ========== PERMISSION MANAGEMENT ==========
 
 @admin_bp.route('/permissions', methods=['GET'])
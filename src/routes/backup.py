@@ -1,15 +1,26 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, Response, request, jsonify, send_file, stream_with_context
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 import os
 import json
 from datetime import datetime
 import tempfile
+import zipfile
 
 from src.models.models import db, Wallet, BalanceHistory, ProtocolBalance, TokenBalance, User, WalletPermission, AppSettings
+from src.routes.jobs import job_accepted, wants_background
+from src.services.backup_archive import read_manifest, restore_archive, verify_archive, write_archive
+from src.services.backup_import import BackupImporter, iter_ndjson_records, read_backup_header, validate_backup_chain
+from src.services.backup_stream import gzip_stream, iter_backup_records, ndjson_lines
+from src.services.bulk_import import parse_timestamp
+from src.services.jobs import submit_job
+from src.services.snapshot_store import tokens_as_of
+from src.services.wallet_state import balances_changed
 
 backup_bp = Blueprint('backup', __name__)
 
+NDJSON_EXTENSIONS = ('.ndjson', '.ndjson.gz')
+
 
 def admin_required(f):
     """Decorator to require admin privileges"""
@@ -26,6 +37,9 @@ def admin_required(f):
 @admin_required
 def export_backup():
     """Export database to JSON file"""
+    if wants_background(default=False):
+        return jsonify({'error': 'Background exports use /export/stream'}), 400
+    
     try:
         print("\n📦 Creating database backup...")
         
@@ -55,13 +69,13 @@ def export_backup():
                 history_data = {
                     'timestamp': h.timestamp.isoformat(),
                     'networth': h.networth,
-                    'data_json': h.data_json,
+                    'data_json': h.raw_json,
                     'protocols': [],
                     'tokens': []
                 }
                 
-                # Export protocol balances
-                protocols = ProtocolBalance.query.filter_by(balance_history_id=h.id).all()
+                # Export protocol balances (heartbeats reuse their snapshot's rows)
+                protocols = ProtocolBalance.query.filter_by(balance_history_id=h.snapshot_id).all()
                 for p in protocols:
                     history_data['protocols'].append({
                         'protocol_key': p.protocol_key,
@@ -69,18 +83,8 @@ def export_backup():
                         'value': p.value
                     })
                 
-                # Export token balances
-                tokens = TokenBalance.query.filter_by(balance_history_id=h.id).all()
-                for t in tokens:
-                    history_data['tokens'].append({
-                        'token_symbol': t.token_symbol,
-                        'token_name': t.token_name,
-                        'balance': t.balance,
-                        'value': t.value,
-                        'price': t.price,
-                        'chain': t.chain,
-                        'protocol': t.protocol
-                    })
+                # Export token balances (full set, rebuilt from keyframe + delta if needed)
+                history_data['tokens'].extend(tokens_as_of(h.id))
                 
                 wallet_data['balance_history'].append(history_data)
             
@@ -141,6 +145,183 @@ def export_backup():
         return jsonify({'error': str(e)}), 500
 
 
+@backup_bp.route('/export/stream', methods=['GET'])
+@login_required
+@admin_required
+def export_backup_stream():
+    """
+    Stream the database as gzipped NDJSON (constant memory)
+    
+    With ?since=<watermark> (the header watermark of a previous export) only
+    rows created or changed after it are included. The export runs as a job
+    whose result is the file; ?wait=1 streams it in the response instead.
+    """
+    since = request.args.get('since')
+    try:
+        since = parse_timestamp(since) if since else None
+    except ValueError:
+        return jsonify({'error': 'since must be an ISO timestamp'}), 400
+    
+    if wants_background():
+        job = submit_job('backup_export', params={'since': since.isoformat() if since else None},
+                         user_id=current_user.id)
+        return job_accepted(job)
+    
+    print(f"\n📦 Streaming {'differential' if since else 'full'} database backup...")
+    
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    kind = 'incremental' if since else 'full'
+    filename = f'wallet_tracker_backup_{timestamp}_{kind}.ndjson.gz'
+    
+    return Response(
+        stream_with_context(gzip_stream(ndjson_lines(iter_backup_records(since=since)))),
+        mimetype='application/gzip',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+@backup_bp.route('/archive', methods=['GET'])
+@login_required
+@admin_required
+def export_backup_archive():
+    """
+    Download a zip archive with one compressed member per table
+    
+    The manifest.json member lists each table's row count and checksum, so
+    the archive can be verified before it is restored. The archive is built
+    by a job whose result is the file; ?wait=1 builds it in the request.
+    """
+    if wants_background():
+        return job_accepted(submit_job('backup_archive', user_id=current_user.id))
+    
+    try:
+        print("\n📦 Creating backup archive...")
+        archive = tempfile.TemporaryFile()
+        manifest = write_archive(archive)
+        archive.seek(0)
+        
+        total_rows = sum(entry['rows'] for entry in manifest['tables'].values())
+        print(f"   ✅ Archived {total_rows} rows from {len(manifest['tables'])} tables")
+        
+        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+        return send_file(
+            archive,
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name=f'wallet_tracker_archive_{timestamp}.zip'
+        )
+    except Exception as e:
+        print(f"\n❌ Error creating backup archive: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+@backup_bp.route('/archive/restore', methods=['POST'])
+@login_required
+@admin_required
+def restore_backup_archive():
+    """
+    Verify a backup archive and restore it into a database without wallets
+    
+    With ?verify_only=1 the archive is only checked against its manifest;
+    otherwise the manifest is checked and the restore runs as a job
+    (?wait=1 restores in the request).
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    verify_only = request.args.get('verify_only', '').lower() in ('1', 'true', 'yes')
+    try:
+        with zipfile.ZipFile(request.files['file'].stream) as archive:
+            if wants_background() and not verify_only:
+                read_manifest(archive)
+                if Wallet.query.first() is not None:
+                    return jsonify({'error': 'Archive restore needs a database without wallets'}), 409
+                file = request.files['file']
+                file.stream.seek(0)
+                job = submit_job('archive_restore', files=[(secure_filename(file.filename) or 'archive.zip',
+                                                            'application/zip', file.stream)],
+                                 user_id=current_user.id)
+                return job_accepted(job)
+            
+            if verify_only:
+                manifest = read_manifest(archive)
+                verify_archive(archive, manifest)
+                return jsonify({
+                    'message': 'Archive verified',
+                    'rows': {name: entry['rows'] for name, entry in manifest['tables'].items()}
+                }), 200
+            
+            if Wallet.query.first() is not None:
+                return jsonify({'error': 'Archive restore needs a database without wallets'}), 409
+            
+            print("\n📥 Restoring backup archive...")
+            counts = restore_archive(archive)
+        
+        print("   ✅ Archive restored successfully")
+        return jsonify({'message': 'Archive restored successfully', 'rows': counts}), 200
+    
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'File is not a zip archive'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"\n❌ Error restoring backup archive: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+def import_backup_stream(files):
+    """
+    Import a chain of NDJSON backups in committed chunks
+    
+    Files are applied in upload order (a full backup, then differential
+    ones). After a failure the response names the file and the last
+    committed line; re-upload from that file with ?resume_from=<line>.
+    After the chain check the files are handed to a job (?wait=1 imports
+    them in the request).
+    """
+    resume_from = request.args.get('resume_from', 0, type=int)
+    print(f"   ✓ Streaming NDJSON import of {len(files)} archive(s) (resume from line {resume_from})")
+    
+    try:
+        validate_backup_chain([read_backup_header(file.stream) for file in files])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if wants_background():
+        job = submit_job(
+            'backup_import',
+            params={'resume_from': resume_from},
+            files=[(secure_filename(file.filename), file.mimetype, file.stream) for file in files],
+            user_id=current_user.id
+        )
+        return job_accepted(job)
+    
+    results = []
+    for index, file in enumerate(files):
+        importer = BackupImporter(resume_from=resume_from if index == 0 else 0)
+        try:
+            result = importer.run(iter_ndjson_records(file.stream))
+        except Exception as e:
+            print(f"\n❌ Error importing {file.filename}: {e}")
+            import traceback
+            traceback.print_exc()
+            return jsonify({
+                'error': str(e),
+                'file': file.filename,
+                'resume_from': importer.committed_line,
+                'imported': results
+            }), 400 if isinstance(e, ValueError) else 500
+        results.append(dict(result, file=file.filename))
+    
+    print("   ✅ Import completed successfully")
+    
+    return jsonify({'message': 'Backup imported successfully', 'imported': results})
+
+
 @backup_bp.route('/import', methods=['POST'])
 @login_required
 @admin_required
@@ -157,8 +338,17 @@ def import_backup():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
+        if file.filename.endswith(NDJSON_EXTENSIONS):
+            files = request.files.getlist('file')
+            if not all(f.filename.endswith(NDJSON_EXTENSIONS) for f in files):
+                return jsonify({'error': 'A backup chain must contain only NDJSON files'}), 400
+            return import_backup_stream(files)
+        
         if not file.filename.endswith('.json'):
-            return jsonify({'error': 'File must be JSON'}), 400
+            return jsonify({'error': 'File must be JSON or NDJSON'}), 400
+        
+        if wants_background(default=False):
+            return jsonify({'error': 'Background imports need NDJSON backups (see /export/stream)'}), 400
         
         # Read and parse JSON
         backup_data = json.load(file)
@@ -196,9 +386,9 @@ def import_backup():
                 balance_history = BalanceHistory(
                     wallet_id=wallet.id,
                     timestamp=datetime.fromisoformat(history_data['timestamp']),
-                    networth=history_data['networth'],
-                    data_json=history_data.get('data_json', '{}')
+                    networth=history_data['networth']
                 )
+                balance_history.raw_json = history_data.get('data_json') or '{}'
                 db.session.add(balance_history)
                 db.session.flush()  # Get history ID
                 
@@ -227,6 +417,9 @@ def import_backup():
                         protocol=token_data['protocol']
                     )
                     db.session.add(token_balance)
+            
+            db.session.flush()
+            balances_changed(wallet)
         
         # Import permissions
         if 'permissions' in backup_data:
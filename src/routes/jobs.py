@@ -0,0 +1,146 @@
+import os
+
+from flask import Blueprint, jsonify, request, send_file, url_for
+from flask_login import current_user, login_required
+
+from src.models.models import Job, JobFile
+from src.routes.admin import admin_required
+from src.services.jobs import (
+    FILE_INPUT_JOBS, JOB_HANDLERS, JOB_QUEUED, JOB_SUCCEEDED, job_file_path, job_result, job_runner_alive,
+    request_cancel, submit_job
+)
+
+jobs_bp = Blueprint('jobs', __name__)
+
+
+NO_RUNNER_WARNING = 'No background worker is polling the jobs table; the job runs once scheduler_worker.py is started'
+
+
+def wants_background(default=True):
+    """
+    True when the request should run as a background job
+
+    Heavy routes queue a job by default; ?wait=1 (or ?background=0) runs the
+    work inline. The default falls back to inline when no worker is polling
+    the jobs table, since the job would never start; an explicit
+    ?background=1 is still queued, with a warning in the response.
+
+    Args:
+        default: Whether to queue when the request does not say
+    """
+    if request.args.get('wait', '').lower() in ('1', 'true', 'yes'):
+        return False
+    background = request.args.get('background', '').lower()
+    if background:
+        return background in ('1', 'true', 'yes')
+    if default and not job_runner_alive():
+        print(f"⚠️  No background worker is polling the jobs table - running {request.path} inline")
+        return False
+    return default
+
+
+def job_accepted(job):
+    """202 response for a queued job, pointing at its status endpoint"""
+    body = {
+        'message': 'Job queued',
+        'job': job.to_dict(),
+        'status_url': url_for('jobs.get_job', job_id=job.id)
+    }
+    if not job_runner_alive():
+        print(f"⚠️  {NO_RUNNER_WARNING} (job {job.id})")
+        body['warning'] = NO_RUNNER_WARNING
+    response = jsonify(body)
+    response.headers['Location'] = url_for('jobs.get_job', job_id=job.id)
+    return response, 202
+
+
+def get_visible_job(job_id):
+    """Job by ID if the current user may see it (admins see all jobs, others their own)"""
+    job = Job.query.get(job_id)
+    if job and (current_user.is_admin or job.created_by == current_user.id):
+        return job
+    return None
+
+
+@jobs_bp.route('/', methods=['GET'])
+@login_required
+def list_jobs():
+    """List recent jobs, newest first (?status= filters, ?limit= defaults to 50); non-admins see their own"""
+    query = Job.query
+    if not current_user.is_admin:
+        query = query.filter_by(created_by=current_user.id)
+    status = request.args.get('status')
+    if status:
+        query = query.filter_by(status=status)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    jobs = query.order_by(Job.id.desc()).limit(limit).all()
+    return jsonify([job.to_dict() for job in jobs]), 200
+
+
+@jobs_bp.route('/', methods=['POST'])
+@admin_required
+def create_job():
+    """
+    Submit a job that needs no uploaded files
+
+    Body: {"type": "sync_all" | "backup_export" | "backup_archive", "params": {...}}
+    Jobs on uploaded files are submitted by uploading to their routes.
+    """
+    data = request.get_json() or {}
+    job_type = data.get('type')
+    if job_type in FILE_INPUT_JOBS:
+        return jsonify({'error': f'{job_type} jobs are submitted by uploading to their route'}), 400
+    if job_type not in JOB_HANDLERS:
+        return jsonify({'error': f"type must be one of: {', '.join(sorted(set(JOB_HANDLERS) - FILE_INPUT_JOBS))}"}), 400
+
+    job = submit_job(job_type, params=data.get('params') or {}, user_id=current_user.id)
+    return job_accepted(job)
+
+
+@jobs_bp.route('/<int:job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    """Status and progress of a job (queued jobs carry a warning while no worker is polling)"""
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    body = job.to_dict()
+    if job.status == JOB_QUEUED and not job_runner_alive():
+        body['warning'] = NO_RUNNER_WARNING
+    return jsonify(body), 200
+
+
+@jobs_bp.route('/<int:job_id>/result', methods=['GET'])
+@login_required
+def get_job_result(job_id):
+    """Download the job's result file, or return its JSON result"""
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != JOB_SUCCEEDED:
+        return jsonify({'error': f'Job is {job.status}', 'job': job.to_dict()}), 409
+
+    result_file = JobFile.query.filter_by(job_id=job.id, role='result').first()
+    if result_file:
+        path = job_file_path(result_file)
+        if not os.path.exists(path):
+            return jsonify({'error': 'Result file is no longer available'}), 410
+        return send_file(
+            path,
+            mimetype=result_file.mimetype or 'application/octet-stream',
+            as_attachment=True,
+            download_name=result_file.filename
+        )
+    return jsonify({'job': job.to_dict(), 'result': job_result(job)}), 200
+
+
+@jobs_bp.route('/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    """Cancel a queued job, or ask a running one to stop at its next progress report"""
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if not request_cancel(job):
+        return jsonify({'error': f'Job already {job.status}', 'job': job.to_dict()}), 409
+    return jsonify({'message': 'Cancellation requested', 'job': job.to_dict()}), 200
@@ -1,11 +1,21 @@
-from flask import Blueprint, request, jsonify
+import csv
+import io
+
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from flask_login import login_required, current_user
 from src.models.models import db, Wallet, WalletPermission
 from src.models.manual_balance import ManualBalance
+from src.routes.jobs import job_accepted, wants_background
+from src.services.bulk_import import import_manual_balance_rows, iter_upload_rows, parse_timestamp, upload_source
+from src.services.jobs import submit_job
+from src.services.wallet_state import balances_changed, record_manual_balance
 from datetime import datetime
 
 manual_balance_bp = Blueprint('manual_balance', __name__)
 
+EXPORT_BATCH_SIZE = 1000
+CSV_COLUMNS = ['timestamp', 'networth', 'notes']
+
 
 def has_wallet_access(wallet_id):
     """Check if current user has access to the wallet"""
@@ -55,7 +65,7 @@ def add_manual_balance(wallet_id):
     
     try:
         # Parse timestamp
-        timestamp = datetime.fromisoformat(data['timestamp'].replace('Z', '+00:00'))
+        timestamp = parse_timestamp(data['timestamp'])
         networth = float(data['networth'])
         notes = data.get('notes', '')
         
@@ -72,6 +82,8 @@ def add_manual_balance(wallet_id):
         )
         
         db.session.add(manual_balance)
+        db.session.flush()
+        record_manual_balance(wallet, manual_balance)
         db.session.commit()
         
         return jsonify({
@@ -99,11 +111,12 @@ def update_manual_balance(wallet_id, balance_id):
     ).first_or_404()
     
     data = request.get_json()
+    previous_timestamp = manual_balance.timestamp
     
     try:
         # Update fields if provided
         if 'timestamp' in data:
-            manual_balance.timestamp = datetime.fromisoformat(data['timestamp'].replace('Z', '+00:00'))
+            manual_balance.timestamp = parse_timestamp(data['timestamp'])
         
         if 'networth' in data:
             networth = float(data['networth'])
@@ -116,6 +129,8 @@ def update_manual_balance(wallet_id, balance_id):
         
         manual_balance.updated_at = datetime.utcnow()
         
+        db.session.flush()
+        balances_changed(manual_balance.wallet, since=min(previous_timestamp, manual_balance.timestamp))
         db.session.commit()
         
         return jsonify({
@@ -143,7 +158,11 @@ def delete_manual_balance(wallet_id, balance_id):
     ).first_or_404()
     
     try:
+        wallet = manual_balance.wallet
+        deleted_timestamp = manual_balance.timestamp
         db.session.delete(manual_balance)
+        db.session.flush()
+        balances_changed(wallet, since=deleted_timestamp)
         db.session.commit()
         
         return jsonify({'message': 'Manual balance deleted successfully'})
@@ -152,3 +171,75 @@ def delete_manual_balance(wallet_id, balance_id):
         db.session.rollback()
         return jsonify({'error': f'Failed to delete manual balance: {str(e)}'}), 500
 
+
+@manual_balance_bp.route('/api/wallets/<int:wallet_id>/manual-balances/import', methods=['POST'])
+@login_required
+def import_manual_balances(wallet_id):
+    """
+    Bulk import manual balances from a CSV upload or JSON array
+    
+    Columns/fields: timestamp, networth, notes (optional). Rows are parsed
+    as the upload streams in and written in batches, upserting on
+    timestamp. Invalid rows are reported in `rejected` and skipped; the
+    valid rows are committed in one transaction. The upload is queued as a
+    job; ?wait=1 imports it in the request.
+    """
+    if not has_wallet_access(wallet_id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    wallet = Wallet.query.get_or_404(wallet_id)
+    
+    if wants_background():
+        job = submit_job('manual_balance_import', params={'wallet_id': wallet.id},
+                         files=[upload_source(request, 'manual_balances')], user_id=current_user.id)
+        return job_accepted(job)
+    
+    try:
+        result = import_manual_balance_rows(wallet, iter_upload_rows(request, 'manual_balances'))
+        db.session.commit()
+        
+        return jsonify(dict(
+            result,
+            message=f"Imported {result['inserted'] + result['updated']} manual balances"
+        )), 200
+        
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': f'Invalid data format: {str(e)}'}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Failed to import manual balances: {str(e)}'}), 500
+
+
+@manual_balance_bp.route('/api/wallets/<int:wallet_id>/manual-balances/export', methods=['GET'])
+@login_required
+def export_manual_balances(wallet_id):
+    """Stream a wallet's manual balances as CSV (same columns the import accepts)"""
+    if not has_wallet_access(wallet_id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    wallet = Wallet.query.get_or_404(wallet_id)
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+        
+        query = db.session.query(ManualBalance.timestamp, ManualBalance.networth, ManualBalance.notes)\
+            .filter(ManualBalance.wallet_id == wallet_id)\
+            .order_by(ManualBalance.timestamp)\
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        for count, (timestamp, networth, notes) in enumerate(query, start=1):
+            writer.writerow([timestamp.isoformat(), repr(networth), notes or ''])
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    filename = f'manual_balances_{wallet.id}_{datetime.utcnow().strftime("%Y%m%d_%H%M%S")}.csv'
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
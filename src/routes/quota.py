@@ -3,6 +3,15 @@ from flask_login import login_required, current_user
 from datetime import datetime
 from src.models.models import db, Wallet, CashFlow, QuotaHistory, BalanceHistory
 from src.models.manual_balance import ManualBalance
+from src.routes.wallets import user_has_wallet_access
+from src.services.analytics import DEFAULT_VOLATILITY_WINDOW, get_analytics
+from src.routes.jobs import job_accepted, wants_background
+from src.services.bulk_import import (
+    RowsRejected, import_cash_flow_rows, iter_upload_rows, parse_timestamp, upload_source
+)
+from src.services.jobs import submit_job
+from src.services.quota_engine import cash_flow_totals, read_nav_series, replay_cash_flows
+from src.services.timeseries import downsample_points
 from sqlalchemy import desc
 
 quota_bp = Blueprint('quota', __name__, url_prefix='/api/quota')
@@ -12,6 +21,9 @@ quota_bp = Blueprint('quota', __name__, url_prefix='/api/quota')
 def get_cash_flows(wallet_id):
     """Get all cash flows for a wallet"""
     try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
         wallet = Wallet.query.get_or_404(wallet_id)
         
         # Get cash flows ordered by timestamp (newest first)
@@ -38,6 +50,9 @@ def get_cash_flows(wallet_id):
 def add_cash_flow(wallet_id):
     """Add a new cash flow (in or out)"""
     try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
         wallet = Wallet.query.get_or_404(wallet_id)
         data = request.get_json()
         
@@ -51,7 +66,7 @@ def add_cash_flow(wallet_id):
         amount = float(data['amount'])
         flow_type = data['type']
         description = data.get('description', '')
-        timestamp = datetime.fromisoformat(data['timestamp']) if data.get('timestamp') else datetime.utcnow()
+        timestamp = parse_timestamp(data['timestamp']) if data.get('timestamp') else datetime.utcnow()
         
         # Get net worth at the time of the cash flow
         # First try to find balance at or before the cash flow date
@@ -71,53 +86,33 @@ def add_cash_flow(wallet_id):
         if not balance_at_date:
             return jsonify({'error': f'No balance history found at or before {timestamp.strftime("%Y-%m-%d")}. Please add a balance entry for that date first.'}), 400
         
-        current_networth = balance_at_date.networth
-        
-        # Calculate current quota value
-        if wallet.current_quota_quantity > 0:
-            current_quota_value = current_networth / wallet.current_quota_quantity
-        else:
-            # First cash flow - initialize with initial quota value
-            current_quota_value = wallet.initial_quota_value
-        
-        # Calculate quotas issued/redeemed
-        if flow_type == 'in':
-            # Cash in: issue new quotas at current value
-            quotas_issued = amount / current_quota_value
-            new_quota_quantity = wallet.current_quota_quantity + quotas_issued
-        else:
-            # Cash out: redeem quotas at current value
-            quotas_issued = amount / current_quota_value
-            new_quota_quantity = wallet.current_quota_quantity - quotas_issued
-            
-            if new_quota_quantity < 0:
-                return jsonify({'error': 'Insufficient quotas to redeem'}), 400
-        
-        # Create cash flow record
+        # Create cash flow and quota history records; both are priced by the
+        # replay below, which also re-prices any later flows when backdated
         cash_flow = CashFlow(
             wallet_id=wallet_id,
             timestamp=timestamp,
             type=flow_type,
             amount=amount,
             description=description,
-            quota_value_at_time=current_quota_value,
-            quotas_issued=quotas_issued
+            quota_value_at_time=wallet.initial_quota_value,
+            quotas_issued=0.0
         )
         
-        # Update wallet quota quantity
-        wallet.current_quota_quantity = new_quota_quantity
+        db.session.add(cash_flow)
+        db.session.flush()
         
-        # Create quota history record
         quota_history = QuotaHistory(
             wallet_id=wallet_id,
             timestamp=timestamp,
-            quota_value=current_quota_value,
-            quota_quantity=new_quota_quantity,
-            networth=current_networth
+            quota_value=wallet.initial_quota_value,
+            quota_quantity=0.0,
+            networth=balance_at_date.networth,
+            cash_flow_id=cash_flow.id
         )
-        
-        db.session.add(cash_flow)
         db.session.add(quota_history)
+        db.session.flush()
+        
+        replay_cash_flows(wallet, since=timestamp)
         db.session.commit()
         
         return jsonify({
@@ -129,10 +124,51 @@ def add_cash_flow(wallet_id):
                 'quota_value_at_time': cash_flow.quota_value_at_time,
                 'quotas_issued': cash_flow.quotas_issued
             },
-            'new_quota_quantity': new_quota_quantity,
-            'current_quota_value': current_quota_value
+            'new_quota_quantity': wallet.current_quota_quantity,
+            'current_quota_value': cash_flow.quota_value_at_time
         }), 201
         
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@quota_bp.route('/wallets/<int:wallet_id>/cash-flows/import/', methods=['POST'])
+@login_required
+def import_cash_flows(wallet_id):
+    """
+    Bulk import cash flows from a CSV upload or JSON array
+    
+    Columns/fields: timestamp, type ('in' or 'out'), amount, description
+    (optional). The import is all-or-nothing: every row is validated first,
+    then all flows are inserted and priced in one pass and committed once.
+    The upload is queued as a job; ?wait=1 imports it in the request.
+    """
+    try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
+        wallet = Wallet.query.get_or_404(wallet_id)
+        
+        if wants_background():
+            job = submit_job('cash_flow_import', params={'wallet_id': wallet.id},
+                             files=[upload_source(request, 'cash_flows')], user_id=current_user.id)
+            return job_accepted(job)
+        
+        result = import_cash_flow_rows(wallet, iter_upload_rows(request, 'cash_flows'))
+        db.session.commit()
+        
+        return jsonify(dict(result, message=f"Imported {result['imported']} cash flows")), 201
+        
+    except RowsRejected as e:
+        db.session.rollback()
+        return jsonify({'error': 'Invalid rows, nothing was imported', 'rejected': e.rejected}), 400
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -143,26 +179,87 @@ def add_cash_flow(wallet_id):
 def delete_cash_flow(wallet_id, flow_id):
     """Delete a cash flow"""
     try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
         cash_flow = CashFlow.query.filter_by(id=flow_id, wallet_id=wallet_id).first_or_404()
         wallet = Wallet.query.get_or_404(wallet_id)
         
-        # Reverse the quota quantity change
-        if cash_flow.type == 'in':
-            wallet.current_quota_quantity -= cash_flow.quotas_issued
-        else:
-            wallet.current_quota_quantity += cash_flow.quotas_issued
-        
         # Delete associated quota history record
-        QuotaHistory.query.filter_by(
-            wallet_id=wallet_id,
-            timestamp=cash_flow.timestamp
-        ).delete()
+        QuotaHistory.query.filter_by(cash_flow_id=cash_flow.id).delete()
         
         db.session.delete(cash_flow)
+        db.session.flush()
+        
+        # Re-price later cash flows without this one
+        replay_cash_flows(wallet, since=cash_flow.timestamp)
         db.session.commit()
         
         return jsonify({'message': 'Cash flow deleted successfully'}), 200
         
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@quota_bp.route('/wallets/<int:wallet_id>/cash-flows/<int:flow_id>/', methods=['PUT'])
+@login_required
+def update_cash_flow(wallet_id, flow_id):
+    """Edit a cash flow and re-price it and every later flow"""
+    try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
+        cash_flow = CashFlow.query.filter_by(id=flow_id, wallet_id=wallet_id).first_or_404()
+        wallet = Wallet.query.get_or_404(wallet_id)
+        data = request.get_json()
+        previous_timestamp = cash_flow.timestamp
+        
+        if 'type' in data:
+            if data['type'] not in ['in', 'out']:
+                return jsonify({'error': 'Invalid type. Must be "in" or "out"'}), 400
+            cash_flow.type = data['type']
+        
+        if 'amount' in data:
+            if not data['amount'] or float(data['amount']) <= 0:
+                return jsonify({'error': 'Amount must be greater than 0'}), 400
+            cash_flow.amount = float(data['amount'])
+        
+        if 'description' in data:
+            cash_flow.description = data['description']
+        
+        if data.get('timestamp'):
+            cash_flow.timestamp = parse_timestamp(data['timestamp'])
+            
+            # Move the associated quota history record with the flow
+            quota_history = QuotaHistory.query.filter_by(cash_flow_id=cash_flow.id).first()
+            if quota_history:
+                quota_history.timestamp = cash_flow.timestamp
+        
+        db.session.flush()
+        replay_cash_flows(wallet, since=min(previous_timestamp, cash_flow.timestamp))
+        db.session.commit()
+        
+        return jsonify({
+            'message': 'Cash flow updated successfully',
+            'cash_flow': {
+                'id': cash_flow.id,
+                'timestamp': cash_flow.timestamp.isoformat(),
+                'type': cash_flow.type,
+                'amount': cash_flow.amount,
+                'description': cash_flow.description,
+                'quota_value_at_time': cash_flow.quota_value_at_time,
+                'quotas_issued': cash_flow.quotas_issued
+            },
+            'new_quota_quantity': wallet.current_quota_quantity
+        }), 200
+        
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -173,81 +270,18 @@ def delete_cash_flow(wallet_id, flow_id):
 def get_quota_history(wallet_id):
     """Get quota value history for performance analysis"""
     try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
         wallet = Wallet.query.get_or_404(wallet_id)
         
         days = request.args.get('days', 30, type=int)
         limit = request.args.get('limit', 100, type=int)
+        points = request.args.get('points', type=int)
         
-        # Get quota history
-        quota_history = QuotaHistory.query.filter_by(wallet_id=wallet_id)\
-            .order_by(QuotaHistory.timestamp)\
-            .limit(limit)\
-            .all()
-        
-        # Get automatic balance history
-        auto_balance_history = BalanceHistory.query.filter_by(wallet_id=wallet_id)\
-            .order_by(BalanceHistory.timestamp)\
-            .limit(limit)\
-            .all()
-        
-        # Get manual balance history
-        manual_balance_history = ManualBalance.query.filter_by(wallet_id=wallet_id)\
-            .order_by(ManualBalance.timestamp)\
-            .all()
-        
-        # Merge both histories
-        all_balances = []
-        
-        # Add automatic balances
-        for balance in auto_balance_history:
-            all_balances.append({
-                'timestamp': balance.timestamp,
-                'networth': balance.networth,
-                'source': 'automatic'
-            })
-        
-        # Add manual balances
-        for balance in manual_balance_history:
-            all_balances.append({
-                'timestamp': balance.timestamp,
-                'networth': balance.networth,
-                'source': 'manual'
-            })
-        
-        # Sort by timestamp
-        all_balances.sort(key=lambda x: x['timestamp'])
-        
-        # Get all cash flows to track quota quantity changes over time
-        cash_flows = CashFlow.query.filter_by(wallet_id=wallet_id).order_by(CashFlow.timestamp).all()
-        
-        # Calculate quota value for each balance point
-        history_data = []
-        for balance in all_balances:
-            # Calculate quota quantity at this point in time
-            # Start with initial quantity (0 or from first cash flow)
-            quota_quantity_at_time = 0
-            
-            # Add up all cash flows that happened before or at this balance timestamp
-            for cf in cash_flows:
-                if cf.timestamp <= balance['timestamp']:
-                    if cf.type == 'in':
-                        quota_quantity_at_time += cf.quotas_issued
-                    else:
-                        quota_quantity_at_time -= cf.quotas_issued
-            
-            # Calculate quota value at this point
-            if quota_quantity_at_time > 0:
-                quota_value = balance['networth'] / quota_quantity_at_time
-            else:
-                quota_value = wallet.initial_quota_value
-            
-            history_data.append({
-                'timestamp': balance['timestamp'].isoformat(),
-                'quota_value': quota_value,
-                'networth': balance['networth'],
-                'quota_quantity': quota_quantity_at_time,
-                'source': balance['source']
-            })
+        # Most recent window of the NAV series (valued on the fly until materialized)
+        series = read_nav_series(wallet, days=days, limit=limit)
+        history_data = [dict(point, timestamp=point['timestamp'].isoformat()) for point in series]
         
         # Calculate performance metrics
         if history_data:
@@ -260,21 +294,18 @@ def get_quota_history(wallet_id):
             performance_pct = 0
         
         # Calculate total invested (cash in - cash out)
-        # cash_flows already loaded above
-        total_cash_in = sum(cf.amount for cf in cash_flows if cf.type == 'in')
-        total_cash_out = sum(cf.amount for cf in cash_flows if cf.type == 'out')
+        total_cash_in, total_cash_out = cash_flow_totals(wallet_id)
         total_invested = total_cash_in - total_cash_out
         
-        # Get current net worth
-        latest_balance = BalanceHistory.query.filter_by(wallet_id=wallet_id)\
-            .order_by(desc(BalanceHistory.timestamp)).first()
+        # Get current net worth from the latest automatic snapshot
+        latest_balance = BalanceHistory.query.get(wallet.latest_balance_id) if wallet.latest_balance_id else None
         current_networth = latest_balance.networth if latest_balance else 0
         
         # Calculate absolute gain/loss
         absolute_gain = current_networth - total_invested
         
         return jsonify({
-            'history': history_data,
+            'history': downsample_points(history_data, points, value_key='quota_value'),
             'metrics': {
                 'current_quota_value': current_quota_value,
                 'initial_quota_value': initial_quota_value,
@@ -291,11 +322,41 @@ def get_quota_history(wallet_id):
         return jsonify({'error': str(e)}), 500
 
 
+@quota_bp.route('/wallets/<int:wallet_id>/analytics/', methods=['GET'])
+@login_required
+def get_wallet_analytics(wallet_id):
+    """Get performance analytics (TWR, IRR, drawdown, volatility, ratios) for a wallet"""
+    try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
+        wallet = Wallet.query.get_or_404(wallet_id)
+        
+        days = request.args.get('days', type=int)
+        window = request.args.get('window', DEFAULT_VOLATILITY_WINDOW, type=int)
+        risk_free_rate = request.args.get('risk_free_rate', 0.0, type=float)
+        
+        if window < 2:
+            return jsonify({'error': 'Window must be at least 2 days'}), 400
+        
+        analytics = get_analytics(wallet, days=days, window=window, risk_free_rate=risk_free_rate)
+        if analytics is None:
+            return jsonify({'error': 'Not enough balance history to compute analytics'}), 400
+        
+        return jsonify({'wallet_id': wallet_id, 'analytics': analytics}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @quota_bp.route('/wallets/<int:wallet_id>/initialize-quotas/', methods=['POST'])
 @login_required
 def initialize_quotas(wallet_id):
     """Initialize quota system for a wallet with first cash in"""
     try:
+        if not user_has_wallet_access(wallet_id):
+            return jsonify({'error': 'Access denied'}), 403
+        
         wallet = Wallet.query.get_or_404(wallet_id)
         data = request.get_json()
         
@@ -315,35 +376,44 @@ def initialize_quotas(wallet_id):
         wallet.current_quota_quantity = initial_quota_quantity
         
         # Create initial cash flow
+        timestamp = datetime.utcnow()
         cash_flow = CashFlow(
             wallet_id=wallet_id,
-            timestamp=datetime.utcnow(),
+            timestamp=timestamp,
             type='in',
             amount=initial_amount,
             description='Initial investment',
             quota_value_at_time=initial_quota_value,
             quotas_issued=initial_quota_quantity
         )
+        db.session.add(cash_flow)
+        db.session.flush()
         
-        # Create initial quota history
+        # Create initial quota history, linked so the replay re-prices it
         quota_history = QuotaHistory(
             wallet_id=wallet_id,
-            timestamp=datetime.utcnow(),
+            timestamp=timestamp,
             quota_value=initial_quota_value,
             quota_quantity=initial_quota_quantity,
-            networth=initial_amount
+            networth=initial_amount,
+            cash_flow_id=cash_flow.id
         )
-        
-        db.session.add(cash_flow)
         db.session.add(quota_history)
+        db.session.flush()
+        
+        # Initial quota value changed, so replay the whole history
+        replay_cash_flows(wallet)
         db.session.commit()
         
         return jsonify({
             'message': 'Quotas initialized successfully',
-            'initial_quota_value': initial_quota_value,
-            'initial_quota_quantity': initial_quota_quantity
+            'initial_quota_value': wallet.initial_quota_value,
+            'initial_quota_quantity': wallet.current_quota_quantity
         }), 201
         
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
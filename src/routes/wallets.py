@@ -1,11 +1,19 @@
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, current_user
 from datetime import datetime, timedelta
-from sqlalchemy import func
+import time
+from collections import Counter
+from sqlalchemy import case, func, select
 
-from src.models.models import db, Wallet, WalletPermission, BalanceHistory, ProtocolBalance, TokenBalance
+from src.models.models import db, Wallet, WalletPermission, BalanceHistory, NetworthRollup, ProtocolBalance
 from src.models.manual_balance import ManualBalance
 from src.services.octav_service import OctavService
+from src.services.response_cache import cached_payload
+from src.services.rollups import (
+    GRANULARITIES, bucket_start, computed_rollups, pick_stored_granularity, wallets_missing_rollups
+)
+from src.services.snapshot_store import tokens_as_of
+from src.services.timeseries import downsample_points
 
 wallets_bp = Blueprint('wallets', __name__)
 
@@ -23,6 +31,80 @@ def user_has_wallet_access(wallet_id):
     return permission is not None
 
 
+def accessible_wallet_ids():
+    """IDs of the wallets the current user can view"""
+    if current_user.is_admin:
+        return [wallet_id for (wallet_id,) in db.session.query(Wallet.id).all()]
+    return [wallet_id for (wallet_id,) in db.session.query(WalletPermission.wallet_id)
+            .filter(WalletPermission.user_id == current_user.id).all()]
+
+
+def get_latest_snapshot(wallet_id):
+    """Get the newest automatic snapshot through the wallet's latest pointer"""
+    wallet = Wallet.query.get(wallet_id)
+    if not wallet or not wallet.latest_balance_id:
+        return None
+    return BalanceHistory.query.get(wallet.latest_balance_id)
+
+
+def protocol_breakdown(wallet_id):
+    """Protocol breakdown payload of the wallet's latest snapshot"""
+    # Get latest balance history
+    latest_balance = get_latest_snapshot(wallet_id)
+    
+    if not latest_balance:
+        print(f"   ⚠ No balance history found")
+        return {'protocols': [], 'timestamp': None}
+    
+    # Get protocol balances
+    protocols = ProtocolBalance.query.filter_by(balance_history_id=latest_balance.snapshot_id).all()
+    
+    print(f"   ✓ Found {len(protocols)} protocols")
+    for p in protocols:
+        print(f"      - {p.protocol_name}: ${p.value:,.2f}")
+    
+    return {
+        'timestamp': latest_balance.timestamp.isoformat(),
+        'protocols': [{
+            'name': p.protocol_name,
+            'key': p.protocol_key,
+            'value': p.value,
+            'chain': p.chain
+        } for p in protocols]
+    }
+
+
+def token_breakdown(wallet_id):
+    """Token breakdown payload of the wallet's latest snapshot"""
+    # Get latest balance history
+    latest_balance = get_latest_snapshot(wallet_id)
+    
+    if not latest_balance:
+        print(f"   ⚠ No balance history found")
+        return {'tokens': [], 'timestamp': None}
+    
+    # Get token balances (rebuilt from keyframe + delta when delta-encoded)
+    tokens = tokens_as_of(latest_balance.id)
+    
+    print(f"   ✓ Found {len(tokens)} tokens")
+    # Show top 5 tokens
+    for t in sorted(tokens, key=lambda x: x['value'], reverse=True)[:5]:
+        print(f"      - {t['token_symbol']}: ${t['value']:,.2f}")
+    
+    return {
+        'timestamp': latest_balance.timestamp.isoformat(),
+        'tokens': [{
+            'symbol': t['token_symbol'],
+            'name': t['token_name'],
+            'balance': t['balance'],
+            'value': t['value'],
+            'price': t['price'],
+            'chain': t['chain'],
+            'protocol': t['protocol']
+        } for t in tokens]
+    }
+
+
 @wallets_bp.route('/', methods=['GET'])
 @login_required
 def get_wallets():
@@ -63,13 +145,10 @@ def get_wallet(wallet_id):
             print(f"   ❌ Wallet {wallet_id} not found")
             return jsonify({'error': 'Wallet not found'}), 404
         
-        # Get latest balance
-        latest_balance = BalanceHistory.query.filter_by(wallet_id=wallet_id)\
-            .order_by(BalanceHistory.timestamp.desc()).first()
-        
-        if latest_balance:
+        # Latest balance is kept on the wallet row
+        if wallet.latest_timestamp:
             print(f"   ✓ Wallet: {wallet.name} ({wallet.address})")
-            print(f"   ✓ Latest balance: ${latest_balance.networth:,.2f}")
+            print(f"   ✓ Latest balance: ${wallet.latest_networth:,.2f}")
         else:
             print(f"   ⚠ Wallet: {wallet.name} - No balance history")
         
@@ -81,9 +160,9 @@ def get_wallet(wallet_id):
                 'created_at': wallet.created_at.isoformat(),
                 'last_synced': wallet.last_synced.isoformat() if wallet.last_synced else None,
                 'latest_balance': {
-                    'networth': latest_balance.networth,
-                    'timestamp': latest_balance.timestamp.isoformat()
-                } if latest_balance else None
+                    'networth': wallet.latest_networth,
+                    'timestamp': wallet.latest_timestamp.isoformat()
+                } if wallet.latest_timestamp else None
             }
         }
         
@@ -111,10 +190,54 @@ def get_balance_history(wallet_id):
         # Get query parameters
         days = request.args.get('days', default=30, type=int)
         limit = request.args.get('limit', default=100, type=int)
+        points = request.args.get('points', type=int)
         
         # Calculate date threshold
         date_threshold = datetime.utcnow() - timedelta(days=days)
         
+        # Windows with more raw points than the limit are served from rollups
+        raw_count = BalanceHistory.query.filter(
+            BalanceHistory.wallet_id == wallet_id,
+            BalanceHistory.timestamp >= date_threshold
+        ).count() + ManualBalance.query.filter(
+            ManualBalance.wallet_id == wallet_id,
+            ManualBalance.timestamp >= date_threshold
+        ).count()
+        
+        if raw_count > limit:
+            if wallets_missing_rollups([wallet_id]):
+                # Older history not rolled up yet - aggregate the raw points
+                computed = computed_rollups(wallet_id, date_threshold)
+                counts = Counter(rollup.granularity for rollup in computed)
+                granularity = next((g for g in GRANULARITIES if counts[g] <= limit), GRANULARITIES[-1])
+                rollups = sorted((rollup for rollup in computed if rollup.granularity == granularity),
+                                 key=lambda rollup: rollup.bucket_start, reverse=True)[:limit]
+            else:
+                granularity = pick_stored_granularity(wallet_id, date_threshold, limit)
+                rollups = NetworthRollup.query.filter(
+                    NetworthRollup.wallet_id == wallet_id,
+                    NetworthRollup.granularity == granularity,
+                    NetworthRollup.bucket_start >= bucket_start(granularity, date_threshold)
+                ).order_by(NetworthRollup.bucket_start.desc()).limit(limit).all()
+            
+            print(f"   ✓ Found {raw_count} records (last {days} days), returning {len(rollups)} {granularity} rollups")
+            
+            rollup_history = [{
+                    'id': f'{granularity}_{rollup.bucket_start.isoformat()}',
+                    'timestamp': rollup.bucket_start.isoformat(),
+                    'networth': rollup.networth,
+                    'source': rollup.source,
+                    'min_networth': rollup.min_networth,
+                    'max_networth': rollup.max_networth,
+                    'avg_networth': rollup.sum_networth / rollup.point_count,
+                    'points': rollup.point_count
+                } for rollup in rollups]
+            
+            return jsonify({
+                'history': downsample_points(rollup_history[::-1], points)[::-1],
+                'granularity': granularity
+            }), 200
+        
         # Query automatic balance history
         auto_history = BalanceHistory.query.filter(
             BalanceHistory.wallet_id == wallet_id,
@@ -157,7 +280,8 @@ def get_balance_history(wallet_id):
         print(f"   ✓ Found {len(auto_history)} automatic + {len(manual_history)} manual records (last {days} days)")
         
         result = {
-            'history': merged_history
+            'history': downsample_points(merged_history[::-1], points)[::-1],
+            'granularity': 'raw'
         }
         
         return jsonify(result), 200
@@ -181,31 +305,7 @@ def get_protocol_breakdown(wallet_id):
             print(f"   ❌ Access denied")
             return jsonify({'error': 'Access denied'}), 403
         
-        # Get latest balance history
-        latest_balance = BalanceHistory.query.filter_by(wallet_id=wallet_id)\
-            .order_by(BalanceHistory.timestamp.desc()).first()
-        
-        if not latest_balance:
-            print(f"   ⚠ No balance history found")
-            return jsonify({'protocols': [], 'timestamp': None}), 200
-        
-        # Get protocol balances
-        protocols = ProtocolBalance.query.filter_by(balance_history_id=latest_balance.id).all()
-        
-        print(f"   ✓ Found {len(protocols)} protocols")
-        for p in protocols:
-            print(f"      - {p.protocol_name}: ${p.value:,.2f}")
-        
-        result = {
-            'timestamp': latest_balance.timestamp.isoformat(),
-            'protocols': [{
-                'name': p.protocol_name,
-                'key': p.protocol_key,
-                'value': p.value,
-                'chain': p.chain
-            } for p in protocols]
-        }
-        
+        result = cached_payload(request, [wallet_id], lambda: protocol_breakdown(wallet_id))
         return jsonify(result), 200
         
     except Exception as e:
@@ -227,35 +327,7 @@ def get_token_breakdown(wallet_id):
             print(f"   ❌ Access denied")
             return jsonify({'error': 'Access denied'}), 403
         
-        # Get latest balance history
-        latest_balance = BalanceHistory.query.filter_by(wallet_id=wallet_id)\
-            .order_by(BalanceHistory.timestamp.desc()).first()
-        
-        if not latest_balance:
-            print(f"   ⚠ No balance history found")
-            return jsonify({'tokens': [], 'timestamp': None}), 200
-        
-        # Get token balances
-        tokens = TokenBalance.query.filter_by(balance_history_id=latest_balance.id).all()
-        
-        print(f"   ✓ Found {len(tokens)} tokens")
-        # Show top 5 tokens
-        for t in sorted(tokens, key=lambda x: x.value, reverse=True)[:5]:
-            print(f"      - {t.token_symbol}: ${t.value:,.2f}")
-        
-        result = {
-            'timestamp': latest_balance.timestamp.isoformat(),
-            'tokens': [{
-                'symbol': t.token_symbol,
-                'name': t.token_name,
-                'balance': t.balance,
-                'value': t.value,
-                'price': t.price,
-                'chain': t.chain,
-                'protocol': t.protocol
-            } for t in tokens]
-        }
-        
+        result = cached_payload(request, [wallet_id], lambda: token_breakdown(wallet_id))
         return jsonify(result), 200
         
     except Exception as e:
@@ -265,6 +337,73 @@ def get_token_breakdown(wallet_id):
         return jsonify({'error': str(e), 'tokens': [], 'timestamp': None}), 500
 
 
+OTHER_PROTOCOL_KEY = 'other'
+
+
+def protocol_history_query(wallet_id, cutoff_date, limit, top=None):
+    """
+    Build the joined protocol history query for a wallet
+    
+    Selects the first `limit` automatic balance records since `cutoff_date`
+    and outer-joins the protocol rows of each (heartbeats join through the
+    snapshot they repeat). With `top`, protocols outside the `top` largest by
+    total value in the window are summed into an "other" bucket in SQL.
+    
+    Rows are ordered by record, so they can be pivoted in one streaming pass.
+    """
+    window = select(
+        BalanceHistory.id,
+        BalanceHistory.timestamp,
+        BalanceHistory.networth,
+        func.coalesce(BalanceHistory.heartbeat_of_id, BalanceHistory.id).label('snapshot_id')
+    ).where(
+        BalanceHistory.wallet_id == wallet_id,
+        BalanceHistory.timestamp >= cutoff_date
+    ).order_by(BalanceHistory.timestamp.asc()).limit(limit).subquery()
+    
+    join_on = ProtocolBalance.balance_history_id == window.c.snapshot_id
+    
+    if not top or top <= 0:
+        return select(
+            window.c.id,
+            window.c.timestamp,
+            window.c.networth,
+            ProtocolBalance.protocol_key,
+            ProtocolBalance.protocol_name,
+            ProtocolBalance.value.label('protocol_value')
+        ).select_from(window).outerjoin(ProtocolBalance, join_on)\
+            .order_by(window.c.timestamp.asc(), window.c.id.asc(), ProtocolBalance.id.asc())
+    
+    top_keys = select(ProtocolBalance.protocol_key)\
+        .join(window, join_on)\
+        .group_by(ProtocolBalance.protocol_key)\
+        .order_by(func.sum(ProtocolBalance.value).desc())\
+        .limit(top)
+    is_top = ProtocolBalance.protocol_key.in_(top_keys.scalar_subquery())
+    
+    bucket_key = case(
+        (ProtocolBalance.protocol_key.is_(None), None),
+        (is_top, ProtocolBalance.protocol_key),
+        else_=OTHER_PROTOCOL_KEY
+    ).label('protocol_key')
+    bucket_name = case(
+        (ProtocolBalance.protocol_key.is_(None), None),
+        (is_top, ProtocolBalance.protocol_name),
+        else_='Other'
+    )
+    
+    return select(
+        window.c.id,
+        window.c.timestamp,
+        window.c.networth,
+        bucket_key,
+        func.max(bucket_name).label('protocol_name'),
+        func.sum(ProtocolBalance.value).label('protocol_value')
+    ).select_from(window).outerjoin(ProtocolBalance, join_on)\
+        .group_by(window.c.id, window.c.timestamp, window.c.networth, bucket_key)\
+        .order_by(window.c.timestamp.asc(), window.c.id.asc(), func.sum(ProtocolBalance.value).desc())
+
+
 @wallets_bp.route('/<int:wallet_id>/protocol-history/', methods=['GET'])
 @wallets_bp.route('/<int:wallet_id>/protocol-history', methods=['GET'])
 @login_required
@@ -280,16 +419,14 @@ def get_protocol_history(wallet_id):
         # Get parameters
         days = request.args.get('days', 30, type=int)
         limit = request.args.get('limit', 100, type=int)
+        top = request.args.get('top', type=int)
+        points = request.args.get('points', type=int)
         
         # Calculate cutoff date
-        from datetime import datetime, timedelta
         cutoff_date = datetime.utcnow() - timedelta(days=days)
         
-        # Get automatic balance history
-        auto_balance_records = BalanceHistory.query.filter(
-            BalanceHistory.wallet_id == wallet_id,
-            BalanceHistory.timestamp >= cutoff_date
-        ).order_by(BalanceHistory.timestamp.asc()).limit(limit).all()
+        # Get automatic balance history joined with its protocol rows (one query)
+        auto_rows = db.session.execute(protocol_history_query(wallet_id, cutoff_date, limit, top))
         
         # Get manual balance history
         manual_balance_records = ManualBalance.query.filter(
@@ -297,39 +434,37 @@ def get_protocol_history(wallet_id):
             ManualBalance.timestamp >= cutoff_date
         ).order_by(ManualBalance.timestamp.asc()).all()
         
-        if not auto_balance_records and not manual_balance_records:
-            print(f"   ⚠ No balance history found")
-            return jsonify({'history': [], 'protocols': []}), 200
-        
-        print(f"   ✓ Found {len(auto_balance_records)} automatic + {len(manual_balance_records)} manual balance records")
-        
         # Build history with protocol breakdown
         history = []
         all_protocols = set()
         
-        # Process automatic balance records
-        for record in auto_balance_records:
-            # Get protocol balances for this record
-            protocol_balances = ProtocolBalance.query.filter_by(
-                balance_history_id=record.id
-            ).all()
-            
-            # Build protocols dict
-            protocols_dict = {}
-            for pb in protocol_balances:
-                protocol_key = pb.protocol_key or 'unknown'
-                all_protocols.add(protocol_key)
-                protocols_dict[protocol_key] = {
-                    'name': pb.protocol_name or protocol_key,
-                    'value': pb.value
-                }
+        # Pivot the joined rows into one entry per balance record in a single pass
+        current_id = None
+        for row in auto_rows:
+            if row.id != current_id:
+                current_id = row.id
+                protocols_dict = {}
+                history.append({
+                    'timestamp': row.timestamp.isoformat(),
+                    'networth': row.networth,
+                    'protocols': protocols_dict,
+                    'source': 'automatic'
+                })
             
-            history.append({
-                'timestamp': record.timestamp.isoformat(),
-                'networth': record.networth,
-                'protocols': protocols_dict,
-                'source': 'automatic'
-            })
+            if row.protocol_key is None:
+                continue  # Balance record without protocol rows
+            protocol_key = row.protocol_key or 'unknown'
+            all_protocols.add(protocol_key)
+            protocols_dict[protocol_key] = {
+                'name': row.protocol_name or protocol_key,
+                'value': row.protocol_value
+            }
+        
+        if not history and not manual_balance_records:
+            print(f"   ⚠ No balance history found")
+            return jsonify({'history': [], 'protocols': []}), 200
+        
+        print(f"   ✓ Found {len(history)} automatic + {len(manual_balance_records)} manual balance records")
         
         # Process manual balance records (no protocol breakdown)
         for record in manual_balance_records:
@@ -353,7 +488,7 @@ def get_protocol_history(wallet_id):
         print(f"   ✓ Found {len(all_protocols)} unique protocols")
         
         result = {
-            'history': history,
+            'history': downsample_points(history, points),
             'protocols': list(all_protocols)
         }
         
@@ -382,7 +517,9 @@ def sync_wallet(wallet_id):
     
     try:
         print(f"\n🔄 Sync request received for wallet ID: {wallet_id}")
-        success = OctavService.sync_wallet(wallet_id)
+        # Fail fast rather than being killed by the worker timeout
+        deadline = time.monotonic() + OctavService.REQUEST_SYNC_DEADLINE
+        success = OctavService.sync_wallet(wallet_id, deadline=deadline)
         if success:
             print(f"✅ Wallet {wallet_id} synced successfully")
             return jsonify({'message': 'Wallet synced successfully'}), 200
@@ -396,6 +533,38 @@ def sync_wallet(wallet_id):
         return jsonify({'error': str(e)}), 500
 
 
+def portfolio_summary():
+    """Summary payload of the current user's wallets"""
+    # Single query: the latest balance is denormalized onto each wallet row
+    query = Wallet.query.filter(Wallet.latest_timestamp.isnot(None))
+    if not current_user.is_admin:
+        query = query.join(WalletPermission, WalletPermission.wallet_id == Wallet.id)\
+            .filter(WalletPermission.user_id == current_user.id)
+    wallets = query.all()
+    print(f"   {'Admin' if current_user.is_admin else 'Regular'} user - {len(wallets)} wallets with balance history")
+    
+    total_networth = 0
+    wallet_summaries = []
+    
+    for wallet in wallets:
+        print(f"   Wallet {wallet.id} ({wallet.name}): ${wallet.latest_networth:,.2f}")
+        total_networth += wallet.latest_networth
+        wallet_summaries.append({
+            'id': wallet.id,
+            'address': wallet.address,
+            'name': wallet.name,
+            'networth': wallet.latest_networth,
+            'timestamp': wallet.latest_timestamp.isoformat()
+        })
+    
+    print(f"\n✅ Summary: {len(wallet_summaries)} wallets, Total: ${total_networth:,.2f}\n")
+    
+    return {
+        'total_networth': total_networth,
+        'wallets': wallet_summaries
+    }
+
+
 @wallets_bp.route('/summary/', methods=['GET'])
 @wallets_bp.route('/summary', methods=['GET'])
 @login_required
@@ -404,43 +573,7 @@ def get_portfolio_summary():
     try:
         print("\n📊 Getting portfolio summary...")
         
-        if current_user.is_admin:
-            wallets = Wallet.query.all()
-            print(f"   Admin user - loading all {len(wallets)} wallets")
-        else:
-            permissions = WalletPermission.query.filter_by(user_id=current_user.id).all()
-            wallet_ids = [p.wallet_id for p in permissions]
-            wallets = Wallet.query.filter(Wallet.id.in_(wallet_ids)).all() if wallet_ids else []
-            print(f"   Regular user - loading {len(wallets)} permitted wallets")
-        
-        total_networth = 0
-        wallet_summaries = []
-        
-        for wallet in wallets:
-            # Get the MOST RECENT balance history for this wallet
-            latest_balance = BalanceHistory.query.filter_by(wallet_id=wallet.id)\
-                .order_by(BalanceHistory.timestamp.desc()).first()
-            
-            if latest_balance:
-                print(f"   Wallet {wallet.id} ({wallet.name}): ${latest_balance.networth:,.2f}")
-                total_networth += latest_balance.networth
-                wallet_summaries.append({
-                    'id': wallet.id,
-                    'address': wallet.address,
-                    'name': wallet.name,
-                    'networth': latest_balance.networth,
-                    'timestamp': latest_balance.timestamp.isoformat()
-                })
-            else:
-                print(f"   Wallet {wallet.id} ({wallet.name}): No balance history")
-        
-        result = {
-            'total_networth': total_networth,
-            'wallets': wallet_summaries
-        }
-        
-        print(f"\n✅ Summary: {len(wallet_summaries)} wallets, Total: ${total_networth:,.2f}\n")
-        
+        result = cached_payload(request, accessible_wallet_ids(), portfolio_summary)
         return jsonify(result), 200
         
     except Exception as e:
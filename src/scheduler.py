@@ -1,7 +1,11 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from datetime import datetime
-from src.models.models import AppSettings
+from src.models.models import db, AppSettings
+from src.services.jobs import (
+    JOB_POLL_SECONDS, JOB_RUNNER_HEARTBEAT_SECONDS, purge_finished_jobs, record_runner_heartbeat,
+    recover_interrupted_jobs, run_pending_jobs
+)
 from src.services.octav_service import OctavService
 
 scheduler = BackgroundScheduler()
@@ -13,7 +17,8 @@ def sync_wallets_job():
     
     try:
         results = OctavService.sync_all_wallets()
-        print(f"Sync completed: {results['success']} successful, {results['failed']} failed")
+        print(f"Sync completed: {results['success']} successful, {results['failed']} failed "
+              f"({results['requests']} API requests)")
         if results['errors']:
             for error in results['errors']:
                 print(f"  - {error}")
@@ -77,9 +82,74 @@ def init_scheduler(app):
         )
         print(f"Wallet sync job scheduled: every {interval_hours} hours")
     
+    init_job_runner(app)
+    
     return scheduler
 
 
+def init_job_runner(app):
+    """Poll the jobs table for queued background jobs (see src/services/jobs.py)"""
+    
+    def run_jobs():
+        with app.app_context():
+            try:
+                run_pending_jobs()
+            except Exception as e:
+                print(f"Error in job runner: {e}")
+            finally:
+                db.session.remove()
+    
+    def heartbeat():
+        # Separate from run_jobs so a long job does not look like a dead worker
+        with app.app_context():
+            try:
+                record_runner_heartbeat()
+            except Exception as e:
+                print(f"Error recording job runner heartbeat: {e}")
+            finally:
+                db.session.remove()
+    
+    def purge_jobs():
+        with app.app_context():
+            try:
+                purged = purge_finished_jobs()
+                if purged:
+                    print(f"Purged {purged} finished jobs")
+            except Exception as e:
+                print(f"Error purging jobs: {e}")
+    
+    with app.app_context():
+        recover_interrupted_jobs()
+        record_runner_heartbeat()
+    
+    scheduler.add_job(
+        func=run_jobs,
+        trigger=IntervalTrigger(seconds=JOB_POLL_SECONDS),
+        id='job_runner',
+        name='Run background jobs',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=heartbeat,
+        trigger=IntervalTrigger(seconds=JOB_RUNNER_HEARTBEAT_SECONDS),
+        id='job_runner_heartbeat',
+        name='Record job runner heartbeat',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=purge_jobs,
+        trigger=IntervalTrigger(hours=24),
+        id='job_cleanup',
+        name='Purge finished background jobs',
+        replace_existing=True
+    )
+    print(f"Background job runner scheduled: polling every {JOB_POLL_SECONDS} seconds")
+
+
 def trigger_immediate_sync(app):
     """Trigger an immediate sync of all wallets"""
     with app.app_context():
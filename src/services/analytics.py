@@ -0,0 +1,286 @@
+"""
+Performance analytics over the materialized quota (NAV) series.
+
+Loads a wallet's quota values into NumPy arrays once and computes
+time-weighted return, money-weighted return (IRR), drawdown, rolling
+volatility and risk-adjusted ratios with vectorized operations. Results are
+cached per process and reused until the wallet's data version changes
+(see src/services/response_cache.py).
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from src.models.models import db, CashFlow, NavHistory, Wallet
+from src.services.quota_engine import nav_materialized, quota_series
+from src.services.response_cache import MISSING, VersionedCache, data_versions
+
+# Crypto markets trade every day, so returns are annualized over calendar days
+PERIODS_PER_YEAR = 365
+SECONDS_PER_YEAR = 365.25 * 24 * 3600
+DEFAULT_VOLATILITY_WINDOW = 30
+
+IRR_MAX_ITERATIONS = 100
+IRR_TOLERANCE = 1e-10
+
+ANALYTICS_CACHE_MAX_ENTRIES = 256
+ANALYTICS_CACHE_TTL_SECONDS = 3600
+_cache = VersionedCache(ANALYTICS_CACHE_MAX_ENTRIES, ANALYTICS_CACHE_TTL_SECONDS)
+
+
+def load_nav_arrays(wallet_id, since=None):
+    """
+    Load the quota series as NumPy arrays in timestamp order
+
+    Wallets whose NAV points are not materialized yet (see the nav_backfill
+    job) are valued on the fly.
+
+    Returns:
+        tuple: (timestamps as datetime64[us], quota values, networths)
+    """
+    query = db.session.query(NavHistory.timestamp, NavHistory.quota_value, NavHistory.networth)\
+        .filter(NavHistory.wallet_id == wallet_id)
+    if since is not None:
+        query = query.filter(NavHistory.timestamp >= since)
+    rows = query.order_by(NavHistory.timestamp, NavHistory.id).all()
+    if not rows and not nav_materialized(wallet_id):
+        series = quota_series(db.session.get(Wallet, wallet_id), since=since)
+        rows = [(point['timestamp'], point['quota_value'], point['networth']) for point in series]
+
+    timestamps = np.array([row[0] for row in rows], dtype='datetime64[us]')
+    quota_values = np.array([row[1] for row in rows], dtype=float)
+    networths = np.array([row[2] for row in rows], dtype=float)
+    return timestamps, quota_values, networths
+
+
+def daily_closes(timestamps, values):
+    """
+    Last value of each UTC day, forward-filled over days without data
+
+    Returns:
+        tuple: (days as datetime64[D], closing values)
+    """
+    days = timestamps.astype('datetime64[D]')
+    last_of_day = np.flatnonzero(np.append(days[1:] != days[:-1], True))
+    close_days = days[last_of_day]
+    all_days = np.arange(close_days[0], close_days[-1] + 1, dtype='datetime64[D]')
+    fill_index = np.searchsorted(close_days, all_days, side='right') - 1
+    return all_days, values[last_of_day][fill_index]
+
+
+def max_drawdown(timestamps, values):
+    """
+    Largest peak-to-trough decline of a value series
+
+    Points with no positive peak before them (e.g. a series that starts at
+    zero NAV) count as no drawdown.
+
+    Returns:
+        dict: max_drawdown_pct plus peak, trough and recovery dates (recovery
+        is None while the series is still below the peak)
+    """
+    running_max = np.maximum.accumulate(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drawdowns = np.where(running_max > 0, values / running_max - 1.0, 0.0)
+    trough = int(np.argmin(drawdowns))
+    if drawdowns[trough] >= 0:
+        return {'max_drawdown_pct': 0.0, 'peak_date': None, 'trough_date': None, 'recovery_date': None}
+
+    peak = int(np.argmax(values[:trough + 1]))
+    recovered = np.flatnonzero(values[trough:] >= values[peak])
+    recovery = trough + int(recovered[0]) if recovered.size else None
+    return {
+        'max_drawdown_pct': float(drawdowns[trough]) * 100,
+        'peak_date': _isoformat(timestamps[peak]),
+        'trough_date': _isoformat(timestamps[trough]),
+        'recovery_date': _isoformat(timestamps[recovery]) if recovery is not None else None
+    }
+
+
+def rolling_volatility(returns, window):
+    """Annualized rolling standard deviation of returns using cumulative sums"""
+    if returns.size < window or window < 2:
+        return np.array([])
+    sums = np.concatenate(([0.0], np.cumsum(returns)))
+    squares = np.concatenate(([0.0], np.cumsum(returns * returns)))
+    window_sums = sums[window:] - sums[:-window]
+    window_squares = squares[window:] - squares[:-window]
+    variance = (window_squares - window_sums * window_sums / window) / (window - 1)
+    return np.sqrt(np.clip(variance, 0.0, None) * PERIODS_PER_YEAR)
+
+
+def xirr(amounts, years):
+    """
+    Annualized internal rate of return of dated cash flows
+
+    Newton's method on the vectorized NPV, falling back to bisection when it
+    does not converge.
+
+    Args:
+        amounts: Cash flow amounts (negative = invested, positive = returned)
+        years: Time of each amount in years from the first one
+
+    Returns:
+        float or None: The rate, or None when no rate zeroes the NPV
+    """
+    if amounts.size < 2 or not (np.any(amounts > 0) and np.any(amounts < 0)):
+        return None
+
+    def npv(rate):
+        return float(np.sum(amounts * (1.0 + rate) ** -years))
+
+    rate = 0.1
+    for _ in range(IRR_MAX_ITERATIONS):
+        discount = (1.0 + rate) ** -years
+        value = np.sum(amounts * discount)
+        derivative = np.sum(-years * amounts * discount / (1.0 + rate))
+        if derivative == 0 or not np.isfinite(derivative):
+            break
+        next_rate = rate - value / derivative
+        if not np.isfinite(next_rate) or next_rate <= -1.0:
+            break
+        if abs(next_rate - rate) < IRR_TOLERANCE:
+            return float(next_rate)
+        rate = next_rate
+
+    low, high = -0.9999, 1000.0
+    npv_low, npv_high = npv(low), npv(high)
+    if not (np.isfinite(npv_low) and np.isfinite(npv_high)) or npv_low * npv_high > 0:
+        return None
+    for _ in range(IRR_MAX_ITERATIONS * 2):
+        middle = (low + high) / 2
+        npv_middle = npv(middle)
+        if abs(npv_middle) < IRR_TOLERANCE or high - low < IRR_TOLERANCE:
+            break
+        if npv_low * npv_middle < 0:
+            high = middle
+        else:
+            low, npv_low = middle, npv_middle
+    return float((low + high) / 2)
+
+
+def money_weighted_return(wallet_id, timestamps, networths):
+    """
+    IRR of the wallet over the series window
+
+    The networth at the first point counts as the opening investment, cash
+    flows inside the window as deposits/withdrawals and the networth at the
+    last point as the closing value.
+    """
+    start, end = timestamps[0].astype(datetime), timestamps[-1].astype(datetime)
+    flows = db.session.query(CashFlow.timestamp, CashFlow.type, CashFlow.amount)\
+        .filter(CashFlow.wallet_id == wallet_id, CashFlow.timestamp > start, CashFlow.timestamp <= end)\
+        .order_by(CashFlow.timestamp).all()
+
+    flow_times = np.array([flow.timestamp for flow in flows], dtype='datetime64[us]')
+    flow_amounts = np.array([-flow.amount if flow.type == 'in' else flow.amount for flow in flows], dtype=float)
+
+    times = np.concatenate((timestamps[:1], flow_times, timestamps[-1:]))
+    amounts = np.concatenate(([-networths[0]], flow_amounts, [networths[-1]]))
+    years = (times - times[0]).astype('timedelta64[us]').astype(float) / 1e6 / SECONDS_PER_YEAR
+    return xirr(amounts, years)
+
+
+def compute_analytics(wallet_id, days=None, window=DEFAULT_VOLATILITY_WINDOW, risk_free_rate=0.0):
+    """
+    Compute performance analytics for a wallet's quota series
+
+    Args:
+        wallet_id: Wallet database ID
+        days: Only analyze the last `days` days (None for the full history)
+        window: Rolling volatility window in days
+        risk_free_rate: Annual risk-free rate as a decimal, for Sharpe/Sortino
+
+    Returns:
+        dict: Analytics payload, or None when the wallet has fewer than two points
+    """
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    timestamps, quota_values, networths = load_nav_arrays(wallet_id, since=since)
+    if quota_values.size < 2:
+        return None
+
+    span_years = (timestamps[-1] - timestamps[0]).astype('timedelta64[us]').astype(float) / 1e6 / SECONDS_PER_YEAR
+    # A series starting at zero NAV has no defined return over the window
+    twr = quota_values[-1] / quota_values[0] - 1.0 if quota_values[0] > 0 else None
+    annualized_twr = None
+    if twr is not None and span_years > 0 and twr > -1:
+        with np.errstate(over='ignore'):
+            annualized_twr = (1.0 + twr) ** (1.0 / span_years) - 1.0
+        if not np.isfinite(annualized_twr):
+            annualized_twr = None
+
+    close_days, closes = daily_closes(timestamps, quota_values)
+    # Days after a zero close count as a zero return
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.where(closes[:-1] > 0, closes[1:] / closes[:-1] - 1.0, 0.0)
+
+    volatility = sharpe = sortino = None
+    if returns.size >= 2:
+        daily_risk_free = risk_free_rate / PERIODS_PER_YEAR
+        excess = returns - daily_risk_free
+        deviation = returns.std(ddof=1)
+        volatility = float(deviation * np.sqrt(PERIODS_PER_YEAR))
+        if deviation > 0:
+            sharpe = float(excess.mean() / deviation * np.sqrt(PERIODS_PER_YEAR))
+        downside = np.sqrt(np.mean(np.minimum(excess, 0.0) ** 2))
+        if downside > 0:
+            sortino = float(excess.mean() / downside * np.sqrt(PERIODS_PER_YEAR))
+
+    drawdown = max_drawdown(timestamps, quota_values)
+    calmar = None
+    if annualized_twr is not None and drawdown['max_drawdown_pct'] < 0:
+        calmar = annualized_twr / abs(drawdown['max_drawdown_pct'] / 100)
+
+    irr = money_weighted_return(wallet_id, timestamps, networths)
+    rolling = rolling_volatility(returns, window)
+
+    return {
+        'period': {
+            'start': _isoformat(timestamps[0]),
+            'end': _isoformat(timestamps[-1]),
+            'points': int(quota_values.size),
+            'days': int(close_days.size)
+        },
+        'time_weighted_return_pct': _pct(twr),
+        'annualized_twr_pct': _pct(annualized_twr),
+        'money_weighted_return_pct': _pct(irr),
+        'volatility_pct': _pct(volatility),
+        'sharpe_ratio': sharpe,
+        'sortino_ratio': sortino,
+        'calmar_ratio': calmar,
+        'drawdown': drawdown,
+        'rolling_volatility': {
+            'window_days': window,
+            'series': [{
+                'date': str(day),
+                'volatility_pct': float(value) * 100
+            } for day, value in zip(close_days[window:], rolling)]
+        }
+    }
+
+
+def get_analytics(wallet, days=None, window=DEFAULT_VOLATILITY_WINDOW, risk_free_rate=0.0):
+    """
+    Cached compute_analytics for a wallet
+
+    Entries are keyed on the request parameters (and the current day when a
+    rolling window is requested) and reused while the wallet's data version
+    is unchanged. The cache is per process, bounded in size (LRU) and expires
+    entries after a TTL.
+    """
+    key = (wallet.id, days, window, risk_free_rate, datetime.utcnow().date() if days else None)
+    version = data_versions([wallet.id])
+
+    result = _cache.get(key, version)
+    if result is MISSING:
+        result = compute_analytics(wallet.id, days=days, window=window, risk_free_rate=risk_free_rate)
+        _cache.set(key, version, result)
+    return result
+
+
+def _isoformat(timestamp):
+    return timestamp.astype(datetime).isoformat()
+
+
+def _pct(value):
+    return float(value) * 100 if value is not None else None
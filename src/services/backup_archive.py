@@ -0,0 +1,356 @@
+"""
+Compact backup archives.
+
+An archive is a zip file with one gzipped NDJSON member per table (each
+line a JSON array of column values, in the column order listed in the
+manifest) and a manifest.json with the row count and SHA-256 of every
+member's uncompressed content. Rows are stored as they are in the database:
+heartbeats, delta-encoded token rows and compressed payloads stay compact.
+Derived tables (NAV, rollups, data versions) are rebuilt on restore.
+
+On PostgreSQL tables are dumped in parallel worker threads, each in a
+read-only REPEATABLE READ transaction importing one exported snapshot, so
+every member reflects the same instant. SQLite connections cannot share a
+snapshot, so there all tables are read in order inside a single read
+transaction.
+
+Restores verify every member against the manifest before writing anything
+and load the archive into a database without wallets, keeping row IDs.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import DateTime, LargeBinary, bindparam, func, select, text, update
+
+from src.models.models import (
+    db, AppSettings, BalanceHistory, BalancePayload, CashFlow, ProtocolBalance, QuotaHistory, TokenBalance,
+    User, Wallet, WalletPermission
+)
+from src.models.manual_balance import ManualBalance
+from src.services.backup_stream import SENSITIVE_SETTINGS
+from src.services.quota_engine import link_quota_history
+from src.services.wallet_state import balances_changed
+
+ARCHIVE_FORMAT = 'wallet-tracker-archive'
+ARCHIVE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+DEFAULT_DUMP_WORKERS = 4
+DUMP_BATCH_SIZE = 1000
+RESTORE_BATCH_SIZE = 1000
+
+SNAPSHOT_ID = re.compile(r'^[0-9A-Fa-f-]+$')
+
+# (table, model, exported columns or None for all), in restore order. Users
+# are exported without password hashes and only map permissions on restore.
+ARCHIVE_TABLES = (
+    ('wallets', Wallet, ('id', 'address', 'name', 'created_at', 'last_synced',
+                         'initial_quota_value', 'current_quota_quantity')),
+    ('balance_history', BalanceHistory, None),
+    ('balance_payloads', BalancePayload, None),
+    ('protocol_balances', ProtocolBalance, None),
+    ('token_balances', TokenBalance, None),
+    ('manual_balances', ManualBalance, None),
+    ('cash_flows', CashFlow, None),
+    ('quota_history', QuotaHistory, None),
+    ('users', User, ('id', 'username', 'is_admin')),
+    ('wallet_permissions', WalletPermission, None),
+    ('app_settings', AppSettings, None),
+)
+
+# Tables restored with their original primary keys
+ID_PRESERVING_TABLES = ('wallets', 'balance_history', 'protocol_balances', 'token_balances',
+                        'manual_balances', 'cash_flows', 'quota_history')
+
+
+def _member_name(table_name):
+    return f'{table_name}.ndjson.gz'
+
+
+def _columns(model, names):
+    table = model.__table__
+    return [table.c[name] for name in names] if names else list(table.c)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    return value
+
+
+def _dump_table(conn, table_name, model, names, directory):
+    """Write one table as a gzipped NDJSON member; returns its manifest entry"""
+    columns = _columns(model, names)
+    query = select(*columns).order_by(*model.__table__.primary_key.columns)
+    if table_name == 'app_settings':
+        query = query.where(AppSettings.key.notin_(SENSITIVE_SETTINGS))
+
+    digest = hashlib.sha256()
+    rows = 0
+    member = _member_name(table_name)
+    with gzip.open(os.path.join(directory, member), 'wb', compresslevel=6) as out:
+        result = conn.execution_options(yield_per=DUMP_BATCH_SIZE).execute(query)
+        for partition in result.partitions():
+            chunk = ''.join(
+                json.dumps([_encode(value) for value in row], separators=(',', ':')) + '\n' for row in partition
+            ).encode('utf-8')
+            digest.update(chunk)
+            out.write(chunk)
+            rows += len(partition)
+
+    print(f"   ✓ {table_name}: {rows} rows")
+    return table_name, {
+        'member': member,
+        'columns': [column.name for column in columns],
+        'rows': rows,
+        'sha256': digest.hexdigest()
+    }
+
+
+@contextmanager
+def _exported_snapshot(engine):
+    """Hold a read-only PostgreSQL transaction open and yield its exported snapshot ID"""
+    with engine.connect().execution_options(isolation_level='REPEATABLE READ', postgresql_readonly=True) as conn:
+        with conn.begin():
+            yield conn.execute(text('SELECT pg_export_snapshot()')).scalar()
+
+
+def _dump_in_snapshot(engine, snapshot_id, table_name, model, names, directory):
+    if not SNAPSHOT_ID.match(snapshot_id):
+        raise ValueError(f'Unexpected snapshot ID: {snapshot_id}')
+    with engine.connect().execution_options(isolation_level='REPEATABLE READ', postgresql_readonly=True) as conn:
+        with conn.begin():
+            conn.exec_driver_sql(f"SET TRANSACTION SNAPSHOT '{snapshot_id}'")
+            return _dump_table(conn, table_name, model, names, directory)
+
+
+def write_archive(fileobj, workers=DEFAULT_DUMP_WORKERS, progress=None):
+    """
+    Dump the database into a zip archive
+
+    Args:
+        fileobj: Writable binary file object for the zip
+        workers: Parallel dump threads (PostgreSQL only)
+        progress: Optional callable receiving (tables dumped, total tables)
+
+    Returns:
+        dict: The manifest written to the archive
+    """
+    engine = db.engine
+    tables = {}
+
+    def dumped(table_name, entry):
+        tables[table_name] = entry
+        if progress:
+            progress(len(tables), len(ARCHIVE_TABLES))
+
+    with tempfile.TemporaryDirectory() as directory:
+        if engine.dialect.name == 'postgresql':
+            with _exported_snapshot(engine) as snapshot_id:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = [pool.submit(_dump_in_snapshot, engine, snapshot_id, table_name, model, names, directory)
+                               for table_name, model, names in ARCHIVE_TABLES]
+                    for future in as_completed(futures):
+                        dumped(*future.result())
+        else:
+            with engine.connect() as conn:
+                conn.exec_driver_sql('BEGIN')
+                try:
+                    for table_name, model, names in ARCHIVE_TABLES:
+                        dumped(*_dump_table(conn, table_name, model, names, directory))
+                finally:
+                    conn.rollback()
+
+        manifest = {
+            'format': ARCHIVE_FORMAT,
+            'version': ARCHIVE_VERSION,
+            'created_at': datetime.utcnow().isoformat(),
+            'dialect': engine.dialect.name,
+            'tables': tables
+        }
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+            for table_name, _, _ in ARCHIVE_TABLES:
+                member = tables[table_name]['member']
+                archive.write(os.path.join(directory, member), member)
+    return manifest
+
+
+def read_manifest(archive):
+    """
+    Load and check the manifest of an open archive
+
+    Raises:
+        ValueError: If the file is not a supported archive
+    """
+    try:
+        manifest = json.loads(archive.read(MANIFEST_NAME))
+    except KeyError:
+        raise ValueError('Not a backup archive: manifest.json is missing')
+    if manifest.get('format') != ARCHIVE_FORMAT or manifest.get('version') != ARCHIVE_VERSION:
+        raise ValueError(f"Unsupported archive format: {manifest.get('format')} v{manifest.get('version')}")
+    missing = [table_name for table_name, _, _ in ARCHIVE_TABLES if table_name not in manifest.get('tables', {})]
+    if missing:
+        raise ValueError(f"Archive is missing tables: {', '.join(missing)}")
+    return manifest
+
+
+def verify_archive(archive, manifest):
+    """
+    Check every member's row count and checksum against the manifest
+
+    Raises:
+        ValueError: Listing the members that do not match
+    """
+    problems = []
+    for table_name, entry in manifest['tables'].items():
+        digest = hashlib.sha256()
+        rows = 0
+        try:
+            with gzip.open(archive.open(entry['member'])) as member:
+                for line in member:
+                    digest.update(line)
+                    rows += 1
+        except (KeyError, OSError, EOFError) as e:
+            problems.append(f'{table_name}: unreadable ({e})')
+            continue
+        if rows != entry['rows']:
+            problems.append(f"{table_name}: {rows} rows, manifest says {entry['rows']}")
+        elif digest.hexdigest() != entry['sha256']:
+            problems.append(f'{table_name}: checksum mismatch')
+    if problems:
+        raise ValueError('Archive verification failed: ' + '; '.join(problems))
+
+
+def _iter_member_batches(archive, entry, model):
+    """Yield lists of column dicts decoded from a member, RESTORE_BATCH_SIZE rows at a time"""
+    table = model.__table__
+    names = [name for name in entry['columns'] if name in table.c]
+    positions = [entry['columns'].index(name) for name in names]
+    decoders = {}
+    for name in names:
+        if isinstance(table.c[name].type, DateTime):
+            decoders[name] = datetime.fromisoformat
+        elif isinstance(table.c[name].type, LargeBinary):
+            decoders[name] = base64.b64decode
+
+    batch = []
+    with gzip.open(archive.open(entry['member'])) as member:
+        for line in member:
+            values = json.loads(line)
+            row = {}
+            for name, position in zip(names, positions):
+                value = values[position]
+                decoder = decoders.get(name)
+                row[name] = decoder(value) if decoder and value is not None else value
+            batch.append(row)
+            if len(batch) >= RESTORE_BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _reset_sequences():
+    """Move PostgreSQL ID sequences past the restored IDs"""
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    for table_name in ID_PRESERVING_TABLES:
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table_name}), 0) + 1, false)"
+        ))
+
+
+def restore_archive(archive, progress=None):
+    """
+    Verify an archive and load it into a database without wallets
+
+    Runs in the session's transaction and commits at the end, so a failed
+    restore leaves the database unchanged. Permissions are mapped onto
+    existing users by username; settings in the archive overwrite existing
+    values. NAV, rollups and latest balances are rebuilt for every wallet.
+
+    Args:
+        archive: Open zipfile.ZipFile
+        progress: Optional callable receiving (table_name, rows restored so far)
+
+    Returns:
+        dict: Restored row counts per table (for users, the number mapped)
+
+    Raises:
+        ValueError: If the archive is invalid or the database already has wallets
+    """
+    manifest = read_manifest(archive)
+    verify_archive(archive, manifest)
+    if db.session.query(Wallet.id).first() is not None:
+        raise ValueError('Archive restore needs a database without wallets')
+
+    counts = {}
+    user_ids = {}
+    try:
+        for table_name, model, _ in ARCHIVE_TABLES:
+            entry = manifest['tables'][table_name]
+            restored = 0
+            for batch in _iter_member_batches(archive, entry, model):
+                if table_name == 'users':
+                    existing = dict(db.session.query(User.username, User.id)
+                                    .filter(User.username.in_([row['username'] for row in batch])).all())
+                    mapped = {row['id']: existing[row['username']] for row in batch if row['username'] in existing}
+                    user_ids.update(mapped)
+                    restored += len(mapped)
+                    continue
+                if table_name == 'wallet_permissions':
+                    batch = [dict(row, user_id=user_ids[row['user_id']]) for row in batch if row['user_id'] in user_ids]
+                    for row in batch:
+                        row.pop('id', None)
+                elif table_name == 'app_settings':
+                    batch = _upsert_settings(batch)
+                if batch:
+                    db.session.execute(model.__table__.insert(), batch)
+                restored += len(batch)
+                if progress:
+                    progress(table_name, restored)
+            counts[table_name] = restored
+            print(f"   ✓ Restored {table_name}: {restored} rows")
+
+        _reset_sequences()
+        # Archives written before quota history carried cash_flow_id
+        link_quota_history(db.session)
+        db.session.flush()
+        for wallet in Wallet.query.order_by(Wallet.id).all():
+            balances_changed(wallet)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return counts
+
+
+def _upsert_settings(rows):
+    """Update settings that already exist; returns the rows still to insert"""
+    existing = {key for (key,) in db.session.query(AppSettings.key)
+                .filter(AppSettings.key.in_([row['key'] for row in rows])).all()}
+    updates = [{'b_key': row['key'], 'b_value': row['value']} for row in rows if row['key'] in existing]
+    if updates:
+        table = AppSettings.__table__
+        db.session.execute(
+            update(table).where(table.c.key == bindparam('b_key')).values(
+                value=bindparam('b_value'),
+                updated_at=func.now()
+            ),
+            updates
+        )
+    return [{name: value for name, value in row.items() if name != 'id'}
+            for row in rows if row['key'] not in existing]
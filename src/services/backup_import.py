@@ -0,0 +1,442 @@
+"""
+Streaming backup import.
+
+Reads an NDJSON backup (see src/services/backup_stream.py, optionally
+gzipped) one line at a time and writes it in chunks: each chunk's wallets,
+balance histories, protocol/token/payload rows, permissions and settings
+are inserted with a few bulk statements, IDs are assigned in bulk with
+INSERT ... RETURNING, and existing rows are found with set-based lookups.
+
+The import merges into the database: wallets are matched by address,
+balance history by (wallet, timestamp), permissions by (user, wallet) and
+settings by key, and only missing rows are inserted. Manual balances are
+upserted by (wallet, timestamp) and each exported cash flow ledger replaces
+the wallet's cash flows and quota history. Every chunk is committed on its
+own, so an interrupted import can be re-run with resume_from set to the
+last committed line; re-applying a chunk is harmless.
+
+A chain of archives (a full export followed by differential ones) is
+applied in order with validate_backup_chain checking that each differential
+archive starts at or before the previous archive's watermark.
+"""
+import gzip
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, bindparam, insert, or_, update
+
+from src.models.models import (
+    db, AppSettings, BalanceHistory, BalancePayload, CashFlow, ProtocolBalance, QuotaHistory, TokenBalance,
+    User, Wallet, WalletPermission
+)
+from src.services.backup_stream import BACKUP_KIND_INCREMENTAL, BACKUP_STREAM_VERSION
+from src.services.bulk_import import parse_timestamp, upsert_manual_balance_batch
+from src.services.quota_engine import link_quota_history, rebuild_nav
+from src.services.response_cache import bump_data_version
+from src.services.wallet_state import balances_changed
+
+# Records written per committed chunk
+IMPORT_CHUNK_SIZE = 1000
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+PROTOCOL_COLUMNS = ('protocol_key', 'protocol_name', 'value', 'chain')
+TOKEN_COLUMNS = ('token_symbol', 'token_name', 'balance', 'value', 'price', 'chain', 'protocol')
+
+
+def iter_ndjson_records(stream):
+    """
+    Yield (line_number, record) pairs from an NDJSON backup file
+
+    Gzipped files are detected by their magic bytes and decompressed as they
+    are read. Blank lines are skipped but still counted. The stream must be
+    seekable (uploaded files are).
+
+    Raises:
+        ValueError: On a line that is not a JSON object with a "type"
+    """
+    head = stream.read(2)
+    stream.seek(0)
+    if head == GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+
+    text = io.TextIOWrapper(stream, encoding='utf-8')
+    try:
+        for line_number, line in enumerate(text, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError(f'Line {line_number}: invalid JSON')
+            if not isinstance(record, dict) or 'type' not in record:
+                raise ValueError(f'Line {line_number}: expected an object with a "type"')
+            yield line_number, record
+    finally:
+        # Leave the upload open for the caller (e.g. after reading the header)
+        text.detach()
+
+
+def read_backup_header(stream):
+    """
+    Read the header record of an NDJSON backup file and rewind the stream
+
+    Raises:
+        ValueError: If the file does not start with a supported header
+    """
+    records = iter_ndjson_records(stream)
+    try:
+        first = next(records, None)
+    finally:
+        records.close()
+    stream.seek(0)
+    if first is None or first[1].get('type') != 'header':
+        raise ValueError('Backup stream must start with a header record')
+    header = first[1]
+    version = str(header.get('version', ''))
+    if version.split('.')[0] != BACKUP_STREAM_VERSION.split('.')[0]:
+        raise ValueError(f'Unsupported backup version: {version}')
+    return header
+
+
+def validate_backup_chain(headers):
+    """
+    Check that a list of archive headers can be applied in the given order
+
+    Each differential archive must start at or before the watermark of the
+    archive applied before it; otherwise changes in between would be lost.
+
+    Raises:
+        ValueError: Describing the first gap in the chain
+    """
+    previous = None
+    for index, header in enumerate(headers, start=1):
+        if header.get('kind') == BACKUP_KIND_INCREMENTAL and previous is not None:
+            if not previous.get('watermark') or parse_timestamp(header['since']) > parse_timestamp(previous['watermark']):
+                raise ValueError(
+                    f"Archive {index} starts at {header['since']}, after the previous archive's "
+                    f"watermark {previous.get('watermark')}; an archive is missing from the chain"
+                )
+        previous = header
+
+
+class BackupImporter:
+    """
+    Applies a stream of backup records to the database in committed chunks
+
+    Args:
+        resume_from: Last line committed by an earlier, interrupted run;
+                     records up to it only rebuild the ID mappings
+        chunk_size: Records per committed chunk
+        progress: Optional callable receiving a progress dict after each chunk
+    """
+
+    def __init__(self, resume_from=0, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+        self.resume_from = resume_from or 0
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.committed_line = self.resume_from
+        self.counts = {
+            'wallets_imported': 0,
+            'wallets_existing': 0,
+            'history_records': 0,
+            'history_skipped': 0,
+            'manual_balances': 0,
+            'cash_flow_ledgers': 0,
+            'permissions': 0,
+            'settings': 0
+        }
+        # Backup IDs -> database IDs
+        self.wallet_ids = {}
+        self.user_ids = {}
+        self.incremental = False
+        self._pending = []
+
+    def run(self, records):
+        """
+        Import every record of the stream
+
+        Returns:
+            dict: Counts of imported rows plus 'committed_line'
+
+        Raises:
+            ValueError: If the stream does not start with a supported header
+        """
+        records = iter(records)
+        first = next(records, None)
+        if first is None or first[1].get('type') != 'header':
+            raise ValueError('Backup stream must start with a header record')
+        version = str(first[1].get('version', ''))
+        if version.split('.')[0] != BACKUP_STREAM_VERSION.split('.')[0]:
+            raise ValueError(f'Unsupported backup version: {version}')
+        self.incremental = first[1].get('kind') == BACKUP_KIND_INCREMENTAL
+
+        replayed = []
+        for line_number, record in records:
+            if line_number <= self.resume_from:
+                replayed.append(record)
+                if len(replayed) >= self.chunk_size:
+                    self._map_committed(replayed)
+                    replayed = []
+                continue
+            if replayed:
+                self._map_committed(replayed)
+                replayed = []
+            self._pending.append((line_number, record))
+            if len(self._pending) >= self.chunk_size:
+                self._flush()
+        if replayed:
+            self._map_committed(replayed)
+        self._flush()
+        return dict(self.counts, committed_line=self.committed_line)
+
+    def _map_committed(self, records):
+        """Rebuild ID mappings for records an earlier run already committed"""
+        self._map_wallets([record for record in records if record['type'] == 'wallet'])
+        self._map_users([record for record in records if record['type'] == 'user'])
+
+    def _flush(self):
+        """Write and commit the pending chunk"""
+        if not self._pending:
+            return
+        by_type = {}
+        for _, record in self._pending:
+            by_type.setdefault(record['type'], []).append(record)
+
+        try:
+            self._import_wallets(by_type.get('wallet', []))
+            self._import_histories(by_type.get('balance_history', []))
+            self._import_manual_balances(by_type.get('manual_balance', []))
+            self._import_cash_flows(by_type.get('cash_flows', []))
+            self._map_users(by_type.get('user', []))
+            self._import_permissions(by_type.get('permission', []))
+            self._import_settings(by_type.get('setting', []))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        self.committed_line = self._pending[-1][0]
+        self._pending = []
+        print(f"   ✓ Committed through line {self.committed_line}: "
+              f"{self.counts['wallets_imported']} wallets, {self.counts['history_records']} balance records")
+        if self.progress:
+            self.progress(dict(self.counts, committed_line=self.committed_line))
+
+    def _map_wallets(self, records):
+        """Map backup wallet IDs onto existing wallets by address; returns the unmatched records"""
+        if not records:
+            return []
+        existing = dict(db.session.query(Wallet.address, Wallet.id)
+                        .filter(Wallet.address.in_({record['address'] for record in records})).all())
+        missing = []
+        for record in records:
+            if record['address'] in existing:
+                self.wallet_ids[record['id']] = existing[record['address']]
+            else:
+                missing.append(record)
+        return missing
+
+    def _import_wallets(self, records):
+        missing = self._map_wallets(records)
+        self.counts['wallets_existing'] += len(records) - len(missing)
+        if not missing:
+            return
+        table = Wallet.__table__
+        now = datetime.utcnow()
+        rows = [{
+            'address': record['address'],
+            'name': record.get('name'),
+            'created_at': parse_timestamp(record['created_at']) if record.get('created_at') else now,
+            'initial_quota_value': record.get('initial_quota_value') or 1.0
+        } for record in missing]
+        new_ids = db.session.execute(
+            insert(table).returning(table.c.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        for record, wallet_id in zip(missing, new_ids):
+            self.wallet_ids[record['id']] = wallet_id
+        self.counts['wallets_imported'] += len(missing)
+
+    def _existing_history_keys(self, candidates):
+        """(wallet_id, timestamp) pairs among the candidates that are already stored"""
+        ranges = {}
+        for wallet_id, timestamp in candidates:
+            low, high = ranges.get(wallet_id, (timestamp, timestamp))
+            ranges[wallet_id] = (min(low, timestamp), max(high, timestamp))
+        rows = db.session.query(BalanceHistory.wallet_id, BalanceHistory.timestamp).filter(or_(*[
+            and_(BalanceHistory.wallet_id == wallet_id, BalanceHistory.timestamp.between(low, high))
+            for wallet_id, (low, high) in ranges.items()
+        ])).all()
+        return {(row.wallet_id, row.timestamp) for row in rows}
+
+    def _import_histories(self, records):
+        if not records:
+            return
+        candidates = []
+        for record in records:
+            wallet_id = self.wallet_ids.get(record['wallet_id'])
+            if wallet_id is None:
+                raise ValueError(f"Balance history for unknown wallet {record['wallet_id']}")
+            candidates.append((wallet_id, parse_timestamp(record['timestamp']), record))
+
+        existing = self._existing_history_keys([(wallet_id, timestamp) for wallet_id, timestamp, _ in candidates])
+        new = []
+        for wallet_id, timestamp, record in candidates:
+            if (wallet_id, timestamp) in existing:
+                continue
+            existing.add((wallet_id, timestamp))
+            new.append((wallet_id, timestamp, record))
+        self.counts['history_skipped'] += len(candidates) - len(new)
+        if not new:
+            return
+
+        table = BalanceHistory.__table__
+        history_ids = db.session.execute(
+            insert(table).returning(table.c.id, sort_by_parameter_order=True),
+            [{'wallet_id': wallet_id, 'timestamp': timestamp, 'networth': record['networth'], 'data_json': ''}
+             for wallet_id, timestamp, record in new]
+        ).scalars().all()
+
+        payloads, protocols, tokens = [], [], []
+        for history_id, (_, _, record) in zip(history_ids, new):
+            codec, raw_size, blob = BalancePayload.compress(record.get('data_json') or '{}')
+            payloads.append({'balance_history_id': history_id, 'codec': codec, 'raw_size': raw_size, 'payload': blob})
+            protocols.extend(dict({column: protocol.get(column) for column in PROTOCOL_COLUMNS}, balance_history_id=history_id)
+                             for protocol in record.get('protocols', []))
+            tokens.extend(dict({column: token.get(column) for column in TOKEN_COLUMNS}, balance_history_id=history_id)
+                          for token in record.get('tokens', []))
+        db.session.execute(BalancePayload.__table__.insert(), payloads)
+        if protocols:
+            db.session.execute(ProtocolBalance.__table__.insert(), protocols)
+        if tokens:
+            db.session.execute(TokenBalance.__table__.insert(), tokens)
+        self.counts['history_records'] += len(new)
+
+        # Refresh derived state from the earliest point this chunk added per wallet
+        since = {}
+        for wallet_id, timestamp, _ in new:
+            since[wallet_id] = min(since.get(wallet_id, timestamp), timestamp)
+        for wallet in Wallet.query.filter(Wallet.id.in_(list(since))).all():
+            balances_changed(wallet, since=since[wallet.id])
+
+    def _mapped_wallet_id(self, record):
+        wallet_id = self.wallet_ids.get(record['wallet_id'])
+        if wallet_id is None:
+            raise ValueError(f"{record['type']} record for unknown wallet {record['wallet_id']}")
+        return wallet_id
+
+    def _import_manual_balances(self, records):
+        """Upsert manual balances by (wallet, timestamp)"""
+        by_wallet = {}
+        for record in records:
+            by_wallet.setdefault(self._mapped_wallet_id(record), []).append({
+                'timestamp': parse_timestamp(record['timestamp']),
+                'networth': record['networth'],
+                'notes': record.get('notes')
+            })
+        if not by_wallet:
+            return
+        for wallet_id, rows in by_wallet.items():
+            inserted, updated = upsert_manual_balance_batch(wallet_id, rows)
+            self.counts['manual_balances'] += inserted + updated
+        for wallet in Wallet.query.filter(Wallet.id.in_(list(by_wallet))).all():
+            balances_changed(wallet, since=min(row['timestamp'] for row in by_wallet[wallet.id]))
+
+    def _import_cash_flows(self, records):
+        """Replace each wallet's cash flows and quota history with the exported ledger"""
+        ledgers = {self._mapped_wallet_id(record): record for record in records}
+        if not ledgers:
+            return
+        wallet_ids = list(ledgers)
+        CashFlow.query.filter(CashFlow.wallet_id.in_(wallet_ids)).delete(synchronize_session=False)
+        QuotaHistory.query.filter(QuotaHistory.wallet_id.in_(wallet_ids)).delete(synchronize_session=False)
+
+        now = datetime.utcnow()
+        flows = [{
+            'wallet_id': wallet_id,
+            'timestamp': parse_timestamp(flow['timestamp']),
+            'type': flow['type'],
+            'amount': flow['amount'],
+            'description': flow.get('description'),
+            'quota_value_at_time': flow['quota_value_at_time'],
+            'quotas_issued': flow['quotas_issued'],
+            'created_at': parse_timestamp(flow['created_at']) if flow.get('created_at') else now
+        } for wallet_id, ledger in ledgers.items() for flow in ledger.get('flows', [])]
+        history = [{
+            'wallet_id': wallet_id,
+            'timestamp': parse_timestamp(row['timestamp']),
+            'quota_value': row['quota_value'],
+            'quota_quantity': row['quota_quantity'],
+            'networth': row['networth']
+        } for wallet_id, ledger in ledgers.items() for row in ledger.get('quota_history', [])]
+        if flows:
+            db.session.execute(CashFlow.__table__.insert(), flows)
+        if history:
+            db.session.execute(QuotaHistory.__table__.insert(), history)
+        link_quota_history(db.session, wallet_ids)
+
+        for wallet in Wallet.query.filter(Wallet.id.in_(wallet_ids)).all():
+            wallet.current_quota_quantity = ledgers[wallet.id].get('current_quota_quantity') or 0.0
+            wallet.ledger_updated_at = now
+            db.session.flush()
+            rebuild_nav(wallet)
+            bump_data_version(wallet.id)
+        self.counts['cash_flow_ledgers'] += len(ledgers)
+
+    def _map_users(self, records):
+        """Map backup user IDs onto existing users by username (users are never created)"""
+        if not records:
+            return
+        existing = dict(db.session.query(User.username, User.id)
+                        .filter(User.username.in_({record['username'] for record in records})).all())
+        for record in records:
+            if record['username'] in existing:
+                self.user_ids[record['id']] = existing[record['username']]
+
+    def _import_permissions(self, records):
+        pairs = set()
+        for record in records:
+            user_id = self.user_ids.get(record['user_id'])
+            wallet_id = self.wallet_ids.get(record['wallet_id'])
+            if user_id is not None and wallet_id is not None:
+                pairs.add((user_id, wallet_id))
+        if not pairs:
+            return
+        existing = set(db.session.query(WalletPermission.user_id, WalletPermission.wallet_id).filter(
+            WalletPermission.user_id.in_({user_id for user_id, _ in pairs}),
+            WalletPermission.wallet_id.in_({wallet_id for _, wallet_id in pairs})
+        ).all())
+        rows = [{'user_id': user_id, 'wallet_id': wallet_id} for user_id, wallet_id in sorted(pairs - existing)]
+        if rows:
+            db.session.execute(WalletPermission.__table__.insert(), rows)
+        self.counts['permissions'] += len(rows)
+
+    def _import_settings(self, records):
+        """Insert missing settings; differential archives also update changed values"""
+        if not records:
+            return
+        values = {record['key']: record.get('value') for record in records}
+        existing = {key for (key,) in db.session.query(AppSettings.key)
+                    .filter(AppSettings.key.in_(list(values))).all()}
+        now = datetime.utcnow()
+
+        inserts = [{'key': key, 'value': value, 'updated_at': now} for key, value in values.items() if key not in existing]
+        if inserts:
+            db.session.execute(AppSettings.__table__.insert(), inserts)
+        self.counts['settings'] += len(inserts)
+
+        if self.incremental:
+            table = AppSettings.__table__
+            updates = [{'b_key': key, 'b_value': value, 'b_updated_at': now}
+                       for key, value in values.items() if key in existing]
+            if updates:
+                db.session.execute(
+                    update(table).where(table.c.key == bindparam('b_key')).values(
+                        value=bindparam('b_value'),
+                        updated_at=bindparam('b_updated_at')
+                    ),
+                    updates
+                )
+            self.counts['settings'] += len(updates)
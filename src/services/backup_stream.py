@@ -0,0 +1,340 @@
+"""
+Streaming backup export.
+
+Writes the database as NDJSON: one JSON record per line, each tagged with a
+"type" ('header', 'wallet', 'balance_history', 'manual_balance',
+'cash_flows', 'user', 'permission', 'setting' and a closing 'footer' with
+record counts). Tables are read with server-side cursors (yield_per) and
+the protocol, token and payload rows of balance history are loaded with one
+batched query per chunk of histories, so memory stays flat regardless of
+database size. Balance history records carry the same fields as the JSON
+backup (heartbeats and delta snapshots are resolved to full rows).
+
+A differential export (since=<watermark>) only includes balance history
+created, manual balances and settings updated, cash flow ledgers changed
+and permissions granted after the watermark, plus the wallet and user
+records those rows need to be mapped on import. Every header carries the
+watermark to pass as `since` for the next differential export.
+
+Change timestamps are set when a row is flushed, which can be a little
+before its transaction commits, so a differential export reaches back
+BACKUP_OVERLAP before its watermark. Rows it repeats are skipped or
+upserted by the importer.
+"""
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, union
+
+from src.models.models import (
+    db, AppSettings, BalanceHistory, BalancePayload, CashFlow, ProtocolBalance, QuotaHistory,
+    User, Wallet, WalletPermission
+)
+from src.models.manual_balance import ManualBalance
+from src.services.snapshot_store import tokens_as_of_many
+
+BACKUP_STREAM_VERSION = '2.0'
+
+# Balance history rows per batched child query
+EXPORT_CHUNK_SIZE = 500
+# Rows fetched per round trip for the other tables
+EXPORT_BATCH_SIZE = 1000
+# Wallets per batched cash flow ledger query
+LEDGER_CHUNK_SIZE = 100
+
+# Differential exports also include rows changed this long before `since`
+BACKUP_OVERLAP = timedelta(minutes=10)
+
+BACKUP_KIND_FULL = 'full'
+BACKUP_KIND_INCREMENTAL = 'incremental'
+
+# Settings never written to backups
+SENSITIVE_SETTINGS = frozenset({'octav_api_key'})
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def _payload_texts(snapshot_ids):
+    """Raw API response of each snapshot (compressed payload, else legacy data_json)"""
+    if not snapshot_ids:
+        return {}
+    history = BalanceHistory.__table__
+    payloads = BalancePayload.__table__
+    rows = db.session.execute(
+        select(history.c.id, history.c.data_json, payloads.c.codec, payloads.c.payload)
+        .select_from(history.outerjoin(payloads, payloads.c.balance_history_id == history.c.id))
+        .where(history.c.id.in_(list(snapshot_ids)))
+    )
+    texts = {}
+    for history_id, data_json, codec, payload in rows:
+        if payload is not None:
+            texts[history_id] = BalancePayload.decompress(codec, payload)
+        else:
+            texts[history_id] = data_json or None
+    return texts
+
+
+def _protocol_rows(snapshot_ids):
+    """Protocol rows of each snapshot, in insertion order"""
+    rows_by_snapshot = {snapshot_id: [] for snapshot_id in snapshot_ids}
+    if not snapshot_ids:
+        return rows_by_snapshot
+    table = ProtocolBalance.__table__
+    rows = db.session.execute(
+        select(table.c.balance_history_id, table.c.protocol_key, table.c.protocol_name, table.c.value, table.c.chain)
+        .where(table.c.balance_history_id.in_(list(snapshot_ids)))
+        .order_by(table.c.id)
+    )
+    for row in rows:
+        rows_by_snapshot[row.balance_history_id].append({
+            'protocol_key': row.protocol_key,
+            'protocol_name': row.protocol_name,
+            'value': row.value,
+            'chain': row.chain
+        })
+    return rows_by_snapshot
+
+
+def history_records(histories):
+    """
+    Build balance_history records for a chunk of BalanceHistory rows
+
+    Loads payloads, protocol rows and tokens of the whole chunk with one
+    batched query each.
+
+    Args:
+        histories: Rows with id, wallet_id, timestamp, networth and heartbeat_of_id
+    """
+    snapshot_ids = {row.heartbeat_of_id or row.id for row in histories}
+    payloads = _payload_texts(snapshot_ids)
+    protocols = _protocol_rows(snapshot_ids)
+    tokens = tokens_as_of_many([row.id for row in histories])
+
+    for row in histories:
+        snapshot_id = row.heartbeat_of_id or row.id
+        yield {
+            'type': 'balance_history',
+            'wallet_id': row.wallet_id,
+            'timestamp': row.timestamp.isoformat(),
+            'networth': row.networth,
+            'data_json': payloads.get(snapshot_id),
+            'protocols': protocols[snapshot_id],
+            'tokens': tokens[row.id]
+        }
+
+
+def _rows(query):
+    """Iterate a column query through a server-side cursor"""
+    return db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+
+
+def _balance_history_records(since=None):
+    history = BalanceHistory.__table__
+    query = select(history.c.id, history.c.wallet_id, history.c.timestamp, history.c.networth, history.c.heartbeat_of_id)
+    if since is not None:
+        query = query.where(history.c.created_at > since).order_by(history.c.created_at, history.c.id)
+    else:
+        query = query.order_by(history.c.wallet_id, history.c.id)
+    for partition in db.session.execute(query.execution_options(yield_per=EXPORT_CHUNK_SIZE)).partitions():
+        yield from history_records(partition)
+
+
+def _manual_balance_records(since=None):
+    query = select(ManualBalance.wallet_id, ManualBalance.timestamp, ManualBalance.networth, ManualBalance.notes)
+    if since is not None:
+        query = query.where(ManualBalance.updated_at > since).order_by(ManualBalance.id)
+    else:
+        query = query.order_by(ManualBalance.wallet_id, ManualBalance.timestamp)
+    for row in _rows(query):
+        yield {
+            'type': 'manual_balance',
+            'wallet_id': row.wallet_id,
+            'timestamp': row.timestamp.isoformat(),
+            'networth': row.networth,
+            'notes': row.notes
+        }
+
+
+def _ledger_wallet_ids(since=None):
+    """Wallets whose cash flow ledger is exported: any with flows, or (differential) any changed since `since`"""
+    if since is not None:
+        query = select(Wallet.id).where(Wallet.ledger_updated_at > since)
+    else:
+        query = select(CashFlow.wallet_id).distinct()
+    wallet_ids = set(db.session.execute(query).scalars())
+    existing = db.session.execute(select(Wallet.id).where(Wallet.id.in_(list(wallet_ids)))).scalars() if wallet_ids else []
+    return sorted(existing)
+
+
+def _changed_wallet_ids(since):
+    """Wallets created after `since` or referenced by a row a differential export includes"""
+    return union(
+        select(Wallet.id).where(Wallet.created_at > since),
+        select(BalanceHistory.wallet_id).where(BalanceHistory.created_at > since),
+        select(ManualBalance.wallet_id).where(ManualBalance.updated_at > since),
+        select(Wallet.id).where(Wallet.ledger_updated_at > since),
+        select(WalletPermission.wallet_id).where(WalletPermission.created_at > since)
+    )
+
+
+def _cash_flow_records(since=None):
+    """
+    One record per wallet with its complete cash flow ledger
+
+    Cash flows are edited and re-priced in place, so a wallet's ledger is
+    always exported (and restored) as a whole.
+    """
+    wallet_ids = _ledger_wallet_ids(since)
+    for start in range(0, len(wallet_ids), LEDGER_CHUNK_SIZE):
+        chunk = wallet_ids[start:start + LEDGER_CHUNK_SIZE]
+        ledgers = {wallet_id: {'flows': [], 'quota_history': []} for wallet_id in chunk}
+        quantities = dict(db.session.execute(
+            select(Wallet.id, Wallet.current_quota_quantity).where(Wallet.id.in_(chunk))
+        ).all())
+
+        flows = db.session.execute(
+            select(CashFlow.wallet_id, CashFlow.timestamp, CashFlow.type, CashFlow.amount, CashFlow.description,
+                   CashFlow.quota_value_at_time, CashFlow.quotas_issued, CashFlow.created_at)
+            .where(CashFlow.wallet_id.in_(chunk))
+            .order_by(CashFlow.wallet_id, CashFlow.timestamp, CashFlow.id)
+        )
+        for row in flows:
+            ledgers[row.wallet_id]['flows'].append({
+                'timestamp': row.timestamp.isoformat(),
+                'type': row.type,
+                'amount': row.amount,
+                'description': row.description,
+                'quota_value_at_time': row.quota_value_at_time,
+                'quotas_issued': row.quotas_issued,
+                'created_at': _isoformat(row.created_at)
+            })
+
+        history = db.session.execute(
+            select(QuotaHistory.wallet_id, QuotaHistory.timestamp, QuotaHistory.quota_value,
+                   QuotaHistory.quota_quantity, QuotaHistory.networth)
+            .where(QuotaHistory.wallet_id.in_(chunk))
+            .order_by(QuotaHistory.wallet_id, QuotaHistory.timestamp, QuotaHistory.id)
+        )
+        for row in history:
+            ledgers[row.wallet_id]['quota_history'].append({
+                'timestamp': row.timestamp.isoformat(),
+                'quota_value': row.quota_value,
+                'quota_quantity': row.quota_quantity,
+                'networth': row.networth
+            })
+
+        for wallet_id in chunk:
+            yield dict(
+                ledgers[wallet_id],
+                type='cash_flows',
+                wallet_id=wallet_id,
+                current_quota_quantity=quantities[wallet_id]
+            )
+
+
+def iter_backup_records(since=None):
+    """
+    Yield the backup as a sequence of record dicts
+
+    Wallets come before their balance history and users before permissions,
+    so the stream can be imported in a single pass. Differential exports
+    only carry the wallets and users their other records reference.
+
+    Args:
+        since: Watermark of the previous export for a differential export
+               (None for a full export)
+    """
+    counts = {}
+    wallet_ids, user_ids = set(), set()
+
+    def counted(record_type, records):
+        for record in records:
+            counts[record_type] = counts.get(record_type, 0) + 1
+            yield record
+
+    def of_known_wallets(records):
+        # Rows of a wallet created after the wallet records were read are
+        # left to the next differential export, which reaches back past them
+        return (record for record in records if record['wallet_id'] in wallet_ids)
+
+    # Taken before reading anything, so rows written during the export are
+    # picked up again by the next differential export
+    watermark = datetime.utcnow()
+    changed_since = since - BACKUP_OVERLAP if since is not None else None
+    yield {
+        'type': 'header',
+        'version': BACKUP_STREAM_VERSION,
+        'kind': BACKUP_KIND_INCREMENTAL if since is not None else BACKUP_KIND_FULL,
+        'since': _isoformat(since),
+        'watermark': watermark.isoformat(),
+        'timestamp': watermark.isoformat()
+    }
+
+    wallets = select(Wallet.id, Wallet.name, Wallet.address, Wallet.created_at, Wallet.initial_quota_value)
+    permissions = select(WalletPermission.user_id, WalletPermission.wallet_id).order_by(WalletPermission.id)
+    users = select(User.id, User.username, User.is_admin).order_by(User.id)
+    settings = select(AppSettings.key, AppSettings.value).order_by(AppSettings.id)
+    if changed_since is not None:
+        wallets = wallets.where(Wallet.id.in_(_changed_wallet_ids(changed_since)))
+        permissions = permissions.where(WalletPermission.created_at > changed_since)
+        users = users.where(User.id.in_(
+            select(WalletPermission.user_id).where(WalletPermission.created_at > changed_since)
+        ))
+        settings = settings.where(AppSettings.updated_at > changed_since)
+
+    def wallet_records():
+        for row in _rows(wallets.order_by(Wallet.id)):
+            wallet_ids.add(row.id)
+            yield {
+                'type': 'wallet',
+                'id': row.id,
+                'name': row.name,
+                'address': row.address,
+                'created_at': _isoformat(row.created_at),
+                'initial_quota_value': row.initial_quota_value
+            }
+
+    def user_records():
+        # Users are exported without passwords for security
+        for row in _rows(users):
+            user_ids.add(row.id)
+            yield {'type': 'user', 'id': row.id, 'username': row.username, 'is_admin': row.is_admin}
+
+    yield from counted('wallet', wallet_records())
+    yield from counted('balance_history', of_known_wallets(_balance_history_records(changed_since)))
+    yield from counted('manual_balance', of_known_wallets(_manual_balance_records(changed_since)))
+    yield from counted('cash_flows', of_known_wallets(_cash_flow_records(changed_since)))
+    yield from counted('user', user_records())
+
+    yield from counted('permission', ({
+        'type': 'permission',
+        'user_id': row.user_id,
+        'wallet_id': row.wallet_id
+    } for row in _rows(permissions) if row.wallet_id in wallet_ids and row.user_id in user_ids))
+
+    yield from counted('setting', ({
+        'type': 'setting',
+        'key': row.key,
+        'value': row.value
+    } for row in _rows(settings) if row.key not in SENSITIVE_SETTINGS))
+
+    yield {'type': 'footer', 'counts': counts}
+
+
+def ndjson_lines(records):
+    """Serialize records as NDJSON lines"""
+    for record in records:
+        yield json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def gzip_stream(chunks, level=6):
+    """Gzip-compress an iterable of text chunks incrementally, yielding compressed bytes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,294 @@
+"""
+Helpers for bulk import endpoints.
+
+Uploads can be a CSV file (multipart field "file"), a raw text/csv request
+body or a JSON array; rows are yielded one at a time so CSV uploads are
+parsed as they stream in. The same uploads can be staged as background job
+inputs (upload_source) and read back with iter_file_rows. The importers and
+batch writers are shared by the routes, their jobs and the backup importer.
+"""
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, insert, update
+from werkzeug.utils import secure_filename
+
+from src.models.models import db, CashFlow, QuotaHistory
+from src.models.manual_balance import ManualBalance
+from src.services.quota_engine import flow_networths, replay_cash_flows
+from src.services.wallet_state import balances_changed
+
+CSV_MIMETYPES = ('text/csv', 'application/csv')
+# Manual balances upserted per statement batch
+MANUAL_BALANCE_BATCH_SIZE = 500
+
+
+class RowsRejected(ValueError):
+    """Raised by an all-or-nothing import when rows fail validation"""
+
+    def __init__(self, rejected):
+        first = rejected[0]
+        super().__init__(f"{len(rejected)} invalid rows, nothing was imported (row {first['row']}: {first['error']})")
+        self.rejected = rejected
+
+
+def parse_timestamp(value):
+    """Parse an ISO timestamp into a naive UTC datetime (the format stored in the database)"""
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _csv_rows(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        yield reader.line_num, {
+            (key or '').strip().lower(): (value or '').strip() if isinstance(value, str) else value
+            for key, value in row.items()
+        }
+
+
+def _json_rows(data, json_key):
+    if isinstance(data, dict):
+        data = data.get(json_key)
+    if not isinstance(data, list):
+        raise ValueError(f'Expected a CSV upload or a JSON array of {json_key}')
+    for index, row in enumerate(data, start=1):
+        if not isinstance(row, dict):
+            raise ValueError(f'Row {index}: expected an object')
+        yield index, row
+
+
+def iter_upload_rows(req, json_key):
+    """
+    Yield (row_number, row dict) pairs from a bulk upload
+
+    CSV headers are matched case-insensitively and row numbers are file line
+    numbers; JSON rows are numbered from 1.
+
+    Args:
+        req: Flask request
+        json_key: Key holding the row list when the JSON body is an object
+
+    Raises:
+        ValueError: If the body is neither CSV nor a JSON array of objects
+    """
+    upload = req.files.get('file')
+    if upload is not None:
+        yield from _csv_rows(upload.stream)
+        return
+
+    if req.mimetype in CSV_MIMETYPES:
+        yield from _csv_rows(req.stream)
+        return
+
+    yield from _json_rows(req.get_json(silent=True), json_key)
+
+
+def upload_source(req, name):
+    """(filename, mimetype, stream) of a bulk upload, for staging it as a job input"""
+    upload = req.files.get('file')
+    if upload is not None:
+        return secure_filename(upload.filename) or f'{name}.csv', 'text/csv', upload.stream
+    if req.mimetype in CSV_MIMETYPES:
+        return f'{name}.csv', 'text/csv', req.stream
+    return f'{name}.json', 'application/json', req.stream
+
+
+def iter_file_rows(stream, mimetype, json_key):
+    """
+    Yield (row_number, row dict) pairs from a staged upload
+
+    Args:
+        stream: Binary file with the upload
+        mimetype: Mimetype recorded by upload_source
+        json_key: Key holding the row list when the JSON body is an object
+
+    Raises:
+        ValueError: If the file is neither CSV nor a JSON array of objects
+    """
+    if mimetype in CSV_MIMETYPES:
+        yield from _csv_rows(stream)
+        return
+
+    try:
+        data = json.load(stream)
+    except ValueError:
+        data = None
+    yield from _json_rows(data, json_key)
+
+
+def upsert_manual_balance_batch(wallet_id, rows):
+    """
+    Insert or update a batch of validated manual balances by timestamp
+
+    Existing entries for the same (wallet_id, timestamp) are updated in
+    place; the rest are inserted. Both use one bulk statement each.
+
+    Returns:
+        tuple: (inserted count, updated count)
+    """
+    by_timestamp = {row['timestamp']: row for row in rows}  # last row wins within a batch
+    table = ManualBalance.__table__
+    existing = dict(db.session.query(ManualBalance.timestamp, ManualBalance.id).filter(
+        ManualBalance.wallet_id == wallet_id,
+        ManualBalance.timestamp.in_(list(by_timestamp))
+    ).all())
+    now = datetime.utcnow()
+
+    updates = [{
+        'b_id': existing[timestamp],
+        'b_networth': row['networth'],
+        'b_notes': row['notes'],
+        'b_updated_at': now
+    } for timestamp, row in by_timestamp.items() if timestamp in existing]
+    inserts = [dict(
+        row,
+        wallet_id=wallet_id,
+        created_at=now,
+        updated_at=now
+    ) for timestamp, row in by_timestamp.items() if timestamp not in existing]
+
+    if updates:
+        db.session.execute(
+            update(table).where(table.c.id == bindparam('b_id')).values(
+                networth=bindparam('b_networth'),
+                notes=bindparam('b_notes'),
+                updated_at=bindparam('b_updated_at')
+            ),
+            updates
+        )
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    return len(inserts), len(updates)
+
+
+def import_manual_balance_rows(wallet, rows):
+    """
+    Upsert manual balances by timestamp in batches
+
+    Invalid rows are reported and skipped. Does not commit.
+
+    Args:
+        wallet: Wallet model instance
+        rows: (row_number, row dict) pairs with timestamp, networth and notes
+
+    Returns:
+        dict: Counts of inserted and updated entries, and the rejected rows
+    """
+    inserted = updated = 0
+    rejected = []
+    earliest = None
+    batch = []
+
+    for row_number, row in rows:
+        try:
+            if not row.get('timestamp') or row.get('networth') in (None, ''):
+                raise ValueError('Missing required fields: timestamp and networth')
+            timestamp = parse_timestamp(str(row['timestamp']))
+            networth = float(row['networth'])
+            if networth < 0:
+                raise ValueError('Networth must be positive')
+        except (TypeError, ValueError) as e:
+            rejected.append({'row': row_number, 'error': str(e)})
+            continue
+
+        batch.append({'timestamp': timestamp, 'networth': networth, 'notes': row.get('notes') or ''})
+        earliest = timestamp if earliest is None else min(earliest, timestamp)
+
+        if len(batch) >= MANUAL_BALANCE_BATCH_SIZE:
+            counts = upsert_manual_balance_batch(wallet.id, batch)
+            inserted, updated = inserted + counts[0], updated + counts[1]
+            batch = []
+
+    if batch:
+        counts = upsert_manual_balance_batch(wallet.id, batch)
+        inserted, updated = inserted + counts[0], updated + counts[1]
+
+    if earliest is not None:
+        balances_changed(wallet, since=earliest)
+    return {'inserted': inserted, 'updated': updated, 'rejected': rejected}
+
+
+def import_cash_flow_rows(wallet, rows):
+    """
+    Validate and insert cash flows, then price them in one replay
+
+    All-or-nothing: every row is validated before anything is written. Does
+    not commit.
+
+    Args:
+        wallet: Wallet model instance
+        rows: (row_number, row dict) pairs with timestamp, type, amount and description
+
+    Returns:
+        dict: Number imported, first/last timestamps and the new quota quantity
+
+    Raises:
+        RowsRejected: If any row is invalid
+        ValueError: If there is nothing to import or no balance to price the first flow
+    """
+    valid = []
+    rejected = []
+    for row_number, row in rows:
+        try:
+            flow_type = (row.get('type') or '').strip().lower()
+            if flow_type not in ['in', 'out']:
+                raise ValueError('Invalid type. Must be "in" or "out"')
+            amount = float(row.get('amount') or 0)
+            if amount <= 0:
+                raise ValueError('Amount must be greater than 0')
+            if not row.get('timestamp'):
+                raise ValueError('Missing timestamp')
+            valid.append({
+                'timestamp': parse_timestamp(str(row['timestamp'])),
+                'type': flow_type,
+                'amount': amount,
+                'description': row.get('description') or ''
+            })
+        except (TypeError, ValueError) as e:
+            rejected.append({'row': row_number, 'error': str(e)})
+
+    if rejected:
+        raise RowsRejected(rejected)
+    if not valid:
+        raise ValueError('No cash flows to import')
+
+    valid.sort(key=lambda r: r['timestamp'])
+    first_timestamp = valid[0]['timestamp']
+
+    # Balance at each flow, stored on its history row exactly like add_cash_flow
+    networths = flow_networths(wallet.id, [row['timestamp'] for row in valid])
+    if networths[0] is None:
+        raise ValueError(f'No balance history found at or before {first_timestamp.strftime("%Y-%m-%d")}. Please add a balance entry for that date first.')
+
+    # Insert placeholder rows in bulk; the replay prices them in one pass
+    created_at = datetime.utcnow()
+    flows = CashFlow.__table__
+    flow_ids = db.session.execute(insert(flows).returning(flows.c.id, sort_by_parameter_order=True), [dict(
+        row,
+        wallet_id=wallet.id,
+        quota_value_at_time=wallet.initial_quota_value,
+        quotas_issued=0.0,
+        created_at=created_at
+    ) for row in valid]).scalars().all()
+    db.session.execute(QuotaHistory.__table__.insert(), [{
+        'wallet_id': wallet.id,
+        'timestamp': row['timestamp'],
+        'quota_value': wallet.initial_quota_value,
+        'quota_quantity': 0.0,
+        'networth': networth,
+        'cash_flow_id': flow_id
+    } for row, networth, flow_id in zip(valid, networths, flow_ids)])
+
+    replay_cash_flows(wallet, since=first_timestamp)
+
+    return {
+        'imported': len(valid),
+        'first_timestamp': first_timestamp.isoformat(),
+        'last_timestamp': valid[-1]['timestamp'].isoformat(),
+        'new_quota_quantity': wallet.current_quota_quantity
+    }
@@ -0,0 +1,673 @@
+"""
+Persistent background jobs for long admin operations.
+
+Web requests submit a job (a row in the jobs table, with any uploaded files
+streamed to disk under the job files directory) and return immediately; the
+scheduler worker process
+(scheduler_worker.py) polls the table, claims queued jobs one at a time and
+runs their handler. Handlers report progress percentages and resume
+checkpoints through a JobContext, which writes them on its own connection so
+they are visible while the job's transaction is still open, and raises
+JobCancelled once a cancel was requested. Results are stored as JSON and,
+for exports, as a result file next to the inputs. Both processes must see
+the same job files directory (JOB_FILES_DIR, else <DATA_DIR>/jobs), e.g. a
+shared volume. Migrations queue their slow data backfills
+the same way (enqueue_job) so they never hold up web startup.
+
+The worker records a heartbeat (job_runner_heartbeat in app_settings) while
+it polls. Without a recent heartbeat nothing will run queued jobs, e.g. on a
+web-only deploy; job_runner_alive() lets routes run inline or warn instead.
+
+Jobs interrupted by a worker restart are requeued (up to JOB_MAX_ATTEMPTS
+attempts); the backup import handler continues from its last checkpoint.
+"""
+import json
+import os
+import shutil
+import time
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import OperationalError
+
+from src.models.models import db, AppSettings, BalanceHistory, BalancePayload, Job, JobFile, Wallet
+from src.services.backup_archive import restore_archive, read_manifest, write_archive
+from src.services.backup_import import BackupImporter, iter_ndjson_records, read_backup_header, validate_backup_chain
+from src.services.backup_stream import (
+    BACKUP_KIND_FULL, BACKUP_KIND_INCREMENTAL, BACKUP_OVERLAP, EXPORT_CHUNK_SIZE, gzip_stream, iter_backup_records,
+    ndjson_lines
+)
+from src.services.bulk_import import (
+    import_cash_flow_rows, import_manual_balance_rows, iter_file_rows, parse_timestamp
+)
+from src.services.octav_service import OctavService
+from src.services.quota_engine import nav_materialized, rebuild_nav
+from src.services.rollups import rebuild_rollups
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED, JOB_CANCELLED)
+
+# Seconds between polls of the jobs table by the scheduler worker
+JOB_POLL_SECONDS = 5
+# Seconds between job runner heartbeats, and age after which no worker is assumed
+JOB_RUNNER_HEARTBEAT_SECONDS = 30
+JOB_RUNNER_STALE_SECONDS = 120
+JOB_RUNNER_HEARTBEAT_KEY = 'job_runner_heartbeat'
+# Runs of a job interrupted by worker restarts before it is marked failed
+JOB_MAX_ATTEMPTS = 3
+# Finished jobs and their files are deleted after this many days
+JOB_RETENTION_DAYS = 7
+# Minimum seconds between progress writes (checkpoints are always written)
+JOB_PROGRESS_INTERVAL = 1.0
+# Bytes copied per read when staging job files
+JOB_FILE_CHUNK_SIZE = 1024 * 1024
+# Balance history rows per transaction when moving inline payloads
+PAYLOAD_MIGRATION_BATCH = 500
+# SQLite allows a single writer: progress writes wait at most this long for
+# a lock held by the job's own reads or writes, and are skipped otherwise
+SQLITE_PROGRESS_TIMEOUT_MS = 100
+SQLITE_DEFAULT_TIMEOUT_MS = 5000
+
+# job type -> handler(context) returning a JSON-serializable result
+JOB_HANDLERS = {}
+# Job types that run on uploaded files
+FILE_INPUT_JOBS = set()
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when the job's cancellation was requested"""
+
+
+def job_handler(job_type, needs_files=False):
+    """Register a handler for a job type"""
+    def register(handler):
+        JOB_HANDLERS[job_type] = handler
+        if needs_files:
+            FILE_INPUT_JOBS.add(job_type)
+        return handler
+    return register
+
+
+def job_files_dir():
+    """Directory holding job inputs and results (JOB_FILES_DIR, else <DATA_DIR>/jobs)"""
+    path = os.getenv('JOB_FILES_DIR')
+    if not path:
+        data_dir = os.getenv('DATA_DIR', '/data')
+        if not os.path.exists(data_dir):
+            project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            data_dir = os.path.join(project_root, 'data')
+        path = os.path.join(data_dir, 'jobs')
+    return path
+
+
+def job_file_path(job_file):
+    """Absolute path of a JobFile"""
+    return os.path.join(job_files_dir(), job_file.path)
+
+
+def _stage_file(relative_path, stream):
+    """Copy a stream into the job files directory in chunks; returns the size in bytes"""
+    path = os.path.join(job_files_dir(), relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        shutil.copyfileobj(stream, out, JOB_FILE_CHUNK_SIZE)
+        return out.tell()
+
+
+def _remove_input_files(job_id):
+    """Delete a job's staged inputs (rows and files); the caller commits"""
+    for job_file in JobFile.query.filter_by(job_id=job_id, role='input').all():
+        try:
+            os.remove(job_file_path(job_file))
+        except FileNotFoundError:
+            pass
+        db.session.delete(job_file)
+
+
+def submit_job(job_type, params=None, files=(), user_id=None):
+    """
+    Queue a job
+
+    Args:
+        job_type: Registered job type
+        params: JSON-serializable handler parameters
+        files: Input files as (filename, mimetype, binary stream) tuples,
+               copied to the job files directory in chunks
+        user_id: Submitting user
+
+    Returns:
+        Job: The queued job (committed)
+
+    Raises:
+        ValueError: If the type is unknown or its input files are missing
+    """
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job type: {job_type}. Available: {', '.join(sorted(JOB_HANDLERS))}")
+    if job_type in FILE_INPUT_JOBS and not files:
+        raise ValueError(f'Job type {job_type} needs an uploaded file')
+
+    job = Job(type=job_type, status=JOB_QUEUED, params_json=json.dumps(params or {}), created_by=user_id)
+    db.session.add(job)
+    db.session.flush()
+    try:
+        for position, (filename, mimetype, stream) in enumerate(files):
+            path = f'{job.id}/input-{position}'
+            size = _stage_file(path, stream)
+            job.files.append(JobFile(role='input', position=position, filename=filename, mimetype=mimetype,
+                                     path=path, size=size))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        shutil.rmtree(os.path.join(job_files_dir(), str(job.id)), ignore_errors=True)
+        raise
+    print(f"📋 Queued job {job.id} ({job_type})")
+    return job
+
+
+def enqueue_job(conn, job_type, params=None):
+    """
+    Queue a job from a migration or other code running on a bare connection
+
+    Does nothing if a job of the same type is already queued or running.
+
+    Args:
+        conn: SQLAlchemy connection (the caller commits)
+        job_type: Registered job type that needs no input files
+        params: JSON-serializable handler parameters
+
+    Returns:
+        bool: True if a job was queued
+    """
+    jobs = Job.__table__
+    pending = conn.execute(
+        select(jobs.c.id).where(jobs.c.type == job_type, jobs.c.status.in_((JOB_QUEUED, JOB_RUNNING))).limit(1)
+    ).first()
+    if pending:
+        return False
+    conn.execute(jobs.insert().values(type=job_type, status=JOB_QUEUED, params_json=json.dumps(params or {})))
+    return True
+
+
+def record_runner_heartbeat():
+    """Record that a worker is polling the jobs table"""
+    setting = AppSettings.query.filter_by(key=JOB_RUNNER_HEARTBEAT_KEY).first()
+    if not setting:
+        setting = AppSettings(key=JOB_RUNNER_HEARTBEAT_KEY)
+        db.session.add(setting)
+    setting.value = datetime.utcnow().isoformat()
+    db.session.commit()
+
+
+def job_runner_alive():
+    """True if a worker recorded a heartbeat within JOB_RUNNER_STALE_SECONDS"""
+    value = db.session.execute(
+        select(AppSettings.value).where(AppSettings.key == JOB_RUNNER_HEARTBEAT_KEY)
+    ).scalar()
+    if not value:
+        return False
+    try:
+        heartbeat = datetime.fromisoformat(value)
+    except ValueError:
+        return False
+    return datetime.utcnow() - heartbeat < timedelta(seconds=JOB_RUNNER_STALE_SECONDS)
+
+
+def request_cancel(job):
+    """
+    Cancel a queued job, or ask a running job to stop at its next progress report
+
+    Returns:
+        bool: False if the job had already finished
+    """
+    if job.status in FINISHED_STATUSES:
+        return False
+    if job.status == JOB_QUEUED:
+        job.status = JOB_CANCELLED
+        job.message = 'Cancelled before start'
+        job.finished_at = datetime.utcnow()
+        _remove_input_files(job.id)
+    job.cancel_requested = True
+    db.session.commit()
+    return True
+
+
+def job_result(job):
+    """Decoded JSON result of a job (None until it succeeded)"""
+    return json.loads(job.result_json) if job.result_json else None
+
+
+@contextmanager
+def _progress_connection():
+    """Connection of its own, so progress commits independently of the job's transaction"""
+    with db.engine.connect() as conn:
+        sqlite = conn.dialect.name == 'sqlite'
+        if sqlite:
+            conn.exec_driver_sql(f'PRAGMA busy_timeout = {SQLITE_PROGRESS_TIMEOUT_MS}')
+        try:
+            yield conn
+        finally:
+            if sqlite:
+                conn.rollback()
+                conn.exec_driver_sql(f'PRAGMA busy_timeout = {SQLITE_DEFAULT_TIMEOUT_MS}')
+
+
+class JobContext:
+    """
+    Handle given to a job handler
+
+    Attributes:
+        job_id: ID of the running job
+        params: Handler parameters from submit_job
+        checkpoint: Last checkpoint saved by an earlier attempt (or None)
+    """
+
+    def __init__(self, job):
+        self.job_id = job.id
+        self.params = json.loads(job.params_json) if job.params_json else {}
+        self.checkpoint = json.loads(job.checkpoint_json) if job.checkpoint_json else None
+        self._last_report = 0.0
+
+    def report(self, percent, message=None, checkpoint=None):
+        """
+        Record progress and check for cancellation
+
+        Writes are throttled to one per JOB_PROGRESS_INTERVAL unless a
+        checkpoint is given. On SQLite a write that would wait for the
+        job's own lock is skipped.
+
+        Args:
+            percent: Completion between 0 and 100
+            message: Short status text
+            checkpoint: JSON-serializable resume point for a later attempt
+
+        Raises:
+            JobCancelled: If cancellation was requested
+        """
+        now = time.monotonic()
+        if checkpoint is None and now - self._last_report < JOB_PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+
+        values = {'progress': min(max(float(percent), 0.0), 100.0), 'heartbeat_at': datetime.utcnow()}
+        if message is not None:
+            values['message'] = message[:255]
+        if checkpoint is not None:
+            values['checkpoint_json'] = json.dumps(checkpoint)
+
+        with _progress_connection() as conn:
+            cancel_requested = conn.execute(select(Job.cancel_requested).where(Job.id == self.job_id)).scalar()
+            try:
+                conn.execute(update(Job).where(Job.id == self.job_id).values(**values))
+                conn.commit()
+            except OperationalError:
+                if conn.dialect.name != 'sqlite':
+                    raise
+                conn.rollback()
+        if cancel_requested:
+            raise JobCancelled()
+
+    def input_files(self):
+        """Uploaded files as (filename, mimetype, path) in upload order"""
+        files = JobFile.query.filter_by(job_id=self.job_id, role='input').order_by(JobFile.position).all()
+        return [(f.filename, f.mimetype, job_file_path(f)) for f in files]
+
+    @contextmanager
+    def result_file(self, filename, mimetype):
+        """Open the job's result file for writing; it is recorded for download when the block exits"""
+        relative_path = f'{self.job_id}/result'
+        path = os.path.join(job_files_dir(), relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out:
+            yield out
+            size = out.tell()
+        JobFile.query.filter_by(job_id=self.job_id, role='result').delete()
+        db.session.add(JobFile(job_id=self.job_id, role='result', filename=filename, mimetype=mimetype,
+                               path=relative_path, size=size))
+        db.session.commit()
+
+
+def _claim_next_job():
+    """Mark the oldest queued job running; returns its ID or None"""
+    job_id = db.session.execute(
+        select(Job.id).where(Job.status == JOB_QUEUED).order_by(Job.id).limit(1)
+    ).scalar()
+    if job_id is None:
+        return None
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        update(Job).where(Job.id == job_id, Job.status == JOB_QUEUED).values(
+            status=JOB_RUNNING, started_at=now, heartbeat_at=now, attempts=Job.attempts + 1
+        )
+    ).rowcount
+    db.session.commit()
+    return job_id if claimed else None
+
+
+def _finish(job_id, status, message=None, error=None, result=None):
+    job = db.session.get(Job, job_id)
+    job.status = status
+    job.message = message
+    job.error = error
+    job.finished_at = datetime.utcnow()
+    if status == JOB_SUCCEEDED:
+        job.progress = 100.0
+        job.result_json = json.dumps(result)
+    _remove_input_files(job_id)
+    db.session.commit()
+
+
+def run_next_job():
+    """
+    Claim and run one queued job
+
+    Returns:
+        bool: True if a job was run
+    """
+    job_id = _claim_next_job()
+    if job_id is None:
+        return False
+
+    job = db.session.get(Job, job_id)
+    context = JobContext(job)
+    handler = JOB_HANDLERS.get(job.type)
+    print(f"\n⚙️  Running job {job.id} ({job.type}, attempt {job.attempts})")
+    try:
+        if handler is None:
+            raise ValueError(f'Unknown job type: {job.type}')
+        result = handler(context)
+    except JobCancelled:
+        db.session.rollback()
+        _finish(job_id, JOB_CANCELLED, message='Cancelled')
+        print(f"   ⚠️  Job {job_id} cancelled")
+    except Exception as e:
+        db.session.rollback()
+        print(f"   ❌ Job {job_id} failed: {e}")
+        import traceback
+        traceback.print_exc()
+        _finish(job_id, JOB_FAILED, error=str(e))
+    else:
+        _finish(job_id, JOB_SUCCEEDED, message='Completed', result=result)
+        print(f"   ✅ Job {job_id} completed")
+    return True
+
+
+def run_pending_jobs():
+    """Run queued jobs until none are left; returns how many ran"""
+    count = 0
+    while run_next_job():
+        count += 1
+    return count
+
+
+def recover_interrupted_jobs():
+    """
+    Requeue jobs left running by a previous worker process
+
+    Only call this from the (single) worker process on startup. Jobs that
+    already used JOB_MAX_ATTEMPTS attempts or were being cancelled are
+    finished instead.
+
+    Returns:
+        int: Number of jobs requeued
+    """
+    requeued = 0
+    now = datetime.utcnow()
+    for job in Job.query.filter_by(status=JOB_RUNNING).all():
+        if job.cancel_requested:
+            job.status, job.message, job.finished_at = JOB_CANCELLED, 'Cancelled', now
+        elif job.attempts >= JOB_MAX_ATTEMPTS:
+            job.status, job.error, job.finished_at = JOB_FAILED, 'Interrupted too many times', now
+            _remove_input_files(job.id)
+        else:
+            job.status, job.message = JOB_QUEUED, 'Requeued after worker restart'
+            requeued += 1
+    db.session.commit()
+    if requeued:
+        print(f"🔁 Requeued {requeued} interrupted job(s)")
+    return requeued
+
+
+def purge_finished_jobs(days=JOB_RETENTION_DAYS):
+    """Delete jobs (and their files) that finished more than `days` days ago"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    job_ids = db.session.execute(
+        select(Job.id).where(Job.status.in_(FINISHED_STATUSES), Job.finished_at < cutoff)
+    ).scalars().all()
+    if not job_ids:
+        return 0
+    db.session.execute(delete(JobFile).where(JobFile.job_id.in_(job_ids)))
+    db.session.execute(delete(Job).where(Job.id.in_(job_ids)))
+    db.session.commit()
+    for job_id in job_ids:
+        shutil.rmtree(os.path.join(job_files_dir(), str(job_id)), ignore_errors=True)
+    return len(job_ids)
+
+
+# ========== HANDLERS ==========
+
+@job_handler('sync_all')
+def sync_all_job(context):
+    """Sync every wallet with Octav.fi"""
+    def progress(done, total):
+        context.report(100.0 * done / total, f'{done}/{total} wallets synced')
+
+    results = OctavService.sync_all_wallets(progress=progress)
+    return {key: value for key, value in results.items() if key != 'latency'}
+
+
+@job_handler('backup_export')
+def backup_export_job(context):
+    """Write a gzipped NDJSON backup (params: since) as the result file"""
+    since = parse_timestamp(context.params['since']) if context.params.get('since') else None
+    histories = BalanceHistory.query
+    if since is not None:
+        histories = histories.filter(BalanceHistory.created_at > since - BACKUP_OVERLAP)
+    total = histories.count()
+    summary = {}
+    written = 0
+
+    def tracked(records):
+        nonlocal written
+        for record in records:
+            if record['type'] == 'balance_history':
+                written += 1
+                if written % EXPORT_CHUNK_SIZE == 0:
+                    context.report(95.0 * written / max(total, written), f'{written}/{total} balance records')
+            elif record['type'] == 'header':
+                summary.update(kind=record['kind'], since=record['since'], watermark=record['watermark'])
+            elif record['type'] == 'footer':
+                summary['counts'] = record['counts']
+            yield record
+
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    kind = BACKUP_KIND_INCREMENTAL if since is not None else BACKUP_KIND_FULL
+    with context.result_file(f'wallet_tracker_backup_{timestamp}_{kind}.ndjson.gz', 'application/gzip') as out:
+        for chunk in gzip_stream(ndjson_lines(tracked(iter_backup_records(since=since)))):
+            out.write(chunk)
+    return summary
+
+
+@job_handler('backup_archive')
+def backup_archive_job(context):
+    """Write a zip archive backup as the result file"""
+    def progress(done, total):
+        context.report(95.0 * done / total, f'{done}/{total} tables dumped')
+
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    with context.result_file(f'wallet_tracker_archive_{timestamp}.zip', 'application/zip') as out:
+        manifest = write_archive(out, progress=progress)
+    return {'rows': {name: entry['rows'] for name, entry in manifest['tables'].items()}}
+
+
+@job_handler('backup_import', needs_files=True)
+def backup_import_job(context):
+    """
+    Import a chain of NDJSON backups (params: resume_from for the first file)
+
+    Checkpoints the file and line of every committed chunk, so an
+    interrupted attempt continues where the previous one stopped. Progress
+    is the share of the uploaded bytes read so far.
+    """
+    files = context.input_files()
+    headers = []
+    for _, _, path in files:
+        with open(path, 'rb') as stream:
+            headers.append(read_backup_header(stream))
+    validate_backup_chain(headers)
+    sizes = [os.path.getsize(path) for _, _, path in files]
+    total_bytes = max(sum(sizes), 1)
+
+    checkpoint = context.checkpoint or {'file': 0, 'line': context.params.get('resume_from', 0), 'imported': []}
+    imported = checkpoint['imported']
+    for index in range(checkpoint['file'], len(files)):
+        filename, _, path = files[index]
+        with open(path, 'rb') as stream:
+            def progress(counts, index=index, filename=filename, stream=stream):
+                read = sum(sizes[:index]) + stream.tell()
+                context.report(100.0 * read / total_bytes,
+                               f"{filename}: line {counts['committed_line']}, {read // 1048576}/{total_bytes // 1048576} MB read",
+                               checkpoint={'file': index, 'line': counts['committed_line'], 'imported': imported})
+
+            importer = BackupImporter(resume_from=checkpoint['line'] if index == checkpoint['file'] else 0,
+                                      progress=progress)
+            result = importer.run(iter_ndjson_records(stream))
+        imported.append(dict(result, file=filename))
+        context.report(100.0 * sum(sizes[:index + 1]) / total_bytes, f'{filename} imported',
+                       checkpoint={'file': index + 1, 'line': 0, 'imported': imported})
+    return {'imported': imported}
+
+
+@job_handler('archive_restore', needs_files=True)
+def archive_restore_job(context):
+    """Verify and restore a zip archive backup into a database without wallets"""
+    (filename, _, path), = context.input_files()
+    with zipfile.ZipFile(path) as archive:
+        total_rows = max(sum(entry['rows'] for entry in read_manifest(archive)['tables'].values()), 1)
+        if db.session.query(Wallet.id).first() is not None:
+            raise ValueError('Archive restore needs a database without wallets')
+        restored = {}
+
+        def progress(table_name, rows):
+            restored[table_name] = rows
+            context.report(95.0 * sum(restored.values()) / total_rows, f'Restoring {table_name}')
+
+        context.report(0.0, f'Verifying {filename}')
+        return {'rows': restore_archive(archive, progress=progress)}
+
+
+@contextmanager
+def _upload_rows(context, json_key):
+    """Rows of the job's staged CSV or JSON upload, reporting the share of bytes read"""
+    (filename, mimetype, path), = context.input_files()
+    size = max(os.path.getsize(path), 1)
+    with open(path, 'rb') as stream:
+        def rows():
+            for row_number, row in iter_file_rows(stream, mimetype, json_key):
+                context.report(90.0 * stream.tell() / size, f'{filename}: row {row_number}')
+                yield row_number, row
+        yield rows()
+
+
+def _job_wallet(context):
+    wallet = db.session.get(Wallet, context.params.get('wallet_id'))
+    if wallet is None:
+        raise ValueError('Wallet not found')
+    return wallet
+
+
+@job_handler('cash_flow_import', needs_files=True)
+def cash_flow_import_job(context):
+    """Import an uploaded cash flow CSV or JSON array (params: wallet_id), all or nothing"""
+    wallet = _job_wallet(context)
+    with _upload_rows(context, 'cash_flows') as rows:
+        result = import_cash_flow_rows(wallet, rows)
+    db.session.commit()
+    return result
+
+
+@job_handler('manual_balance_import', needs_files=True)
+def manual_balance_import_job(context):
+    """Upsert an uploaded manual balance CSV or JSON array (params: wallet_id)"""
+    wallet = _job_wallet(context)
+    with _upload_rows(context, 'manual_balances') as rows:
+        result = import_manual_balance_rows(wallet, rows)
+    db.session.commit()
+    return result
+
+
+@job_handler('rollup_backfill')
+def rollup_backfill_job(context):
+    """Rebuild the networth rollups of every wallet (queued by migration 2)"""
+    wallets = Wallet.query.order_by(Wallet.id).all()
+    for index, wallet in enumerate(wallets):
+        context.report(100.0 * index / max(len(wallets), 1), f'{index}/{len(wallets)} wallets')
+        rebuild_rollups(wallet)
+        db.session.commit()
+    return {'wallets': len(wallets)}
+
+
+@job_handler('nav_backfill')
+def nav_backfill_job(context):
+    """Materialize the NAV series of wallets that have none yet (queued by migration 8)"""
+    wallets = Wallet.query.order_by(Wallet.id).all()
+    rebuilt = 0
+    for index, wallet in enumerate(wallets):
+        context.report(100.0 * index / max(len(wallets), 1), f'{index}/{len(wallets)} wallets')
+        if nav_materialized(wallet.id):
+            continue
+        if rebuild_nav(wallet):
+            rebuilt += 1
+        db.session.commit()
+    return {'wallets': len(wallets), 'rebuilt': rebuilt}
+
+
+@job_handler('payload_migration')
+def payload_migration_job(context):
+    """
+    Move inline balance_history.data_json payloads into balance_payloads (queued by migration 5)
+
+    Commits and checkpoints every PAYLOAD_MIGRATION_BATCH rows; rows that
+    already have a payload are only cleared, so reruns are safe.
+    """
+    history = BalanceHistory.__table__
+    payloads = BalancePayload.__table__
+    last_id = (context.checkpoint or {}).get('last_id', 0)
+    max_id = db.session.execute(select(db.func.max(history.c.id))).scalar() or 0
+    moved = (context.checkpoint or {}).get('moved', 0)
+
+    while True:
+        rows = db.session.execute(
+            select(history.c.id, history.c.data_json)
+            .where(history.c.id > last_id, history.c.data_json != '')
+            .order_by(history.c.id)
+            .limit(PAYLOAD_MIGRATION_BATCH)
+        ).all()
+        if not rows:
+            break
+
+        ids = [row.id for row in rows]
+        already_moved = set(db.session.execute(
+            select(payloads.c.balance_history_id).where(payloads.c.balance_history_id.in_(ids))
+        ).scalars())
+        new_rows = []
+        for row in rows:
+            if row.id in already_moved:
+                continue
+            codec, raw_size, blob = BalancePayload.compress(row.data_json)
+            new_rows.append({'balance_history_id': row.id, 'codec': codec, 'raw_size': raw_size, 'payload': blob})
+        if new_rows:
+            db.session.execute(payloads.insert(), new_rows)
+        db.session.execute(update(history).where(history.c.id.in_(ids)).values(data_json=''))
+        db.session.commit()
+
+        moved += len(new_rows)
+        last_id = ids[-1]
+        context.report(100.0 * last_id / max(max_id, 1), f'{moved} payloads moved',
+                       checkpoint={'last_id': last_id, 'moved': moved})
+    return {'moved': moved}
@@ -1,13 +1,44 @@
 import requests
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from src.models.models import db, Wallet, BalanceHistory, ProtocolBalance, TokenBalance, AppSettings
+from email.utils import parsedate_to_datetime
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from src.models.models import db, Wallet, BalanceHistory, AppSettings
+from src.services.rate_limiter import get_host_limiter
+from src.services.snapshot_store import flatten_portfolio, payload_hash, write_snapshot_rows
+from src.services.wallet_state import record_snapshot
 
 
 class OctavService:
     """Service for interacting with Octav.fi API"""
     
     BASE_URL = "https://api.octav.fi"
+    DEFAULT_SYNC_BATCH_SIZE = 20
+    DEFAULT_SYNC_CONCURRENCY = 4
+    DEFAULT_RATE_LIMIT_PER_MINUTE = 60
+    RATE_LIMIT_BURST = 5
+    
+    # HTTP client tuning
+    CONNECT_TIMEOUT = 5  # seconds to establish TCP+TLS
+    READ_TIMEOUT = 30  # seconds to wait for the response body
+    POOL_SIZE = 16  # keep-alive connections kept per host
+    MAX_RETRIES = 4
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    BACKOFF_BASE = 1.0  # seconds, doubled on every attempt
+    BACKOFF_MAX = 30.0
+    RETRY_AFTER_MAX = 120.0
+    # Total time a request-time sync may spend on the API, well inside
+    # gunicorn's 300s worker timeout
+    REQUEST_SYNC_DEADLINE = 120.0
+    
+    _session = None
+    _session_lock = threading.Lock()
+    _rate_limiter = None
     
     @staticmethod
     def get_api_key():
@@ -16,13 +47,98 @@ class OctavService:
         return setting.value if setting else None
     
     @staticmethod
-    def fetch_portfolio(addresses, wait_for_sync=True):
+    def _get_positive_int_setting(key, default):
+        """Read a positive integer setting, falling back to default"""
+        setting = AppSettings.query.filter_by(key=key).first()
+        if setting and setting.value:
+            try:
+                return max(1, int(setting.value))
+            except ValueError:
+                pass
+        return default
+    
+    @staticmethod
+    def get_sync_batch_size():
+        """Get number of addresses per portfolio request from settings, default 20"""
+        return OctavService._get_positive_int_setting('sync_batch_size', OctavService.DEFAULT_SYNC_BATCH_SIZE)
+    
+    @staticmethod
+    def get_sync_concurrency():
+        """Get number of concurrent sync workers from settings, default 4"""
+        return OctavService._get_positive_int_setting('sync_concurrency', OctavService.DEFAULT_SYNC_CONCURRENCY)
+    
+    @staticmethod
+    def get_rate_limiter():
+        """
+        Get the process-wide rate limiter for the Octav API host
+        
+        The rate setting is read once per process (the shared host limiter
+        keeps its first rate anyway); changes apply after a restart.
+        """
+        with OctavService._session_lock:
+            if OctavService._rate_limiter is None:
+                rate = OctavService._get_positive_int_setting(
+                    'octav_rate_limit_per_minute', OctavService.DEFAULT_RATE_LIMIT_PER_MINUTE
+                )
+                OctavService._rate_limiter = get_host_limiter(OctavService.BASE_URL, rate, OctavService.RATE_LIMIT_BURST)
+            return OctavService._rate_limiter
+    
+    @staticmethod
+    def get_session():
+        """Get the long-lived pooled HTTP session shared by all threads"""
+        with OctavService._session_lock:
+            if OctavService._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=OctavService.POOL_SIZE,
+                    pool_maxsize=OctavService.POOL_SIZE,
+                    max_retries=0  # Retries are handled in fetch_portfolio
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                    'Accept': 'application/json',
+                    'Accept-Encoding': 'gzip, deflate',
+                    'Connection': 'keep-alive'
+                })
+                OctavService._session = session
+            return OctavService._session
+    
+    @staticmethod
+    def _parse_retry_after(response):
+        """Get the Retry-After delay in seconds from a response, if any"""
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    
+    @staticmethod
+    def _backoff_delay(attempt, retry_after=None):
+        """Exponential backoff with full jitter, never shorter than Retry-After"""
+        delay = random.uniform(0, min(OctavService.BACKOFF_MAX, OctavService.BACKOFF_BASE * (2 ** attempt)))
+        if retry_after is not None:
+            delay = min(OctavService.RETRY_AFTER_MAX, retry_after) + random.uniform(0, OctavService.BACKOFF_BASE)
+        return delay
+    
+    @staticmethod
+    def fetch_portfolio(addresses, wait_for_sync=True, deadline=None):
         """
         Fetch portfolio data from Octav.fi API
         
         Args:
             addresses: Comma-separated list of wallet addresses or single address
             wait_for_sync: If True, wait for fresh data
+            deadline: Optional time.monotonic() value bounding all attempts,
+                      rate limiting and backoff together; no attempt or wait
+                      is started that would run past it
             
         Returns:
             dict: API response data or None if error
@@ -47,19 +163,61 @@ class OctavService:
             'waitForSync': 'true' if wait_for_sync else 'false'
         }
         
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching portfolio from Octav API: {e}")
-            return None
+        session = OctavService.get_session()
+        limiter = OctavService.get_rate_limiter()
+        timeout = (OctavService.CONNECT_TIMEOUT, OctavService.READ_TIMEOUT)
+        error = None
+        
+        for attempt in range(OctavService.MAX_RETRIES + 1):
+            if not limiter.acquire(deadline):
+                error = error or "rate limit wait exceeds deadline"
+                break
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= OctavService.CONNECT_TIMEOUT:
+                    error = error or "deadline exceeded"
+                    break
+                timeout = (OctavService.CONNECT_TIMEOUT, min(OctavService.READ_TIMEOUT, remaining - OctavService.CONNECT_TIMEOUT))
+            retry_after = None
+            
+            try:
+                response = session.get(url, headers=headers, params=params, timeout=timeout)
+                if response.status_code not in OctavService.RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.json()
+                error = f"HTTP {response.status_code}"
+                retry_after = OctavService._parse_retry_after(response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = str(e)
+            except requests.exceptions.RequestException as e:
+                # Other client errors (4xx, invalid response) are not retried
+                print(f"Error fetching portfolio from Octav API: {e}")
+                return None
+            
+            if attempt == OctavService.MAX_RETRIES:
+                break
+            
+            delay = OctavService._backoff_delay(attempt, retry_after)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                print(f"Octav API request failed ({error}), no time left to retry before the deadline")
+                break
+            print(f"Octav API request failed ({error}), retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 1}/{OctavService.MAX_RETRIES})")
+            time.sleep(delay)
+        
+        print(f"Error fetching portfolio from Octav API after {attempt + 1} attempts: {error}")
+        return None
     
     @staticmethod
     def save_balance_snapshot(wallet_id, portfolio_data):
         """
         Save balance snapshot to database
         
+        If the normalized payload is identical to the wallet's previous
+        snapshot, only a heartbeat row (timestamp, networth and a reference
+        to the full snapshot) is written instead of duplicating the payload,
+        protocol and token rows.
+        
         Args:
             wallet_id: Wallet database ID
             portfolio_data: Single wallet portfolio data from API
@@ -70,78 +228,97 @@ class OctavService:
         if not portfolio_data:
             return None
         
+        wallet = db.session.get(Wallet, wallet_id)
+        networth = float(portfolio_data.get('networth', 0))
+        content_hash = payload_hash(portfolio_data)
+        
+        if wallet.latest_balance_id:
+            previous = db.session.get(BalanceHistory, wallet.latest_balance_id)
+        else:
+            previous = BalanceHistory.query.filter_by(wallet_id=wallet_id)\
+                .order_by(BalanceHistory.timestamp.desc()).first()
+        
+        if previous and previous.content_hash == content_hash:
+            heartbeat = BalanceHistory(
+                wallet_id=wallet_id,
+                timestamp=datetime.utcnow(),
+                networth=networth,
+                content_hash=content_hash,
+                heartbeat_of_id=previous.snapshot_id
+            )
+            db.session.add(heartbeat)
+            db.session.flush()
+            record_snapshot(wallet, heartbeat)
+            db.session.commit()
+            return heartbeat
+        
+        # Flatten the payload up front so a malformed snapshot fails before any write
+        protocol_rows, token_rows = flatten_portfolio(portfolio_data)
+        
         # Create balance history record
         balance_history = BalanceHistory(
             wallet_id=wallet_id,
             timestamp=datetime.utcnow(),
-            networth=float(portfolio_data.get('networth', 0)),
-            data_json=json.dumps(portfolio_data)
+            networth=networth,
+            content_hash=content_hash
         )
+        balance_history.raw_json = json.dumps(portfolio_data)
         db.session.add(balance_history)
         db.session.flush()  # Get the ID
         
-        # Extract and save protocol balances
-        asset_by_protocols = portfolio_data.get('assetByProtocols', {})
-        for protocol_key, protocol_data in asset_by_protocols.items():
-            # Get total value for this protocol across all chains
-            protocol_value = float(protocol_data.get('value', 0))
-            
-            # Save protocol balance
-            protocol_balance = ProtocolBalance(
-                balance_history_id=balance_history.id,
-                protocol_name=protocol_data.get('name', protocol_key),
-                protocol_key=protocol_key,
-                value=protocol_value,
-                chain=None  # Aggregated across chains
-            )
-            db.session.add(protocol_balance)
-            
-            # Extract tokens from each chain
-            chains = protocol_data.get('chains', {})
-            for chain_key, chain_data in chains.items():
-                protocol_positions = chain_data.get('protocolPositions', {})
-                
-                for position_type, position_data in protocol_positions.items():
-                    # Get assets from this position
-                    assets = position_data.get('assets', [])
-                    for asset in assets:
-                        token_balance = TokenBalance(
-                            balance_history_id=balance_history.id,
-                            token_symbol=asset.get('symbol', ''),
-                            token_name=asset.get('name', ''),
-                            balance=str(asset.get('balance', '0')),
-                            value=float(asset.get('value', 0)),
-                            price=float(asset.get('price', 0)),
-                            chain=chain_key,
-                            protocol=protocol_key
-                        )
-                        db.session.add(token_balance)
-                    
-                    # Also check for reward assets in farming positions
-                    reward_assets = position_data.get('rewardAssets', [])
-                    for asset in reward_assets:
-                        token_balance = TokenBalance(
-                            balance_history_id=balance_history.id,
-                            token_symbol=asset.get('symbol', ''),
-                            token_name=asset.get('name', ''),
-                            balance=str(asset.get('balance', '0')),
-                            value=float(asset.get('value', 0)),
-                            price=float(asset.get('price', 0)),
-                            chain=chain_key,
-                            protocol=f"{protocol_key}_rewards"
-                        )
-                        db.session.add(token_balance)
+        # Bulk insert protocol and token balances in the same transaction
+        write_snapshot_rows(balance_history, protocol_rows, token_rows, previous)
+        record_snapshot(wallet, balance_history)
         
         db.session.commit()
         return balance_history
     
     @staticmethod
-    def sync_wallet(wallet_id):
+    def portfolios_by_address(portfolio_data):
+        """
+        Index a portfolio API response by wallet address
+        
+        Args:
+            portfolio_data: API response (list of portfolios or single portfolio dict)
+            
+        Returns:
+            dict: {address: portfolio} with both original and lower-cased address keys
+        """
+        if isinstance(portfolio_data, dict):
+            portfolio_data = [portfolio_data]
+        if not isinstance(portfolio_data, list):
+            return {}
+        
+        by_address = {}
+        for item in portfolio_data:
+            if not isinstance(item, dict) or not item.get('address'):
+                continue
+            address = str(item['address'])
+            by_address[address] = item
+            by_address.setdefault(address.lower(), item)
+        return by_address
+    
+    @staticmethod
+    def store_wallet_snapshot(wallet, wallet_data):
+        """
+        Save a fetched portfolio for a wallet and mark it as synced
+        
+        Args:
+            wallet: Wallet model instance
+            wallet_data: Single wallet portfolio data from API
+        """
+        wallet.last_synced = datetime.utcnow()
+        # Commits the snapshot and last_synced together
+        OctavService.save_balance_snapshot(wallet.id, wallet_data)
+    
+    @staticmethod
+    def sync_wallet(wallet_id, deadline=None):
         """
         Sync a single wallet with Octav API
         
         Args:
             wallet_id: Wallet database ID
+            deadline: Optional time.monotonic() value bounding the API calls
             
         Returns:
             bool: True if successful, False otherwise
@@ -152,7 +329,7 @@ class OctavService:
         
         try:
             # Fetch portfolio data
-            portfolio_data = OctavService.fetch_portfolio(wallet.address)
+            portfolio_data = OctavService.fetch_portfolio(wallet.address, deadline=deadline)
             if not portfolio_data:
                 return False
             
@@ -166,12 +343,8 @@ class OctavService:
             else:
                 return False
             
-            # Save snapshot
-            OctavService.save_balance_snapshot(wallet_id, wallet_data)
-            
-            # Update wallet last_synced timestamp
-            wallet.last_synced = datetime.utcnow()
-            db.session.commit()
+            # Save snapshot and update wallet last_synced timestamp
+            OctavService.store_wallet_snapshot(wallet, wallet_data)
             
             return True
         except Exception as e:
@@ -180,31 +353,135 @@ class OctavService:
             return False
     
     @staticmethod
-    def sync_all_wallets():
+    def _sync_batch(app, batch):
+        """
+        Fetch and store one batch of wallets inside a worker thread
+        
+        The batch request runs in its own app context, and each wallet's
+        snapshot is written in a fresh app context (and therefore a fresh
+        db.session) so a failing wallet cannot poison the others. If the
+        batch request itself fails (after its retries), every wallet in the
+        batch is marked failed; only addresses missing from a successful
+        response are fetched on their own.
+        
+        Args:
+            app: Flask application
+            batch: List of (wallet_id, address) tuples
+            
+        Returns:
+            dict: Partial sync results for this batch
+        """
+        results = {'success': 0, 'failed': 0, 'errors': [], 'requests': 1, 'latency': {}}
+        started = time.monotonic()
+        
+        batch_error = None
+        with app.app_context():
+            try:
+                portfolio_data = OctavService.fetch_portfolio([address for _, address in batch])
+                if portfolio_data is None:
+                    batch_error = "batch request failed"
+                by_address = OctavService.portfolios_by_address(portfolio_data)
+                # A single-address response may come back without an address field
+                if len(batch) == 1 and not by_address and portfolio_data:
+                    single = portfolio_data[0] if isinstance(portfolio_data, list) else portfolio_data
+                    by_address = {batch[0][1]: single}
+            except Exception as e:
+                print(f"Error fetching batch of {len(batch)} wallets: {e}")
+                batch_error = str(e)
+        
+        if batch_error is not None:
+            # Retrying each wallet alone would multiply the failed request
+            results['failed'] += len(batch)
+            results['errors'] += [f"Failed to sync wallet {address}: {batch_error}" for _, address in batch]
+            latency = round(time.monotonic() - started, 3)
+            results['latency'] = {address: latency for _, address in batch}
+            return results
+        
+        for wallet_id, address in batch:
+            wallet_data = by_address.get(address) or by_address.get(address.lower())
+            with app.app_context():
+                try:
+                    if wallet_data is not None:
+                        wallet = Wallet.query.get(wallet_id)
+                        OctavService.store_wallet_snapshot(wallet, wallet_data)
+                        success = True
+                    else:
+                        # Address missing from batch response - fetch it on its own
+                        results['requests'] += 1
+                        success = OctavService.sync_wallet(wallet_id)
+                    
+                    if success:
+                        results['success'] += 1
+                    else:
+                        results['failed'] += 1
+                        results['errors'].append(f"Failed to sync wallet {address}")
+                except Exception as e:
+                    db.session.rollback()
+                    results['failed'] += 1
+                    results['errors'].append(f"Error syncing wallet {address}: {str(e)}")
+            
+            # Seconds from the batch request until this wallet was stored
+            results['latency'][address] = round(time.monotonic() - started, 3)
+        
+        return results
+    
+    @staticmethod
+    def sync_all_wallets(batch_size=None, concurrency=None, progress=None):
         """
         Sync all wallets with Octav API
         
+        Wallets are fetched in batches of `batch_size` addresses per request,
+        with up to `concurrency` batches in flight at once. Requests share the
+        per-host rate limiter. Each returned portfolio is matched back to its
+        wallet by address; wallets missing from a successful batch response
+        fall back to a single-wallet fetch, while a failed batch request marks
+        all of its wallets failed.
+        
+        Args:
+            batch_size: Addresses per request (defaults to the sync_batch_size setting)
+            concurrency: Worker threads (defaults to the sync_concurrency setting)
+            progress: Optional callable receiving (wallets done, total wallets)
+                      after each batch
+            
         Returns:
-            dict: Summary of sync results
+            dict: Summary of sync results, including per-wallet latency in seconds
         """
-        wallets = Wallet.query.all()
+        if batch_size is None:
+            batch_size = OctavService.get_sync_batch_size()
+        if concurrency is None:
+            concurrency = OctavService.get_sync_concurrency()
+        batch_size = max(1, int(batch_size))
+        concurrency = max(1, int(concurrency))
+        
+        app = current_app._get_current_object()
+        wallets = [(w.id, w.address) for w in Wallet.query.all()]
         results = {
             'total': len(wallets),
             'success': 0,
             'failed': 0,
-            'errors': []
+            'errors': [],
+            'requests': 0,
+            'latency': {}
         }
+        if not wallets:
+            return results
         
-        for wallet in wallets:
-            try:
-                if OctavService.sync_wallet(wallet.id):
-                    results['success'] += 1
-                else:
-                    results['failed'] += 1
-                    results['errors'].append(f"Failed to sync wallet {wallet.address}")
-            except Exception as e:
-                results['failed'] += 1
-                results['errors'].append(f"Error syncing wallet {wallet.address}: {str(e)}")
+        # Make sure the shared limiter exists before workers start
+        OctavService.get_rate_limiter()
+        
+        batches = [wallets[i:i + batch_size] for i in range(0, len(wallets), batch_size)]
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='octav-sync') as executor:
+            for batch_results in executor.map(lambda batch: OctavService._sync_batch(app, batch), batches):
+                results['success'] += batch_results['success']
+                results['failed'] += batch_results['failed']
+                results['errors'].extend(batch_results['errors'])
+                results['requests'] += batch_results['requests']
+                results['latency'].update(batch_results['latency'])
+                if progress:
+                    progress(results['success'] + results['failed'], results['total'])
+        
+        latencies = list(results['latency'].values())
+        results['latency_avg'] = round(sum(latencies) / len(latencies), 3)
+        results['latency_max'] = max(latencies)
         
         return results
-
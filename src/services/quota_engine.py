@@ -0,0 +1,421 @@
+"""
+Quota valuation engine.
+
+Values a wallet's quota over time by merging its sorted balance series with
+its sorted cash-flow stream, keeping a running quota quantity instead of
+re-summing every cash flow for every balance point. The result is
+materialized per balance point in NavHistory and kept up to date
+incrementally. Backdated cash flow changes are replayed from the affected
+timestamp forward.
+"""
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, case, func, select, update
+
+from src.models.models import db, BalanceHistory, CashFlow, NavHistory, QuotaHistory
+from src.models.manual_balance import ManualBalance
+from src.services.response_cache import bump_data_version
+
+# Tolerance for float error when a cash out redeems every outstanding quota
+QUANTITY_EPSILON = 1e-9
+
+
+def signed_quotas():
+    """SQL expression for a cash flow's effect on quota quantity"""
+    return case((CashFlow.type == 'in', CashFlow.quotas_issued), else_=-CashFlow.quotas_issued)
+
+
+def quota_quantity_before(wallet_id, timestamp):
+    """Quota quantity from all cash flows strictly before `timestamp`"""
+    total = db.session.query(func.coalesce(func.sum(signed_quotas()), 0.0))\
+        .filter(CashFlow.wallet_id == wallet_id, CashFlow.timestamp < timestamp)\
+        .scalar()
+    return float(total or 0.0)
+
+
+def load_balance_series(wallet_id, since=None, limit=None):
+    """
+    Load merged automatic and manual balance points in ascending order
+
+    Args:
+        wallet_id: Wallet database ID
+        since: Only include points at or after this datetime
+        limit: Keep only the most recent `limit` points
+
+    Returns:
+        list: [{'timestamp', 'networth', 'source'}] sorted by timestamp
+    """
+    auto_query = db.session.query(BalanceHistory.timestamp, BalanceHistory.networth)\
+        .filter(BalanceHistory.wallet_id == wallet_id)
+    manual_query = db.session.query(ManualBalance.timestamp, ManualBalance.networth)\
+        .filter(ManualBalance.wallet_id == wallet_id)
+    if since is not None:
+        auto_query = auto_query.filter(BalanceHistory.timestamp >= since)
+        manual_query = manual_query.filter(ManualBalance.timestamp >= since)
+    if limit:
+        auto_query = auto_query.order_by(BalanceHistory.timestamp.desc()).limit(limit)
+        manual_query = manual_query.order_by(ManualBalance.timestamp.desc()).limit(limit)
+
+    balances = [{'timestamp': ts, 'networth': networth, 'source': 'automatic'} for ts, networth in auto_query]
+    balances += [{'timestamp': ts, 'networth': networth, 'source': 'manual'} for ts, networth in manual_query]
+    balances.sort(key=lambda x: x['timestamp'])
+
+    if limit:
+        balances = balances[-limit:]
+    return balances
+
+
+def compute_quota_series(balances, cash_flows, initial_quota_value, start_quantity=0.0):
+    """
+    Value each balance point in one merged pass over balances and cash flows
+
+    A cash flow counts towards a balance point when it happened at or before
+    the point's timestamp. When no quotas are outstanding the quota value is
+    the wallet's initial quota value.
+
+    Args:
+        balances: Balance points sorted by timestamp (dicts with timestamp, networth, source)
+        cash_flows: Cash flows sorted by timestamp (objects or rows with timestamp, type, quotas_issued)
+        initial_quota_value: Wallet's initial quota value
+        start_quantity: Quota quantity from cash flows before the first balance point
+
+    Returns:
+        list: [{'timestamp', 'quota_value', 'networth', 'quota_quantity', 'source'}]
+    """
+    series = []
+    quantity = start_quantity
+    flow_index = 0
+    flow_count = len(cash_flows)
+
+    for balance in balances:
+        while flow_index < flow_count and cash_flows[flow_index].timestamp <= balance['timestamp']:
+            flow = cash_flows[flow_index]
+            quantity += flow.quotas_issued if flow.type == 'in' else -flow.quotas_issued
+            flow_index += 1
+
+        if quantity > 0:
+            quota_value = balance['networth'] / quantity
+        else:
+            quota_value = initial_quota_value
+
+        series.append({
+            'timestamp': balance['timestamp'],
+            'quota_value': quota_value,
+            'networth': balance['networth'],
+            'quota_quantity': quantity,
+            'source': balance['source']
+        })
+
+    return series
+
+
+def quota_series(wallet, since=None, limit=None):
+    """
+    Quota value series computed from the raw balance points and cash flows
+
+    Used for wallets whose NAV points are not materialized yet.
+
+    Args:
+        wallet: Wallet model instance
+        since: Only include balance points at or after this datetime
+        limit: Keep only the most recent `limit` balance points
+
+    Returns:
+        list: Series points as returned by compute_quota_series
+    """
+    balances = load_balance_series(wallet.id, since=since, limit=limit)
+    if not balances:
+        return []
+
+    window_start = balances[0]['timestamp']
+    window_end = balances[-1]['timestamp']
+    start_quantity = quota_quantity_before(wallet.id, window_start)
+
+    cash_flows = db.session.query(CashFlow.timestamp, CashFlow.type, CashFlow.quotas_issued)\
+        .filter(
+            CashFlow.wallet_id == wallet.id,
+            CashFlow.timestamp >= window_start,
+            CashFlow.timestamp <= window_end
+        ).order_by(CashFlow.timestamp).all()
+
+    return compute_quota_series(balances, cash_flows, wallet.initial_quota_value, start_quantity)
+
+
+def cash_flow_totals(wallet_id):
+    """Total cash in and cash out amounts for a wallet"""
+    total_in, total_out = db.session.query(
+        func.coalesce(func.sum(case((CashFlow.type == 'in', CashFlow.amount), else_=0.0)), 0.0),
+        func.coalesce(func.sum(case((CashFlow.type == 'out', CashFlow.amount), else_=0.0)), 0.0)
+    ).filter(CashFlow.wallet_id == wallet_id).one()
+    return float(total_in), float(total_out)
+
+
+def rebuild_nav(wallet, since=None):
+    """
+    Recompute materialized NAV points from `since` forward
+
+    Deletes the wallet's NAV rows at or after `since` (all rows when None)
+    and re-values the balance points in that range, seeded with the quota
+    quantity outstanding just before `since`. Does not commit.
+    """
+    delete_query = NavHistory.query.filter(NavHistory.wallet_id == wallet.id)
+    if since is not None:
+        delete_query = delete_query.filter(NavHistory.timestamp >= since)
+    delete_query.delete(synchronize_session=False)
+
+    balances = load_balance_series(wallet.id, since=since)
+    if not balances:
+        return 0
+
+    start_quantity = quota_quantity_before(wallet.id, balances[0]['timestamp'])
+    cash_flows = db.session.query(CashFlow.timestamp, CashFlow.type, CashFlow.quotas_issued)\
+        .filter(CashFlow.wallet_id == wallet.id, CashFlow.timestamp >= balances[0]['timestamp'])\
+        .order_by(CashFlow.timestamp).all()
+
+    series = compute_quota_series(balances, cash_flows, wallet.initial_quota_value, start_quantity)
+    for point in series:
+        point['wallet_id'] = wallet.id
+    db.session.execute(NavHistory.__table__.insert(), series)
+    return len(series)
+
+
+def append_nav_point(wallet, timestamp, networth, source):
+    """
+    Materialize the NAV point for a newly recorded (and flushed) balance
+
+    Points at or after the last NAV row are valued from that row's quantity
+    plus the cash flows in between. Backdated points re-value everything from
+    their timestamp forward, and a wallet without NAV rows is materialized in
+    full. Does not commit.
+    """
+    last = NavHistory.query.filter_by(wallet_id=wallet.id)\
+        .order_by(NavHistory.timestamp.desc(), NavHistory.id.desc()).first()
+
+    if last is None or timestamp < last.timestamp:
+        rebuild_nav(wallet, since=None if last is None else timestamp)
+        return
+
+    flows_since_last = db.session.query(func.coalesce(func.sum(signed_quotas()), 0.0))\
+        .filter(
+            CashFlow.wallet_id == wallet.id,
+            CashFlow.timestamp > last.timestamp,
+            CashFlow.timestamp <= timestamp
+        ).scalar()
+    quantity = last.quota_quantity + float(flows_since_last or 0.0)
+
+    db.session.add(NavHistory(
+        wallet_id=wallet.id,
+        timestamp=timestamp,
+        networth=networth,
+        quota_quantity=quantity,
+        quota_value=networth / quantity if quantity > 0 else wallet.initial_quota_value,
+        source=source
+    ))
+
+
+def nav_materialized(wallet_id):
+    """True if the wallet has NAV points (they are then kept current on every write)"""
+    return db.session.query(NavHistory.id).filter(NavHistory.wallet_id == wallet_id).first() is not None
+
+
+def read_nav_series(wallet, days=None, limit=None):
+    """
+    Quota series for a recent window, in the shape of compute_quota_series
+
+    Served from an indexed range read of NavHistory; wallets whose history
+    predates NavHistory are valued on the fly with quota_series.
+    """
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    if not nav_materialized(wallet.id):
+        return quota_series(wallet, since=since, limit=limit)
+
+    query = NavHistory.query.filter(NavHistory.wallet_id == wallet.id)
+    if since is not None:
+        query = query.filter(NavHistory.timestamp >= since)
+    query = query.order_by(NavHistory.timestamp.desc(), NavHistory.id.desc())
+    if limit:
+        query = query.limit(limit)
+
+    return [{
+        'timestamp': point.timestamp,
+        'quota_value': point.quota_value,
+        'networth': point.networth,
+        'quota_quantity': point.quota_quantity,
+        'source': point.source
+    } for point in reversed(query.all())]
+
+
+def _price_points(model, wallet_id, since, until):
+    """
+    Sorted balance points of one source for pricing cash flows in [since, until]
+
+    Includes the last point before `since` so the first flow in the range
+    can be priced without another query.
+    """
+    query = db.session.query(model.timestamp, model.networth)\
+        .filter(model.wallet_id == wallet_id, model.timestamp <= until)
+    rows = []
+    if since is not None:
+        before = query.filter(model.timestamp < since).order_by(model.timestamp.desc()).first()
+        if before:
+            rows.append(before)
+        query = query.filter(model.timestamp >= since)
+    rows += query.order_by(model.timestamp).all()
+    return [row.timestamp for row in rows], [row.networth for row in rows]
+
+
+def _networth_at(points, timestamp):
+    """Networth of the latest point at or before `timestamp`, or None"""
+    timestamps, networths = points
+    index = bisect_right(timestamps, timestamp)
+    return networths[index - 1] if index else None
+
+
+def flow_networths(wallet_id, timestamps):
+    """
+    Balance each cash flow is priced against, as add_cash_flow looks it up
+
+    The latest automatic balance at or before each timestamp, else the
+    latest manual balance, else None. Reads each balance source once.
+
+    Args:
+        wallet_id: Wallet ID
+        timestamps: Sorted cash flow timestamps
+
+    Returns:
+        list: Networth (or None) per timestamp
+    """
+    if not timestamps:
+        return []
+    auto_points = _price_points(BalanceHistory, wallet_id, timestamps[0], timestamps[-1])
+    manual_points = _price_points(ManualBalance, wallet_id, timestamps[0], timestamps[-1])
+    networths = []
+    for timestamp in timestamps:
+        networth = _networth_at(auto_points, timestamp)
+        networths.append(networth if networth is not None else _networth_at(manual_points, timestamp))
+    return networths
+
+
+def replay_cash_flows(wallet, since=None):
+    """
+    Re-price cash flows at or after `since` and everything derived from them
+
+    Walks the wallet's cash flows in timestamp order starting from the quota
+    quantity outstanding before `since`, pricing each one like add_cash_flow
+    does (latest automatic balance at or before the flow, else latest manual
+    balance) against in-memory balance series. Updates each flow's
+    quota_value_at_time/quotas_issued, its QuotaHistory row (linked by
+    cash_flow_id), the wallet's current quota quantity, ledger_updated_at
+    and the NAV series from `since`, and bumps the wallet's data version. Changes are left in
+    the session to be flushed together; does not commit.
+
+    Args:
+        wallet: Wallet model instance
+        since: Earliest timestamp affected (None replays every cash flow)
+
+    Returns:
+        int: Number of cash flows replayed
+
+    Raises:
+        ValueError: If a cash out would redeem more quotas than are outstanding
+    """
+    flow_query = CashFlow.query.filter(CashFlow.wallet_id == wallet.id)
+    history_query = QuotaHistory.query.filter(QuotaHistory.wallet_id == wallet.id)
+    if since is not None:
+        flow_query = flow_query.filter(CashFlow.timestamp >= since)
+        history_query = history_query.filter(QuotaHistory.timestamp >= since)
+        quantity = quota_quantity_before(wallet.id, since)
+    else:
+        quantity = 0.0
+    flows = flow_query.order_by(CashFlow.timestamp, CashFlow.id).all()
+
+    if flows:
+        until = flows[-1].timestamp
+        auto_points = _price_points(BalanceHistory, wallet.id, since, until)
+        manual_points = _price_points(ManualBalance, wallet.id, since, until)
+
+        history_rows = {
+            row.cash_flow_id: row
+            for row in history_query.filter(QuotaHistory.timestamp <= until, QuotaHistory.cash_flow_id.isnot(None))
+        }
+
+        for flow in flows:
+            networth = _networth_at(auto_points, flow.timestamp)
+            if networth is None:
+                networth = _networth_at(manual_points, flow.timestamp)
+
+            if quantity <= 0:
+                # First quotas issued - use the initial quota value
+                quota_value = wallet.initial_quota_value
+                networth = None
+            elif networth is not None:
+                quota_value = networth / quantity
+            else:
+                # No balance recorded before this flow - keep its original price
+                quota_value = flow.quota_value_at_time
+
+            quotas = flow.amount / quota_value
+            quantity += quotas if flow.type == 'in' else -quotas
+            if quantity < -QUANTITY_EPSILON:
+                raise ValueError(f'Insufficient quotas to redeem for cash out on {flow.timestamp.strftime("%Y-%m-%d")}')
+            quantity = max(quantity, 0.0)
+
+            flow.quota_value_at_time = quota_value
+            flow.quotas_issued = quotas
+
+            history = history_rows.get(flow.id)
+            if history:
+                history.quota_value = quota_value
+                history.quota_quantity = quantity
+                if networth is not None:
+                    history.networth = networth
+
+    wallet.current_quota_quantity = quantity
+    wallet.ledger_updated_at = datetime.utcnow()
+    db.session.flush()
+    rebuild_nav(wallet, since=since)
+    bump_data_version(wallet.id)
+    return len(flows)
+
+
+def link_quota_history(executor, wallet_ids=None):
+    """
+    Link QuotaHistory rows without a cash_flow_id to their cash flows
+
+    Each cash flow has one QuotaHistory row created with it at the same
+    timestamp; unlinked rows (stored before the link existed, or imported
+    from backups that do not carry it) are paired with unlinked flows of the
+    same wallet and timestamp in ID order.
+
+    Args:
+        executor: Session or Connection to run the statements on
+        wallet_ids: Limit to these wallets (None for all)
+
+    Returns:
+        int: Number of rows linked
+    """
+    flows = CashFlow.__table__
+    history = QuotaHistory.__table__
+    linked = select(history.c.cash_flow_id).where(history.c.cash_flow_id.isnot(None))
+    flow_query = select(flows.c.id, flows.c.wallet_id, flows.c.timestamp).where(flows.c.id.notin_(linked))
+    history_query = select(history.c.id, history.c.wallet_id, history.c.timestamp).where(history.c.cash_flow_id.is_(None))
+    if wallet_ids is not None:
+        flow_query = flow_query.where(flows.c.wallet_id.in_(list(wallet_ids)))
+        history_query = history_query.where(history.c.wallet_id.in_(list(wallet_ids)))
+
+    unlinked_flows = {}
+    for row in executor.execute(flow_query.order_by(flows.c.wallet_id, flows.c.timestamp, flows.c.id)):
+        unlinked_flows.setdefault((row.wallet_id, row.timestamp), []).append(row.id)
+
+    links = []
+    for row in executor.execute(history_query.order_by(history.c.wallet_id, history.c.timestamp, history.c.id)):
+        flow_ids = unlinked_flows.get((row.wallet_id, row.timestamp))
+        if flow_ids:
+            links.append({'b_id': row.id, 'b_cash_flow_id': flow_ids.pop(0)})
+    if links:
+        executor.execute(
+            update(history).where(history.c.id == bindparam('b_id')).values(cash_flow_id=bindparam('b_cash_flow_id')),
+            links
+        )
+    return len(links)
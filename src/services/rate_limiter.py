@@ -0,0 +1,66 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter"""
+
+    def __init__(self, rate_per_minute, burst=1):
+        """
+        Args:
+            rate_per_minute: Sustained number of requests allowed per minute
+            burst: Maximum number of requests allowed back-to-back
+        """
+        self.rate = float(rate_per_minute) / 60.0
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, deadline=None):
+        """
+        Block until a token is available, then consume it
+
+        Args:
+            deadline: Optional time.monotonic() value; gives up instead of
+                      waiting past it
+
+        Returns:
+            bool: True if a token was consumed, False if the deadline would pass first
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_host_limiter(url, rate_per_minute, burst=1):
+    """
+    Get the shared rate limiter for the host of a URL
+
+    The limiter is created on first use; later calls for the same host
+    return the same instance so all threads share one budget.
+    """
+    host = urlparse(url).netloc
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = TokenBucket(rate_per_minute, burst)
+            _limiters[host] = limiter
+        return limiter
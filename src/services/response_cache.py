@@ -0,0 +1,132 @@
+"""
+Per-process caching of read endpoint payloads.
+
+Every write that changes a wallet's data bumps the wallet's row in the
+data_versions table inside the same transaction. Cached payloads are tagged
+with the versions of the wallets they were computed from and are only served
+while those versions are unchanged, so writes made by any process (the web
+workers or the scheduler) invalidate them. Entries are also evicted in LRU
+order and expire after a TTL, which bounds the drift of time-relative
+windows such as "last 30 days".
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from src.models.models import db, DataVersion
+
+RESPONSE_CACHE_MAX_ENTRIES = 512
+RESPONSE_CACHE_TTL_SECONDS = 300
+
+UPSERT_INSERTS = {
+    'postgresql': postgresql_insert,
+    'sqlite': sqlite_insert
+}
+
+# Returned by VersionedCache.get on a miss (None is a valid cached value)
+MISSING = object()
+
+
+class VersionedCache:
+    """Thread-safe LRU cache whose entries expire after a TTL or when their version changes"""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Cached value for `key` if it was stored under `version` and has not expired, else MISSING"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            entry_version, stored_at, value = entry
+            if entry_version != version or time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = VersionedCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+
+
+def bump_data_version(wallet_id):
+    """
+    Increment a wallet's data version in the current transaction
+
+    Upserts the wallet's data_versions row, so wallets created before the
+    table existed need no backfill. Does not commit.
+    """
+    now = datetime.utcnow()
+    table = DataVersion.__table__
+    insert = UPSERT_INSERTS[db.session.get_bind().dialect.name]
+    statement = insert(table).values(wallet_id=wallet_id, version=1, updated_at=now)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.wallet_id],
+        set_={'version': table.c.version + 1, 'updated_at': now}
+    )
+    db.session.execute(statement)
+
+
+def data_versions(wallet_ids):
+    """
+    Current data versions of a set of wallets
+
+    Returns:
+        tuple: Sorted (wallet_id, version) pairs; wallets never written have version 0
+    """
+    wallet_ids = sorted(set(wallet_ids))
+    if not wallet_ids:
+        return ()
+    stored = dict(db.session.query(DataVersion.wallet_id, DataVersion.version)
+                  .filter(DataVersion.wallet_id.in_(wallet_ids)).all())
+    return tuple((wallet_id, stored.get(wallet_id, 0)) for wallet_id in wallet_ids)
+
+
+def cached_payload(req, wallet_ids, compute, params=None):
+    """
+    Return the endpoint payload for the request, computing it on a miss
+
+    Entries are keyed on the endpoint, the query arguments and the wallet set
+    the caller may read, and tagged with those wallets' data versions.
+
+    Args:
+        req: Flask request
+        wallet_ids: IDs of the wallets the payload is computed from (the
+                    user's accessible wallets for portfolio-wide endpoints)
+        compute: Callable returning the JSON-serializable payload
+        params: Parsed arguments the payload depends on; keyed instead of
+                the raw query arguments when given, so unused or
+                defaulted arguments share an entry
+
+    Returns:
+        The payload (shared between requests; do not mutate it)
+    """
+    wallet_ids = sorted(set(wallet_ids))
+    args = sorted(params.items()) if params is not None else sorted(req.args.items(multi=True))
+    key = (req.endpoint, tuple(wallet_ids), tuple(args))
+    version = data_versions(wallet_ids)
+
+    payload = response_cache.get(key, version)
+    if payload is MISSING:
+        payload = compute()
+        response_cache.set(key, version, payload)
+    return payload
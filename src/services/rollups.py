@@ -0,0 +1,238 @@
+"""
+Networth rollups.
+
+Keeps per-wallet hour/day/week buckets of the merged automatic and manual
+balance series (closing networth per source, min, max, sum and point counts)
+so long-range charts read one row per bucket instead of every raw point.
+Buckets are updated in place for each new point and recomputed from the raw
+series when history is edited or deleted. History recorded before the
+rollups existed is aggregated by the rollup_backfill job; until it has run
+for a wallet, readers aggregate that wallet's raw points on the fly
+(wallets_missing_rollups / computed_rollups).
+"""
+from datetime import timedelta
+
+from sqlalchemy import and_, case, func, literal, or_, select, union_all
+
+from src.models.models import db, BalanceHistory, NetworthRollup
+from src.models.manual_balance import ManualBalance
+
+GRANULARITIES = ('hour', 'day', 'week')
+GRANULARITY_HOURS = {'hour': 1, 'day': 24, 'week': 24 * 7}
+
+# Default maximum number of points a chart series should return
+DEFAULT_POINT_BUDGET = 1000
+
+ROLLUP_FIELDS = (
+    'min_networth', 'max_networth', 'sum_networth', 'auto_count', 'manual_count',
+    'last_auto_networth', 'last_auto_timestamp', 'last_manual_networth', 'last_manual_timestamp'
+)
+
+
+def bucket_start(granularity, timestamp):
+    """Start of the bucket containing `timestamp` (weeks start on Monday)"""
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        return day
+    return day - timedelta(days=day.weekday())
+
+
+def _add_point(row, timestamp, networth, source):
+    row['min_networth'] = min(row['min_networth'], networth)
+    row['max_networth'] = max(row['max_networth'], networth)
+    row['sum_networth'] += networth
+    if source == 'automatic':
+        row['auto_count'] += 1
+        if row['last_auto_timestamp'] is None or timestamp >= row['last_auto_timestamp']:
+            row['last_auto_networth'] = networth
+            row['last_auto_timestamp'] = timestamp
+    else:
+        row['manual_count'] += 1
+        if row['last_manual_timestamp'] is None or timestamp >= row['last_manual_timestamp']:
+            row['last_manual_networth'] = networth
+            row['last_manual_timestamp'] = timestamp
+
+
+def _empty_row(wallet_id, granularity, start, networth):
+    return {
+        'wallet_id': wallet_id,
+        'granularity': granularity,
+        'bucket_start': start,
+        'min_networth': networth,
+        'max_networth': networth,
+        'sum_networth': 0.0,
+        'auto_count': 0,
+        'manual_count': 0,
+        'last_auto_networth': None,
+        'last_auto_timestamp': None,
+        'last_manual_networth': None,
+        'last_manual_timestamp': None
+    }
+
+
+def aggregate_rollups(wallet_id, points):
+    """
+    Aggregate balance points into rollup rows for every granularity
+
+    Args:
+        wallet_id: Wallet database ID
+        points: Iterable of (timestamp, networth, source) tuples
+
+    Returns:
+        list: NetworthRollup column dicts
+    """
+    buckets = {}
+    for timestamp, networth, source in points:
+        for granularity in GRANULARITIES:
+            start = bucket_start(granularity, timestamp)
+            row = buckets.get((granularity, start))
+            if row is None:
+                row = buckets[(granularity, start)] = _empty_row(wallet_id, granularity, start, networth)
+            _add_point(row, timestamp, networth, source)
+    return list(buckets.values())
+
+
+def balance_points_query(wallet_id, since=None):
+    """Core SELECT of a wallet's (timestamp, networth, source) points from both histories"""
+    auto = select(BalanceHistory.timestamp, BalanceHistory.networth, literal('automatic').label('source'))\
+        .where(BalanceHistory.wallet_id == wallet_id)
+    manual = select(ManualBalance.timestamp, ManualBalance.networth, literal('manual').label('source'))\
+        .where(ManualBalance.wallet_id == wallet_id)
+    if since is not None:
+        auto = auto.where(BalanceHistory.timestamp >= since)
+        manual = manual.where(ManualBalance.timestamp >= since)
+    return union_all(auto, manual)
+
+
+def wallets_missing_rollups(wallet_ids):
+    """
+    Wallets with balance points older than their first stored bucket
+
+    One grouped minimum per table over the (wallet_id, timestamp) indexes.
+
+    Returns:
+        set: IDs of wallets whose rollups do not cover their history yet
+    """
+    if not wallet_ids:
+        return set()
+    first_bucket = dict(db.session.query(NetworthRollup.wallet_id, func.min(NetworthRollup.bucket_start)).filter(
+        NetworthRollup.wallet_id.in_(wallet_ids),
+        NetworthRollup.granularity == 'hour'
+    ).group_by(NetworthRollup.wallet_id).all())
+
+    first_point = {}
+    for model in (BalanceHistory, ManualBalance):
+        rows = db.session.query(model.wallet_id, func.min(model.timestamp))\
+            .filter(model.wallet_id.in_(wallet_ids)).group_by(model.wallet_id).all()
+        for wallet_id, timestamp in rows:
+            first_point[wallet_id] = min(first_point.get(wallet_id, timestamp), timestamp)
+
+    return {
+        wallet_id for wallet_id, timestamp in first_point.items()
+        if wallet_id not in first_bucket or bucket_start('hour', timestamp) < first_bucket[wallet_id]
+    }
+
+
+def computed_rollups(wallet_id, since):
+    """
+    Buckets of every granularity from `since` forward, aggregated from the raw series
+
+    Returns unsaved NetworthRollup rows, for wallets whose stored rollups
+    are incomplete.
+    """
+    starts = {granularity: bucket_start(granularity, since) for granularity in GRANULARITIES}
+    points = db.session.execute(balance_points_query(wallet_id, since=starts['week'])).all()
+    return [
+        NetworthRollup(**row) for row in aggregate_rollups(wallet_id, points)
+        if row['bucket_start'] >= starts[row['granularity']]
+    ]
+
+
+def add_rollup_point(wallet_id, timestamp, networth, source):
+    """Fold a newly recorded balance point into its hour, day and week buckets. Does not commit."""
+    starts = {granularity: bucket_start(granularity, timestamp) for granularity in GRANULARITIES}
+    existing = NetworthRollup.query.filter(
+        NetworthRollup.wallet_id == wallet_id,
+        or_(*[and_(NetworthRollup.granularity == granularity, NetworthRollup.bucket_start == start)
+              for granularity, start in starts.items()])
+    ).all()
+    by_granularity = {rollup.granularity: rollup for rollup in existing}
+
+    for granularity, start in starts.items():
+        rollup = by_granularity.get(granularity)
+        if rollup is None:
+            row = _empty_row(wallet_id, granularity, start, networth)
+            _add_point(row, timestamp, networth, source)
+            db.session.add(NetworthRollup(**row))
+            continue
+        row = {field: getattr(rollup, field) for field in ROLLUP_FIELDS}
+        _add_point(row, timestamp, networth, source)
+        for field, value in row.items():
+            setattr(rollup, field, value)
+
+
+def rebuild_rollups(wallet, since=None):
+    """
+    Recompute a wallet's rollup buckets from `since` forward
+
+    Deletes every bucket that contains or follows `since` (all buckets when
+    None) and re-aggregates them from the raw series. Does not commit.
+    """
+    starts = {granularity: bucket_start(granularity, since) for granularity in GRANULARITIES} if since else None
+
+    delete_query = NetworthRollup.query.filter(NetworthRollup.wallet_id == wallet.id)
+    if starts:
+        delete_query = delete_query.filter(or_(*[
+            and_(NetworthRollup.granularity == granularity, NetworthRollup.bucket_start >= start)
+            for granularity, start in starts.items()
+        ]))
+    delete_query.delete(synchronize_session=False)
+
+    points = db.session.execute(balance_points_query(wallet.id, since=starts['week'] if starts else None)).all()
+    rows = aggregate_rollups(wallet.id, points)
+    if starts:
+        rows = [row for row in rows if row['bucket_start'] >= starts[row['granularity']]]
+    if rows:
+        db.session.execute(NetworthRollup.__table__.insert(), rows)
+    return len(rows)
+
+
+def rollup_networth():
+    """SQL expression for a bucket's closing networth (automatic over manual)"""
+    return case(
+        (NetworthRollup.auto_count > 0, NetworthRollup.last_auto_networth),
+        else_=NetworthRollup.last_manual_networth
+    )
+
+
+def pick_granularity(days, budget=DEFAULT_POINT_BUDGET):
+    """
+    Finest granularity whose bucket count over `days` fits the point budget
+
+    Falls back to weekly buckets when even those exceed the budget.
+    """
+    hours = max(days or 0, 1) * 24
+    for granularity in GRANULARITIES:
+        if hours / GRANULARITY_HOURS[granularity] <= budget:
+            return granularity
+    return GRANULARITIES[-1]
+
+
+def pick_stored_granularity(wallet_id, since, budget):
+    """
+    Finest granularity whose stored bucket count since `since` fits the budget
+
+    Uses the wallet's actual rollup rows (one grouped count), so sparse
+    histories keep a finer resolution than pick_granularity would give.
+    """
+    counts = dict(db.session.query(NetworthRollup.granularity, func.count(NetworthRollup.id)).filter(
+        NetworthRollup.wallet_id == wallet_id,
+        or_(*[and_(NetworthRollup.granularity == granularity, NetworthRollup.bucket_start >= bucket_start(granularity, since))
+              for granularity in GRANULARITIES])
+    ).group_by(NetworthRollup.granularity).all())
+    for granularity in GRANULARITIES:
+        if counts.get(granularity, 0) <= budget:
+            return granularity
+    return GRANULARITIES[-1]
@@ -0,0 +1,306 @@
+"""
+Snapshot storage helpers.
+
+Flattens Octav portfolio payloads into plain row dicts and writes them with
+bulk INSERT statements instead of one ORM object per protocol/token,
+fingerprints payloads so unchanged snapshots can be stored as heartbeats, and
+optionally delta-encodes token rows against periodic full keyframes.
+"""
+import hashlib
+import json
+
+from sqlalchemy import select
+
+from src.models.models import db, AppSettings, BalanceHistory, ProtocolBalance, TokenBalance
+
+TOKEN_STORAGE_FULL = 'full'
+TOKEN_STORAGE_DELTA = 'delta'
+DEFAULT_KEYFRAME_INTERVAL = 24
+
+# Token columns returned by the as-of reconstruction API
+TOKEN_FIELDS = ('token_symbol', 'token_name', 'balance', 'value', 'price', 'chain', 'protocol')
+TOKEN_KEY_FIELDS = ('chain', 'protocol', 'token_symbol', 'token_name')
+
+# Payload fields that change on every fetch without the holdings changing
+VOLATILE_KEYS = frozenset({
+    'lastUpdated', 'lastUpdatedAt', 'updatedAt', 'syncedAt', 'lastSync',
+    'lastSyncedAt', 'cachedAt', 'fetchedAt', 'timestamp'
+})
+
+
+def _strip_volatile(value):
+    if isinstance(value, dict):
+        return {k: _strip_volatile(v) for k, v in value.items() if k not in VOLATILE_KEYS}
+    if isinstance(value, list):
+        return [_strip_volatile(v) for v in value]
+    return value
+
+
+def payload_hash(portfolio_data):
+    """
+    SHA-256 of a portfolio payload with volatile fields removed
+
+    Keys are sorted so the hash does not depend on the API's key order.
+    """
+    normalized = json.dumps(_strip_volatile(portfolio_data), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _token_row(asset, chain_key, protocol):
+    return {
+        'token_symbol': asset.get('symbol', ''),
+        'token_name': asset.get('name', ''),
+        'balance': str(asset.get('balance', '0')),
+        'value': float(asset.get('value', 0)),
+        'price': float(asset.get('price', 0)),
+        'chain': chain_key,
+        'protocol': protocol
+    }
+
+
+def flatten_portfolio(portfolio_data):
+    """
+    Flatten a single wallet portfolio into protocol and token rows
+
+    Walks assetByProtocols -> chains -> protocolPositions once. Every
+    protocol yields one aggregated row (chain=None); every asset yields a
+    token row, and reward assets are tagged with a "<protocol>_rewards"
+    protocol.
+
+    Args:
+        portfolio_data: Single wallet portfolio data from API
+
+    Returns:
+        tuple: (protocol_rows, token_rows) as lists of column dicts
+    """
+    protocol_rows = []
+    token_rows = []
+
+    asset_by_protocols = portfolio_data.get('assetByProtocols', {})
+    for protocol_key, protocol_data in asset_by_protocols.items():
+        protocol_rows.append({
+            'protocol_name': protocol_data.get('name', protocol_key),
+            'protocol_key': protocol_key,
+            'value': float(protocol_data.get('value', 0)),
+            'chain': None  # Aggregated across chains
+        })
+
+        chains = protocol_data.get('chains', {})
+        for chain_key, chain_data in chains.items():
+            protocol_positions = chain_data.get('protocolPositions', {})
+
+            for position_data in protocol_positions.values():
+                for asset in position_data.get('assets', []):
+                    token_rows.append(_token_row(asset, chain_key, protocol_key))
+
+                # Also check for reward assets in farming positions
+                for asset in position_data.get('rewardAssets', []):
+                    token_rows.append(_token_row(asset, chain_key, f"{protocol_key}_rewards"))
+
+    return protocol_rows, token_rows
+
+
+def bulk_insert_rows(model, balance_history_id, rows):
+    """
+    Insert child rows of a balance snapshot with a single executemany
+
+    SQLite runs this as one executemany; on PostgreSQL SQLAlchemy batches
+    it into multi-row INSERT ... VALUES statements.
+    """
+    if not rows:
+        return
+    for row in rows:
+        row['balance_history_id'] = balance_history_id
+    db.session.execute(model.__table__.insert(), rows)
+
+
+def get_token_storage_mode():
+    """Get token storage mode from settings ('full' or 'delta'), default 'full'"""
+    setting = AppSettings.query.filter_by(key='token_storage_mode').first()
+    if setting and setting.value == TOKEN_STORAGE_DELTA:
+        return TOKEN_STORAGE_DELTA
+    return TOKEN_STORAGE_FULL
+
+
+def get_keyframe_interval():
+    """Get the number of snapshots per full token keyframe, default 24"""
+    setting = AppSettings.query.filter_by(key='token_keyframe_interval').first()
+    if setting and setting.value:
+        try:
+            return max(1, int(setting.value))
+        except ValueError:
+            pass
+    return DEFAULT_KEYFRAME_INTERVAL
+
+
+def _group_tokens(rows):
+    """
+    Group token rows by identity (chain, protocol, symbol, name)
+
+    The same token can appear more than once for one chain and protocol
+    (e.g. in two positions), so each identity maps to a list of rows and a
+    group is always replaced as a whole.
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[field] for field in TOKEN_KEY_FIELDS), []).append(row)
+    return groups
+
+
+def _same_group(old_rows, new_rows):
+    return len(old_rows) == len(new_rows) and all(
+        old[field] == new[field] for old, new in zip(old_rows, new_rows) for field in TOKEN_FIELDS
+    )
+
+
+def diff_tokens(base_rows, new_rows):
+    """
+    Compute delta rows that turn base_rows into new_rows
+
+    Added or changed token groups are stored in full with delta_op 'u';
+    removed groups keep only their identity fields with delta_op 'd'.
+    """
+    base = _group_tokens(base_rows)
+    delta = []
+    for key, group in _group_tokens(new_rows).items():
+        previous = base.pop(key, None)
+        if previous is None or not _same_group(previous, group):
+            delta.extend(dict(row, delta_op=TokenBalance.DELTA_UPSERT) for row in group)
+    for group in base.values():
+        row = group[0]
+        delta.append({
+            'token_symbol': row['token_symbol'],
+            'token_name': row['token_name'],
+            'balance': '0',
+            'value': 0.0,
+            'price': 0.0,
+            'chain': row['chain'],
+            'protocol': row['protocol'],
+            'delta_op': TokenBalance.DELTA_REMOVE
+        })
+    return delta
+
+
+def apply_token_delta(base_rows, delta_rows):
+    """Rebuild a full token set from keyframe rows and a snapshot's delta rows"""
+    tokens = _group_tokens(base_rows)
+    for key, group in _group_tokens(delta_rows).items():
+        if group[0].get('delta_op') == TokenBalance.DELTA_REMOVE:
+            tokens.pop(key, None)
+        else:
+            tokens[key] = group
+    return [{field: row[field] for field in TOKEN_FIELDS} for group in tokens.values() for row in group]
+
+
+def _load_token_rows(balance_history_ids):
+    """Load stored token rows grouped by balance_history_id, in insertion order"""
+    rows_by_history = {history_id: [] for history_id in balance_history_ids}
+    if not balance_history_ids:
+        return rows_by_history
+    table = TokenBalance.__table__
+    result = db.session.execute(
+        select(table).where(table.c.balance_history_id.in_(list(balance_history_ids))).order_by(table.c.id)
+    ).mappings()
+    for row in result:
+        rows_by_history[row['balance_history_id']].append(dict(row))
+    return rows_by_history
+
+
+def tokens_as_of_many(balance_history_ids):
+    """
+    Reconstruct the full token set for several balance snapshots
+
+    Heartbeats resolve to the snapshot they repeat, and delta snapshots are
+    rebuilt from their keyframe. Uses one query for snapshot metadata and
+    one for all token rows involved.
+
+    Args:
+        balance_history_ids: Iterable of BalanceHistory IDs
+
+    Returns:
+        dict: {balance_history_id: [token dict, ...]}
+    """
+    balance_history_ids = list(balance_history_ids)
+    if not balance_history_ids:
+        return {}
+
+    history = BalanceHistory.__table__
+    meta = {
+        row.id: row for row in db.session.execute(
+            select(history.c.id, history.c.heartbeat_of_id, history.c.token_keyframe_id)
+            .where(history.c.id.in_(balance_history_ids))
+        )
+    }
+    snapshot_ids = {row.heartbeat_of_id or row.id for row in meta.values()}
+    missing = snapshot_ids - set(meta)
+    if missing:
+        for row in db.session.execute(
+            select(history.c.id, history.c.heartbeat_of_id, history.c.token_keyframe_id)
+            .where(history.c.id.in_(missing))
+        ):
+            meta[row.id] = row
+
+    keyframe_ids = {meta[sid].token_keyframe_id for sid in snapshot_ids if meta[sid].token_keyframe_id}
+    rows = _load_token_rows(snapshot_ids | keyframe_ids)
+
+    result = {}
+    for history_id in balance_history_ids:
+        if history_id not in meta:
+            result[history_id] = []
+            continue
+        snapshot_id = meta[history_id].heartbeat_of_id or history_id
+        keyframe_id = meta[snapshot_id].token_keyframe_id
+        if keyframe_id:
+            result[history_id] = apply_token_delta(rows[keyframe_id], rows[snapshot_id])
+        else:
+            result[history_id] = [{field: row[field] for field in TOKEN_FIELDS} for row in rows[snapshot_id]]
+    return result
+
+
+def tokens_as_of(balance_history_id):
+    """Reconstruct the full token set stored for a single balance snapshot"""
+    return tokens_as_of_many([balance_history_id])[balance_history_id]
+
+
+def _delta_keyframe(previous):
+    """
+    Choose the keyframe a new delta snapshot should be encoded against
+
+    Returns None when the next snapshot must be a full keyframe.
+    """
+    if previous is None:
+        return None
+    snapshot = previous.heartbeat_of if previous.is_heartbeat else previous
+    keyframe_id = snapshot.token_keyframe_id or snapshot.id
+    deltas_since_keyframe = BalanceHistory.query.filter_by(token_keyframe_id=keyframe_id).count()
+    if deltas_since_keyframe + 1 >= get_keyframe_interval():
+        return None
+    return keyframe_id
+
+
+def write_snapshot_rows(balance_history, protocol_rows, token_rows, previous=None):
+    """
+    Bulk insert the protocol and token rows for a balance snapshot
+
+    In 'delta' token storage mode, token rows are stored as a diff against
+    the current keyframe (found through `previous`, the wallet's prior
+    snapshot) unless the keyframe interval is reached or the diff would not
+    be smaller than the full set.
+
+    Args:
+        balance_history: Flushed BalanceHistory record for the snapshot
+        protocol_rows: Protocol rows from flatten_portfolio
+        token_rows: Token rows from flatten_portfolio
+        previous: The wallet's previous BalanceHistory record, if any
+    """
+    bulk_insert_rows(ProtocolBalance, balance_history.id, protocol_rows)
+
+    if get_token_storage_mode() == TOKEN_STORAGE_DELTA:
+        keyframe_id = _delta_keyframe(previous)
+        if keyframe_id:
+            delta_rows = diff_tokens(_load_token_rows([keyframe_id])[keyframe_id], token_rows)
+            if len(delta_rows) < len(token_rows):
+                balance_history.token_keyframe_id = keyframe_id
+                token_rows = delta_rows
+
+    bulk_insert_rows(TokenBalance, balance_history.id, token_rows)
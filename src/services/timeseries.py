@@ -0,0 +1,135 @@
+"""
+Array-backed time series helpers.
+
+Aggregates per-wallet series on a shared timestamp axis using a
+wallets x time NumPy matrix instead of per-timestamp Python loops, and
+downsamples chart series with Largest-Triangle-Three-Buckets (LTTB).
+"""
+import numpy as np
+
+
+def forward_fill(matrix):
+    """
+    Forward-fill NaN gaps along the time axis (columns) of a 2-D array
+
+    Cells before a row's first value stay NaN.
+    """
+    if matrix.size == 0:
+        return matrix
+    columns = np.arange(matrix.shape[1])
+    last_seen = np.where(np.isnan(matrix), 0, columns)
+    np.maximum.accumulate(last_seen, axis=1, out=last_seen)
+    return matrix[np.arange(matrix.shape[0])[:, None], last_seen]
+
+
+def forward_filled_totals(rows):
+    """
+    Sum per-wallet series on a shared axis, carrying each wallet's last value forward
+
+    The axis is every timestamp at which at least one wallet has a value. At
+    each timestamp a wallet contributes its latest value at or before it;
+    wallets without any value yet are left out of the total and the count.
+
+    Args:
+        rows: Iterable of (wallet_id, timestamp, value) with at most one
+              value per wallet and timestamp
+
+    Returns:
+        tuple: (timestamps as datetime64[us], totals, wallet counts)
+    """
+    rows = list(rows)
+    if not rows:
+        return np.array([], dtype='datetime64[us]'), np.array([]), np.array([], dtype=int)
+
+    wallet_ids = np.array([row[0] for row in rows])
+    timestamps = np.array([row[1] for row in rows], dtype='datetime64[us]')
+    values = np.array([row[2] for row in rows], dtype=float)
+
+    axis, time_index = np.unique(timestamps, return_inverse=True)
+    wallets, wallet_index = np.unique(wallet_ids, return_inverse=True)
+
+    matrix = np.full((wallets.size, axis.size), np.nan)
+    matrix[wallet_index, time_index] = values
+    filled = forward_fill(matrix)
+
+    known = ~np.isnan(filled)
+    totals = np.where(known, filled, 0.0).sum(axis=0)
+    return axis, totals, known.sum(axis=0)
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Indices of the points kept when downsampling with LTTB
+
+    The first and last points are always kept, and so are the series'
+    minimum and maximum values: if no kept point has an extreme value, the
+    extreme replaces the point chosen in its bucket (so the result can
+    exceed `threshold` only when both extremes fall in the same bucket).
+
+    Args:
+        x: Ascending x coordinates (e.g. epoch seconds)
+        y: Values
+        threshold: Target number of points (at least 3)
+
+    Returns:
+        numpy.ndarray: Sorted indices into x/y
+    """
+    n = len(y)
+    threshold = max(int(threshold), 3)
+    if n <= threshold:
+        return np.arange(n)
+
+    every = (n - 2) / (threshold - 2)
+    starts = (np.arange(threshold - 2) * every).astype(int) + 1
+    ends = np.append(starts[1:], n - 1)
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    anchor = 0
+    for bucket in range(threshold - 2):
+        start, end = starts[bucket], ends[bucket]
+        if bucket + 1 < threshold - 2:
+            next_start, next_end = starts[bucket + 1], ends[bucket + 1]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs(
+            (x[anchor] - avg_x) * (y[start:end] - y[anchor])
+            - (x[anchor] - x[start:end]) * (avg_y - y[anchor])
+        )
+        anchor = start + int(np.argmax(areas))
+        selected[bucket + 1] = anchor
+
+    kept = [selected]
+    forced_buckets = set()
+    for extreme in (int(np.argmin(y)), int(np.argmax(y))):
+        if np.any(y[selected] == y[extreme]):
+            continue
+        bucket = int(np.searchsorted(starts, extreme, side='right')) - 1
+        if bucket in forced_buckets:
+            kept.append(np.array([extreme]))
+        else:
+            selected[bucket + 1] = extreme
+            forced_buckets.add(bucket)
+    return np.unique(np.concatenate(kept))
+
+
+def downsample_points(points, threshold, value_key='networth', time_key='timestamp'):
+    """
+    Downsample a list of chart point dicts with LTTB
+
+    Points must be in ascending time order; kept points are returned
+    unchanged (including tags such as 'source').
+
+    Args:
+        points: List of dicts with an ISO timestamp and a numeric value
+        threshold: Maximum number of points wanted (None or <= 0 keeps all)
+        value_key: Key of the value to preserve the shape of
+        time_key: Key of the ISO timestamp
+    """
+    if not threshold or threshold <= 0 or len(points) <= threshold:
+        return points
+    x = np.array([point[time_key] for point in points], dtype='datetime64[us]').astype('int64') / 1e6
+    y = np.array([point[value_key] for point in points], dtype=float)
+    return [points[index] for index in lttb_indices(x, y, threshold)]
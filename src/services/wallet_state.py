@@ -0,0 +1,73 @@
+"""
+Denormalized per-wallet state kept in sync by the balance write paths.
+
+Wallet.latest_balance_id points at the newest automatic snapshot (used for
+protocol and token breakdowns); latest_networth/latest_timestamp hold the
+newest balance point from either automatic or manual history, with automatic
+data winning ties. The materialized NAV series (NavHistory) and the networth
+rollups are updated, and the wallet's data version bumped, from the same hooks.
+"""
+from src.models.models import db, BalanceHistory
+from src.models.manual_balance import ManualBalance
+from src.services.quota_engine import append_nav_point, rebuild_nav
+from src.services.response_cache import bump_data_version
+from src.services.rollups import add_rollup_point, rebuild_rollups
+
+
+def record_snapshot(wallet, balance_history):
+    """Update wallet state for a newly saved (and flushed) automatic snapshot"""
+    append_nav_point(wallet, balance_history.timestamp, balance_history.networth, 'automatic')
+    add_rollup_point(wallet.id, balance_history.timestamp, balance_history.networth, 'automatic')
+    bump_data_version(wallet.id)
+    wallet.latest_balance_id = balance_history.id
+    if wallet.latest_timestamp is None or balance_history.timestamp >= wallet.latest_timestamp:
+        wallet.latest_networth = balance_history.networth
+        wallet.latest_timestamp = balance_history.timestamp
+
+
+def record_manual_balance(wallet, manual_balance):
+    """Update wallet state for a newly added (and flushed) manual balance"""
+    append_nav_point(wallet, manual_balance.timestamp, manual_balance.networth, 'manual')
+    add_rollup_point(wallet.id, manual_balance.timestamp, manual_balance.networth, 'manual')
+    bump_data_version(wallet.id)
+    if wallet.latest_timestamp is None or manual_balance.timestamp > wallet.latest_timestamp:
+        wallet.latest_networth = manual_balance.networth
+        wallet.latest_timestamp = manual_balance.timestamp
+
+
+def refresh_latest_balance(wallet):
+    """
+    Recompute the wallet's latest pointer from history
+
+    Used when a write can move the latest point backwards (manual balance
+    edits and deletes, backup imports).
+    """
+    latest_auto = db.session.query(BalanceHistory.id, BalanceHistory.timestamp, BalanceHistory.networth)\
+        .filter(BalanceHistory.wallet_id == wallet.id)\
+        .order_by(BalanceHistory.timestamp.desc()).first()
+    latest_manual = db.session.query(ManualBalance.timestamp, ManualBalance.networth)\
+        .filter(ManualBalance.wallet_id == wallet.id)\
+        .order_by(ManualBalance.timestamp.desc()).first()
+
+    wallet.latest_balance_id = latest_auto.id if latest_auto else None
+
+    latest = latest_auto
+    if latest_manual and (latest is None or latest_manual.timestamp > latest.timestamp):
+        latest = latest_manual
+
+    wallet.latest_networth = latest.networth if latest else None
+    wallet.latest_timestamp = latest.timestamp if latest else None
+
+
+def balances_changed(wallet, since=None):
+    """
+    Update wallet state after balance points were edited, deleted or imported
+
+    Args:
+        wallet: Wallet model instance
+        since: Earliest timestamp affected (None re-derives everything)
+    """
+    refresh_latest_balance(wallet)
+    rebuild_nav(wallet, since=since)
+    rebuild_rollups(wallet, since=since)
+    bump_data_version(wallet.id)